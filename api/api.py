@@ -3,15 +3,19 @@ import datetime
 import json
 import pytz
 import sys
+import time
 import traceback
 import webapp2
 import webapp2_extras.routes
 
 from . import base
 from .jobs.jobs import Job
+from .jobs import queue, stats
 from .jobs.handlers import JobsHandler, JobHandler, GearsHandler, GearHandler, RulesHandler
 from .dao.containerutil import FileReference, ContainerReference
 from . import encoder
+from . import instrumentation
+from . import metrics
 from . import root
 from . import util
 from . import config
@@ -143,6 +147,38 @@ class Version(base.RequestHandler):
 
         return config.get_version()
 
+class Metrics(base.RequestHandler):
+
+    def get(self):
+        """
+        .. http:get:: /api/metrics
+
+            Return server metrics in the Prometheus text exposition format. Requires superuser.
+
+            Request, upload, download, hashing and job dequeue metrics are totals over every worker, as of their
+            last write to the spool directory (see api/metrics.py). Job counts are read from the job statistics.
+            Request durations run until the handler returns; the time spent streaming a body, such as an archive
+            download or a job event stream, is not included.
+
+            :statuscode 200: no error
+            :statuscode 403: not a superuser request
+        """
+
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        counts, _, permafailed = stats.get_counts(queue.max_attempts())
+        reconciliation = stats.get_reconciliation() or {}
+        gauges = [
+            ('scitran_jobs', 'Jobs by state.', [([('state', state)], counts.get(state, 0)) for state in queue.JOB_STATES]),
+            ('scitran_jobs_permafailed', 'Failed jobs that will not be retried.', [([], permafailed)]),
+            ('scitran_job_stats_drift', 'Drift of the job statistics found by their last reconciliation.', [([], reconciliation.get('drift', 0))]),
+            ('scitran_config_snapshot_age_seconds', 'Time since this worker last loaded the config from the database.', [([], config.get_snapshot_age())]),
+        ]
+
+        self.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        self.response.write(metrics.registry.render(gauges))
+
 #regexes used in routing table:
 routing_regexes = {
     # group id regex
@@ -192,6 +228,7 @@ routes = [
         webapp2.Route(r'/config',           Config, methods=['GET']),
         webapp2.Route(r'/config.js',        Config, handler_method='get_js', methods=['GET']),
         webapp2.Route(r'/version',          Version, methods=['GET']),
+        webapp2.Route(r'/metrics',          Metrics, methods=['GET']),
     ]),
     webapp2.Route(r'/api/users',            userhandler.UserHandler, handler_method='get_all', methods=['GET']),
     webapp2.Route(r'/api/users',            userhandler.UserHandler, methods=['POST']),
@@ -206,7 +243,10 @@ routes = [
     webapp2_extras.routes.PathPrefixRoute(r'/api/jobs', [
         webapp2.Route(r'/next',             JobsHandler, handler_method='next', methods=['GET']),
         webapp2.Route(r'/stats',            JobsHandler, handler_method='stats', methods=['GET']),
+        webapp2.Route(r'/stats/reconcile',  JobsHandler, handler_method='reconcile_stats', methods=['POST']),
         webapp2.Route(r'/reap',             JobsHandler, handler_method='reap_stale', methods=['POST']),
+        webapp2.Route(r'/heartbeat',        JobsHandler, handler_method='heartbeat', methods=['POST']),
+        webapp2.Route(r'/events',           JobsHandler, handler_method='events', methods=['GET']),
         webapp2.Route(r'/add',              JobsHandler, handler_method='add', methods=['POST']),
         webapp2.Route(r'/<:[^/]+>',         JobHandler,  name='job'),
         webapp2.Route(r'/<:[^/]+>/retry',   JobHandler,  name='job', handler_method='retry', methods=['POST']),
@@ -287,6 +327,9 @@ routes = [
 
 
 def dispatcher(router, request, response):
+    # The current snapshot, without requiring the database like config.get_item() does
+    core_config = config.get_snapshot()['core']
+    instrumentation.begin(profile=bool(core_config.get('profile_path')))
     try:
         rv = router.default_dispatcher(request, response)
         if rv is not None:
@@ -300,6 +343,16 @@ def dispatcher(router, request, response):
         else:
             message = 'Internal Server Error'
         util.send_json_http_exception(response, message, 500)
+    finally:
+        request_stats = instrumentation.end(request, response, core_config.get('slow_request_threshold'), core_config.get('profile_path'))
+        route = getattr(request, 'route', None)
+        metrics.REQUEST_DURATION.observe(
+            time.time() - request_stats.start,
+            # Templates, not names: routes share names, such as 'job' for every /api/jobs/<id> route
+            route=route.template if route else 'unmatched',
+            method=request.method,
+            status=response.status_int
+        )
 
 def app_factory(*_, **__):
     # don't use config.get_item() as we don't want to require the database at startup
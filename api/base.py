@@ -1,4 +1,5 @@
 import copy
+import calendar
 import datetime
 import json
 import jsonschema
@@ -11,13 +12,58 @@ import webapp2
 
 from . import util
 from . import files
+from . import cache
+from . import gravatar
 from . import config
 from .types import Origin
 from . import validators
-from .dao import APIConsistencyException, APIConflictException
+from .dao import APIConsistencyException, APIConflictException, identitymap
 
 log = config.log
 
+# Per-worker map of access token -> {'uid', 'root', 'disabled'}, saving the authtokens and users lookups on every request.
+# Changes made by other workers are only seen once an entry expires, so keep the ttl short.
+TOKEN_CACHE_TTL = 60
+token_cache = cache.TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+
+def invalidate_cached_user(uid):
+    """
+    Drop all cached tokens for a user. Call whenever a user's root or disabled flags may have changed.
+    """
+    token_cache.discard_if(lambda entry: entry['uid'] == uid)
+
+
+def login_updates(uid, timestamp, provider_avatar=None):
+    """
+    Returns the users collection write operations recording a login, for a single bulk write.
+    """
+
+    ops = [
+        # If this is the first time they've logged in, record that
+        pymongo.UpdateOne({'_id': uid, 'firstlogin': None}, {'$set': {'firstlogin': timestamp}}),
+
+        # Unconditionally set their most recent login time
+        pymongo.UpdateOne({'_id': uid}, {'$set': {'lastlogin': timestamp}}),
+    ]
+
+    if provider_avatar is not None:
+        ops += [
+            # Update the user's provider avatar if it has changed.
+            pymongo.UpdateOne({'_id': uid, 'avatars.provider': {'$ne': provider_avatar}}, {'$set':{'avatars.provider': provider_avatar, 'modified': timestamp}}),
+
+            # If the user has no avatar set, mark their provider_avatar as their chosen avatar.
+            pymongo.UpdateOne({'_id': uid, 'avatar': {'$exists': False}}, {'$set':{'avatar': provider_avatar, 'modified': timestamp}}),
+        ]
+
+    return ops
+
+def set_gravatar(uid, gravatar_url):
+    """
+    Update the user's gravatar if it has changed.
+    """
+    config.db.users.update_one({'_id': uid, 'avatars.gravatar': {'$ne': gravatar_url}}, {'$set':{'avatars.gravatar': gravatar_url, 'modified': datetime.datetime.utcnow()}})
+
+
 class RequestHandler(webapp2.RequestHandler):
 
     json_schema = None
@@ -79,7 +125,9 @@ class RequestHandler(webapp2.RequestHandler):
         elif drone_request:
             self.superuser_request = True
         else:
-            user = config.db.users.find_one({'_id': self.uid}, ['root', 'disabled'])
+            user = token_cache.get(access_token) if access_token else None
+            if user is None:
+                user = config.db.users.find_one({'_id': self.uid}, ['root', 'disabled'])
             if not user:
                 self.abort(402, 'user ' + self.uid + ' does not exist')
             if user.get('disabled', False) is True:
@@ -101,19 +149,36 @@ class RequestHandler(webapp2.RequestHandler):
         Returns the user's UID.
         """
 
+        cached_user = token_cache.get(access_token)
+        if cached_user is not None:
+            return cached_user['uid']
+
         uid = None
         timestamp = datetime.datetime.utcnow()
         cached_token = config.db.authtokens.find_one({'_id': access_token})
 
         if cached_token:
             uid = cached_token['uid']
+            token_timestamp = cached_token['timestamp']
             log.debug('looked up cached token in %dms' % ((datetime.datetime.utcnow() - timestamp).total_seconds() * 1000.))
         else:
             uid = self.validate_oauth_token(access_token, timestamp)
+            token_timestamp = timestamp
             log.debug('looked up remote token in %dms' % ((datetime.datetime.utcnow() - timestamp).total_seconds() * 1000.))
 
             # Cache the token for future requests
-            config.db.authtokens.replace_one({'_id': access_token}, {'uid': uid, 'timestamp': timestamp}, upsert=True)
+            config.db.authtokens.replace_one({'_id': access_token}, {'uid': uid, 'timestamp': token_timestamp}, upsert=True)
+
+        # Cache the user's flags alongside the token, but never past the token's own expiry in the database.
+        # Unknown users are not cached so that the request is rejected below.
+        user = config.db.users.find_one({'_id': uid}, ['root', 'disabled'])
+        if user:
+            token_expiry = token_timestamp + datetime.timedelta(seconds=config.AUTH_TOKEN_TTL)
+            token_cache.set(access_token, {
+                'uid': uid,
+                'root': user.get('root', False),
+                'disabled': user.get('disabled', False),
+            }, expires=calendar.timegm(token_expiry.utctimetuple()))
 
         return uid
 
@@ -140,11 +205,7 @@ class RequestHandler(webapp2.RequestHandler):
         if not uid:
             self.abort(400, 'OAuth2 token resolution did not return email address')
 
-        # If this is the first time they've logged in, record that
-        config.db.users.update_one({'_id': self.uid, 'firstlogin': None}, {'$set': {'firstlogin': timestamp}})
-
-        # Unconditionally set their most recent login time
-        config.db.users.update_one({'_id': self.uid}, {'$set': {'lastlogin': timestamp}})
+        provider_avatar = None
 
         # Set user's auth provider avatar
         # TODO: switch on auth.provider rather than manually comparing endpoint URL.
@@ -158,17 +219,11 @@ class RequestHandler(webapp2.RequestHandler):
             query.pop('sz', None)
             u = u._replace(query=urllib.urlencode(query, True))
             provider_avatar = urlparse.urlunparse(u)
-            # Update the user's provider avatar if it has changed.
-            config.db.users.update_one({'_id': uid, 'avatars.provider': {'$ne': provider_avatar}}, {'$set':{'avatars.provider': provider_avatar, 'modified': timestamp}})
 
-            # If the user has no avatar set, mark their provider_avatar as their chosen avatar.
-            config.db.users.update_one({'_id': uid, 'avatar': {'$exists': False}}, {'$set':{'avatar': provider_avatar, 'modified': timestamp}})
+        config.db.users.bulk_write(login_updates(uid, timestamp, provider_avatar), ordered=False)
 
-        # Look to see if user has a Gravatar
-        gravatar = util.resolve_gravatar(uid)
-        if gravatar is not None:
-            # Update the user's gravatar if it has changed.
-            config.db.users.update_one({'_id': uid, 'avatars.gravatar': {'$ne': gravatar}}, {'$set':{'avatars.gravatar': gravatar, 'modified': timestamp}})
+        # Look to see if user has a Gravatar. This is a round trip to gravatar.com, so it is done in the background.
+        gravatar.resolve_async(uid, set_gravatar)
 
         return uid
 
@@ -271,7 +326,13 @@ class RequestHandler(webapp2.RequestHandler):
         target_site = self.get_param('site', site_id)
         if target_site == site_id:
             log.debug('from %s %s %s %s %s' % (self.source_site, self.uid, self.request.method, self.request.path, str(self.request.GET.mixed())))
-            return super(RequestHandler, self).dispatch()
+            # Containers are loaded at most once per request; see dao.identitymap
+            identitymap.begin()
+            try:
+                return super(RequestHandler, self).dispatch()
+            finally:
+                identity_map = identitymap.end()
+                log.debug('loaded %d containers, %d loads served by the identity map' % (identity_map.loads, identity_map.hits))
         else:
             if not site_id:
                 self.abort(500, 'api site.id is not configured')
@@ -0,0 +1,75 @@
+"""
+Small in-process caches.
+
+Each uwsgi worker holds its own copy of these, so anything cached here must either be immutable
+or tolerate being stale for at most the cache ttl in the other workers.
+"""
+
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    A bounded, thread-safe map whose entries expire.
+
+    When full, the least recently used entry is evicted. Entries expire after `ttl` seconds, or at
+    an explicit `expires` timestamp passed to set(), whichever comes first. A ttl of None disables
+    time-based expiry, leaving a plain LRU.
+    """
+
+    def __init__(self, maxsize, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.timer   = timer
+        self._data   = collections.OrderedDict()
+        self._lock   = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= self.timer():
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, expires=None):
+        if self.ttl is not None:
+            default_expires = self.timer() + self.ttl
+            expires = default_expires if expires is None else min(expires, default_expires)
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def discard_if(self, predicate):
+        """
+        Remove every entry whose value matches predicate. Returns the number of entries removed.
+        """
+        with self._lock:
+            keys = [k for k, (v, _) in self._data.iteritems() if predicate(v)]
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
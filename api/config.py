@@ -1,11 +1,14 @@
 import os
 import copy
 import glob
+import time
 import logging
 import pymongo
 import datetime
+import threading
 import elasticsearch
 
+from . import instrumentation
 
 logging.basicConfig(
     format='%(asctime)s %(name)16.16s %(filename)24.24s %(lineno)5d:%(levelname)4.4s %(message)s',
@@ -27,6 +30,9 @@ DEFAULT_CONFIG = {
         'insecure': False,
         'newrelic': None,
         'drone_secret': None,
+        'slow_request_threshold': None,
+        'profile_path': None,
+        'metrics_path': None,
     },
     'site': {
         'id': 'local',
@@ -39,6 +45,8 @@ DEFAULT_CONFIG = {
     'queue': {
         'max_retries': 3,
         'retry_on_fail': False,
+        'orphan_timeout': 100,
+        'max_event_streams': 8,
     },
     'auth': {
         'client_id': '1052740023071-n20pk8h5uepdua3r8971pc6jrf25lvee.apps.googleusercontent.com',
@@ -79,23 +87,34 @@ def apply_env_variables(config):
 # Create config for startup, will be merged with db config when db is available
 __config = apply_env_variables(copy.deepcopy(DEFAULT_CONFIG))
 __config_persisted = False
-__last_update = datetime.datetime.utcfromtimestamp(0)
+__last_update = 0
+
+# Seconds between background refreshes of the config snapshot from the database
+CONFIG_REFRESH_INTERVAL = 120
+__init_lock = threading.Lock()
 
 if not os.path.exists(__config['persistent']['data_path']):
     os.makedirs(__config['persistent']['data_path'])
 
 log.setLevel(getattr(logging, __config['core']['log_level'].upper()))
 
+# Size in bytes of the capped collection of recent job state changes
+JOB_EVENTS_SIZE = 16 * 2**20
+
+# Lifetime of a cached OAuth token, enforced by a TTL index on the authtokens collection
+AUTH_TOKEN_TTL = 604800
+
 db = pymongo.MongoClient(
     __config['persistent']['db_uri'],
     j=True, # Requests only return once write has hit the DB journal
     connectTimeoutMS=__config['persistent']['db_connect_timeout'],
     serverSelectionTimeoutMS=__config['persistent']['db_server_selection_timeout'],
     connect=False, # Connect on first operation to avoid multi-threading related errors
+    event_listeners=[instrumentation.CommandTimer()],
 ).get_default_database()
 log.debug(str(db))
 
-es = elasticsearch.Elasticsearch([__config['persistent']['elasticsearch_host']])
+es = elasticsearch.Elasticsearch([__config['persistent']['elasticsearch_host']], transport_class=instrumentation.TimedTransport)
 
 # validate the lists of json schemas
 schema_path = __config['persistent']['schema_path']
@@ -176,14 +195,27 @@ def create_or_recreate_ttl_index(coll_name, index_name, ttl):
 
 def initialize_db():
     log.info('Initializing database, creating indexes')
-    # TODO jobs indexes
     # TODO review all indexes
     db.projects.create_index([('gid', 1), ('name', 1)])
+    db.projects.create_index('group')
     db.sessions.create_index('project')
     db.sessions.create_index('uid')
     db.acquisitions.create_index('session')
+    db.acquisitions.create_index('project')
+    db.acquisitions.create_index('group')
+    db.sessions.create_index('group')
     db.acquisitions.create_index('uid')
     db.acquisitions.create_index('collections')
+    # Must be kept in sync with jobs/queue.py; dequeue sorts by priority, then modified
+    db.jobs.create_index([('state', 1), ('priority', -1), ('modified', 1)])
+    db.jobs.create_index([('state', 1), ('tags', 1), ('priority', -1), ('modified', 1)])
+    db.jobs.create_index([('state', 1), ('modified', 1)])
+    db.jobs.create_index('previous_job_id')
+    db.jobs.create_index([('input_containers.type', 1), ('input_containers.id', 1)])
+    # Listing filters and keyset order, for JobsHandler.get
+    db.jobs.create_index([('modified', 1), ('_id', 1)])
+    db.jobs.create_index([('name', 1), ('modified', 1)])
+    db.jobs.create_index([('tags', 1), ('modified', 1)])
 
     # Must be kept in sync with jobs/gears.py
     db.singletons.update({"_id" : "gears"}, {
@@ -202,7 +234,14 @@ def initialize_db():
         upsert=True
     )
 
-    create_or_recreate_ttl_index('authtokens', 'timestamp', 604800)
+    # Must be kept in sync with jobs/events.py, which tails it
+    if 'jobevents' not in db.collection_names():
+        try:
+            db.create_collection('jobevents', capped=True, size=JOB_EVENTS_SIZE)
+        except pymongo.errors.CollectionInvalid:
+            pass # created by another process
+
+    create_or_recreate_ttl_index('authtokens', 'timestamp', AUTH_TOKEN_TTL)
     create_or_recreate_ttl_index('uploads', 'timestamp', 60)
     create_or_recreate_ttl_index('downloads', 'timestamp', 60)
 
@@ -210,33 +249,96 @@ def initialize_db():
     db.groups.update_one({'_id': 'unknown'}, {'$setOnInsert': { 'created': now, 'modified': now, 'name': 'Unknown', 'roles': []}}, upsert=True)
     db.sites.replace_one({'_id': __config['site']['id']}, {'name': __config['site']['name'], 'site_url': __config['site']['api_url']}, upsert=True)
 
-def get_config():
+def merge_config(config, db_config):
+    """
+    Merge a config stored in the database into config, section by section.
+
+    Settings added since the stored copy was written, such as queue.orphan_timeout, keep their value in config;
+    replacing whole sections would drop them, and reading them would raise KeyError.
+    """
+    for key, value in db_config.iteritems():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+    return config
+
+def _persist_config():
+    """
+    Merge the startup config with the database copy and write it back. Runs once per process.
+    """
     global __last_update, __config, __config_persisted
+    initialize_db()
+    log.info('Persisting configuration')
+
     now = datetime.datetime.utcnow()
-    if not __config_persisted:
-        initialize_db()
-        log.info('Persisting configuration')
-
-        db_config = db.singletons.find_one({'_id': 'config'})
-        if db_config is not None:
-            startup_config = copy.deepcopy(__config)
-            startup_config.update(db_config)
-            # Precedence order for config is env vars -> db values -> default
-            __config = apply_env_variables(startup_config)
-        else:
-            __config['created'] = now
-        __config['modified'] = now
-
-        r = db.singletons.replace_one({'_id': 'config'}, __config, upsert=True)
-        __config_persisted = bool(r.modified_count)
-        __last_update = now
-    elif now - __last_update > datetime.timedelta(seconds=120):
-        log.debug('Refreshing configuration from database')
-        __config = db.singletons.find_one({'_id': 'config'})
-        __last_update = now
+    startup_config = copy.deepcopy(__config)
+    db_config = db.singletons.find_one({'_id': 'config'})
+    if db_config is not None:
+        merge_config(startup_config, db_config)
+        # Precedence order for config is env vars -> db values -> default
+        startup_config = apply_env_variables(startup_config)
+    else:
+        startup_config['created'] = now
+    startup_config['modified'] = now
+
+    db.singletons.replace_one({'_id': 'config'}, startup_config, upsert=True)
+    __config = startup_config
+    __last_update = time.time()
+    __config_persisted = True
+
+def _refresh_config():
+    """
+    Load a fresh config snapshot from the database and swap it in.
+
+    The published snapshot is never mutated; readers holding the old one keep a consistent view.
+    """
+    global __last_update, __config
+    log.debug('Refreshing configuration from database')
+    new_config = db.singletons.find_one({'_id': 'config'})
+    if new_config is not None:
+        # The stored copy may have been written by a process running older code, without newer settings
+        __config = merge_config(copy.deepcopy(DEFAULT_CONFIG), new_config)
+        __last_update = time.time()
         log.setLevel(getattr(logging, __config['core']['log_level'].upper()))
+
+def _refresh_loop():
+    while True:
+        time.sleep(CONFIG_REFRESH_INTERVAL)
+        try:
+            _refresh_config()
+        except Exception: # pylint: disable=broad-except
+            log.exception('Could not refresh configuration, keeping snapshot from {:.0f}s ago'.format(get_snapshot_age()))
+
+def get_config():
+    """
+    Returns the current config snapshot. Treat it as read-only.
+
+    The first call in a process persists the config and starts the background refresh;
+    every later call is a plain lookup.
+    """
+    if not __config_persisted:
+        with __init_lock:
+            if not __config_persisted:
+                _persist_config()
+                refresher = threading.Thread(target=_refresh_loop, name='config-refresh')
+                refresher.daemon = True
+                refresher.start()
     return __config
 
+def get_snapshot():
+    """
+    Returns the current config snapshot as is, without persisting it or otherwise touching the database,
+    for code that must work before the database is available. Treat it as read-only.
+    """
+    return __config
+
+def get_snapshot_age():
+    """
+    Seconds since the config snapshot was last loaded from the database.
+    """
+    return time.time() - __last_update
+
 def get_public_config():
     return {
         'created': __config.get('created'),
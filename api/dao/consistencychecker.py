@@ -3,6 +3,7 @@ do some verification against the database before allowing the operation"""
 
 from .. import config
 from . import APIConsistencyException
+from . import identitymap
 
 log = config.log
 
@@ -37,7 +38,7 @@ def user_on_permission(data_op, **kwargs):
     Used before PUT operations.
     """
     if data_op['site'] == config.get_item('site', 'id'):
-        if not config.db.users.find_one({'_id': data_op['_id']}):
+        if not identitymap.find_one('users', data_op['_id']):
             raise APIConsistencyException('user does not exist')
 
 def field_on_container(parent_field, parent_container_name):
@@ -47,7 +48,7 @@ def field_on_container(parent_field, parent_container_name):
     Used before POST/PUT operations.
     """
     def f(data_op, **kwargs):
-        if data_op.get(parent_field) and not config.db[parent_container_name].find_one({'_id': data_op[parent_field]}):
+        if data_op.get(parent_field) and not identitymap.find_one(parent_container_name, data_op[parent_field]):
             raise APIConsistencyException('{} {} does not exist'.format(parent_field, data_op[parent_field]))
     return f
 
@@ -1,3 +1,5 @@
+import copy
+
 import bson.errors
 import bson.objectid
 import pymongo.errors
@@ -7,6 +9,7 @@ from .. import config
 from . import consistencychecker
 from . import APIStorageException, APIConflictException
 from . import hierarchy
+from . import identitymap
 
 log = config.log
 
@@ -38,7 +41,8 @@ class ContainerStorage(object):
         data_op = payload or {'_id': _id}
         check(data_op)
         if action == 'GET' and _id:
-            return self._get_el(_id, projection)
+            # Callers filter and annotate the result; keep the identity map's shared document unchanged
+            return copy.deepcopy(self._get_el(_id, projection))
         if action == 'GET':
             return self._get_all_el(query, user, public, projection)
         if action == 'DELETE':
@@ -55,6 +59,7 @@ class ContainerStorage(object):
             result = self.dbc.insert_one(payload)
         except pymongo.errors.DuplicateKeyError:
             raise APIConflictException('Object with id {} already exists.'.format(payload['_id']))
+        identitymap.discard(self.cont_name, result.inserted_id)
         return result
 
     def _update_el(self, _id, payload, recursive=False, r_payload=None, replace_metadata=False):
@@ -79,6 +84,7 @@ class ContainerStorage(object):
                 raise APIStorageException(e.message)
         if recursive and r_payload is not None:
             hierarchy.propagate_changes(self.cont_name, _id, {}, {'$set': util.mongo_dict(r_payload)})
+        identitymap.discard(self.cont_name, _id)
         return self.dbc.update_one({'_id': _id}, update)
 
     def _delete_el(self, _id):
@@ -87,6 +93,7 @@ class ContainerStorage(object):
                 _id = bson.objectid.ObjectId(_id)
             except bson.errors.InvalidId as e:
                 raise APIStorageException(e.message)
+        identitymap.discard(self.cont_name, _id)
         return self.dbc.delete_one({'_id':_id})
 
     def _get_el(self, _id, projection=None):
@@ -95,6 +102,8 @@ class ContainerStorage(object):
                 _id = bson.objectid.ObjectId(_id)
             except bson.errors.InvalidId as e:
                 raise APIStorageException(e.message)
+        if projection is None:
+            return identitymap.find_one(self.cont_name, _id)
         return self.dbc.find_one(_id, projection)
 
     def _get_all_el(self, query, user, public, projection):
@@ -114,6 +123,7 @@ class GroupStorage(ContainerStorage):
     def _create_el(self, payload):
         log.debug(payload)
         roles = payload.pop('roles')
+        identitymap.discard(self.cont_name, payload['_id'])
         return self.dbc.update_one(
             {'_id': payload['_id']},
             {
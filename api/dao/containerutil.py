@@ -1,7 +1,9 @@
+import copy
 import bson.objectid
 
 from .. import config
 from ..auth import INTEGER_ROLES
+from . import identitymap
 
 CONT_TYPES = ['acquisition', 'analysis', 'collection', 'group', 'project', 'session']
 
@@ -104,7 +106,7 @@ class ContainerReference(object):
         )
 
     def get(self):
-        result = config.db[self.type + 's'].find_one({'_id': bson.ObjectId(self.id)})
+        result = identitymap.find_one(self.type + 's', bson.ObjectId(self.id))
         if result is None:
             raise Exception("No such " + self.type + " " + self.id + " in database")
         return result
@@ -113,7 +115,8 @@ class ContainerReference(object):
         cont = self.get()
         for f in cont.get('files', []):
             if f['name'] == filename:
-                return f
+                # The container is shared for the rest of the request, so callers get their own copy
+                return copy.deepcopy(f)
         return None
 
     def check_access(self, userID, perm_name):
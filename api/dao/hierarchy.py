@@ -9,7 +9,7 @@ import re
 from .. import files
 from .. import util
 from .. import config
-from . import APIStorageException, containerutil
+from . import APIStorageException, containerutil, identitymap
 
 log = config.log
 
@@ -36,6 +36,7 @@ class TargetContainer(object):
         # update_set allows to update all the fileinfo like size, hash, etc.
         for k,v in fileinfo.iteritems():
             update_set['files.$.' + k] = v
+        identitymap.discard(self.level, self._id)
         return self.dbc.find_one_and_update(
             {'_id': self._id, 'files.name': fileinfo['name']},
             {'$set': update_set},
@@ -43,6 +44,7 @@ class TargetContainer(object):
         )
 
     def add_file(self, fileinfo):
+        identitymap.discard(self.level, self._id)
         return self.dbc.find_one_and_update(
             {'_id': self._id},
             {'$push': {'files': fileinfo}},
@@ -54,67 +56,73 @@ def get_container(cont_name, _id):
     cont_name += 's'
     _id = bson.ObjectId(_id)
 
-    return config.db[cont_name].find_one({
-        '_id': _id,
-    })
+    return identitymap.find_one(cont_name, _id)
 
 def propagate_changes(cont_name, _id, query, update):
     """
     Propagates changes down the heirarchy tree.
 
     cont_name and _id refer to top level container (which will not be modified here)
+    Every container carries the ids of its ancestors, so each level is a single indexed update.
     """
 
     if cont_name == 'groups':
-        project_ids = [p['_id'] for p in config.db.projects.find({'group': _id}, [])]
-        session_ids = [s['_id'] for s in config.db.sessions.find({'project': {'$in': project_ids}}, [])]
-
-        project_q = copy.deepcopy(query)
-        project_q['_id'] = {'$in': project_ids}
-        session_q = copy.deepcopy(query)
-        session_q['_id'] = {'$in': session_ids}
-        acquisition_q = copy.deepcopy(query)
-        acquisition_q['session'] = {'$in': session_ids}
-
-        config.db.projects.update_many(project_q, update)
-        config.db.sessions.update_many(session_q, update)
-        config.db.acquisitions.update_many(acquisition_q, update)
-
+        levels = ['projects', 'sessions', 'acquisitions']
+        ancestor_key = 'group'
     elif cont_name == 'projects':
-        session_ids = [s['_id'] for s in config.db.sessions.find({'project': _id}, [])]
-
-        session_q = copy.deepcopy(query)
-        session_q['project'] = _id
-        acquisition_q = copy.deepcopy(query)
-        acquisition_q['session'] = {'$in': session_ids}
-
-        config.db.sessions.update_many(session_q, update)
-        config.db.acquisitions.update_many(acquisition_q, update)
-
+        levels = ['sessions', 'acquisitions']
+        ancestor_key = 'project'
     elif cont_name == 'sessions':
-        query['sessions'] = _id
-        config.db.acquisitions.update_many(query, update)
+        levels = ['acquisitions']
+        ancestor_key = 'session'
     else:
         raise ValueError('changes can only be propagated from group, project or session level')
 
+    for level in levels:
+        q = copy.deepcopy(query)
+        q[ancestor_key] = _id
+        config.db[level].update_many(q, update)
+        identitymap.discard(level)
+
 def upsert_fileinfo(cont_name, _id, fileinfo):
+    return upsert_fileinfos(cont_name, _id, [fileinfo])
+
+def upsert_fileinfos(cont_name, _id, fileinfos):
+    """
+    Add or update several files on a container in a single round trip.
+    """
     # TODO: make all functions take singular noun
     cont_name += 's'
 
     # TODO: make all functions consume strings
     _id = bson.ObjectId(_id)
 
-    # OPPORTUNITY: could potentially be atomic if we pass a closure to perform the modification
-    result = config.db[cont_name].find_one({
-        '_id': _id,
-        'files.name': fileinfo['name'],
-    })
+    ops = []
+    for fileinfo in fileinfos:
+        ops += fileinfo_upsert_ops(_id, fileinfo)
+    identitymap.discard(cont_name, _id)
+    return config.db[cont_name].bulk_write(ops, ordered=True)
 
-    if result is None:
-        fileinfo['created'] = fileinfo['modified']
-        return add_fileinfo(cont_name, _id, fileinfo)
-    else:
-        return update_fileinfo(cont_name, _id, fileinfo)
+def fileinfo_upsert_ops(_id, fileinfo):
+    """
+    Return the write operations that add fileinfo to a container, or update its existing file of the same name.
+
+    The first only pushes when no file has the name and the second only matches when one does, so the
+    add-vs-update decision is made atomically by the database. Run them in order; after a push the
+    second rewrites the same values.
+    """
+    new_fileinfo = dict(fileinfo)
+    new_fileinfo.setdefault('created', fileinfo['modified'])
+
+    update_set = {'files.$.modified': datetime.datetime.utcnow()}
+    # update_set allows to update all the fileinfo like size, hash, etc.
+    for k,v in fileinfo.iteritems():
+        update_set['files.$.' + k] = v
+
+    return [
+        pymongo.UpdateOne({'_id': _id, 'files.name': {'$ne': fileinfo['name']}}, {'$push': {'files': new_fileinfo}}),
+        pymongo.UpdateOne({'_id': _id, 'files.name': fileinfo['name']}, {'$set': update_set}),
+    ]
 
 def update_fileinfo(cont_name, _id, fileinfo):
     update_set = {'files.$.modified': datetime.datetime.utcnow()}
@@ -122,6 +130,7 @@ def update_fileinfo(cont_name, _id, fileinfo):
     # update_set allows to update all the fileinfo like size, hash, etc.
     for k,v in fileinfo.iteritems():
         update_set['files.$.' + k] = v
+    identitymap.discard(cont_name, _id)
     return config.db[cont_name].find_one_and_update(
         {'_id': _id, 'files.name': fileinfo['name']},
         {'$set': update_set},
@@ -129,6 +138,7 @@ def update_fileinfo(cont_name, _id, fileinfo):
     )
 
 def add_fileinfo(cont_name, _id, fileinfo):
+    identitymap.discard(cont_name, _id)
     return config.db[cont_name].find_one_and_update(
         {'_id': _id},
         {'$push': {'files': fileinfo}},
@@ -150,6 +160,7 @@ def _group_id_fuzzy_match(group_id, project_label):
 def _find_or_create_destination_project(group_id, project_label, timestamp):
     group_id, project_label = _group_id_fuzzy_match(group_id, project_label)
     group = config.db.groups.find_one({'_id': group_id})
+    identitymap.discard('projects')
     project = config.db.projects.find_one_and_update(
         {'group': group['_id'],
          'label': {'$regex': re.escape(project_label), '$options': 'i'}
@@ -211,6 +222,7 @@ def _upsert_session(session, project_obj, type_, timestamp):
         ),
         '$set': session
     }
+    identitymap.discard('sessions')
     session_obj = config.db.sessions.find_one_and_update(
         _create_session_query(session, project_obj, type_),
         session_operations,
@@ -225,18 +237,22 @@ def _upsert_acquisition(acquisition, session_obj, type_, timestamp):
         session_operations = {'$min': dict(timestamp=acquisition['timestamp'])}
         if acquisition.get('timezone'):
             session_operations['$set'] = {'timezone': acquisition['timezone']}
+        identitymap.discard('sessions', session_obj['_id'])
         config.db.sessions.update_one({'_id': session_obj['_id']}, session_operations)
 
     acquisition['modified'] = timestamp
     acq_operations = {
         '$setOnInsert': dict(
             session=session_obj['_id'],
+            project=session_obj['project'],
+            group=session_obj['group'],
             permissions=session_obj['permissions'],
             public=session_obj.get('public', False),
             created=timestamp
         ),
         '$set': acquisition
     }
+    identitymap.discard('acquisitions')
     acquisition_obj = config.db.acquisitions.find_one_and_update(
         _create_acquisition_query(acquisition, session_obj, type_),
         acq_operations,
@@ -331,6 +347,7 @@ def update_container_hierarchy(metadata, acquisition_id, level):
     if acquisition_obj is None:
         raise APIStorageException('acquisition doesn''t exist')
     if acquisition.get('timestamp'):
+        identitymap.discard('sessions', acquisition_obj['session'])
         session_obj = config.db.sessions.find_one_and_update(
             {'_id': acquisition_obj['session']},
             {
@@ -339,6 +356,7 @@ def update_container_hierarchy(metadata, acquisition_id, level):
             },
             return_document=pymongo.collection.ReturnDocument.AFTER
         )
+        identitymap.discard('projects', session_obj['project'])
         config.db.projects.find_one_and_update(
             {'_id': session_obj['project']},
             {
@@ -358,6 +376,7 @@ def update_container_hierarchy(metadata, acquisition_id, level):
     return acquisition_obj
 
 def _update_container(query, update, cont_name):
+    identitymap.discard(cont_name)
     return config.db[cont_name].find_one_and_update(
         query,
         {
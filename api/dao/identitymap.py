@@ -0,0 +1,77 @@
+"""
+Request-scoped identity map of containers.
+
+A single request often loads the same container several times: the handler loads it to check permissions, a
+consistency check loads the parent again, ContainerReference.get() reloads it for every file it resolves. While a
+request is active (see RequestHandler.dispatch), find_one() returns the document already loaded for that request
+instead of querying again, so each container is fetched at most once.
+
+Documents are shared between everyone that loads them during the request; treat them as read-only until
+the request is done with them. Writes made through the dao layer discard the documents they touch.
+Maps are per thread, and code running outside a request always reads straight from the database.
+"""
+
+import threading
+
+from .. import config
+
+log = config.log
+
+_local = threading.local()
+
+
+class IdentityMap(object):
+    def __init__(self):
+        self.docs = {} # (collection name, _id) -> document, or None if it did not exist
+        self.loads = 0 # documents fetched from the database
+        self.hits = 0  # documents served from the map
+
+
+def begin():
+    """
+    Start an identity map for the current thread's request, replacing any previous one.
+    """
+    _local.map = IdentityMap()
+    return _local.map
+
+def end():
+    """
+    Drop the current thread's identity map, returning it for its counters.
+    """
+    identity_map = current()
+    _local.map = None
+    return identity_map
+
+def current():
+    return getattr(_local, 'map', None)
+
+def find_one(cont_name, _id):
+    """
+    Return the document with _id from the cont_name collection, or None if it does not exist.
+    """
+    identity_map = current()
+    if identity_map is None:
+        return config.db[cont_name].find_one({'_id': _id})
+
+    key = (cont_name, _id)
+    if key in identity_map.docs:
+        identity_map.hits += 1
+        return identity_map.docs[key]
+
+    doc = config.db[cont_name].find_one({'_id': _id})
+    identity_map.loads += 1
+    identity_map.docs[key] = doc
+    return doc
+
+def discard(cont_name, _id=None):
+    """
+    Forget a document after it has been written, or every document of a collection if no _id is given.
+    """
+    identity_map = current()
+    if identity_map is None:
+        return
+    if _id is None:
+        for key in [k for k in identity_map.docs if k[0] == cont_name]:
+            del identity_map.docs[key]
+    else:
+        identity_map.docs.pop((cont_name, _id), None)
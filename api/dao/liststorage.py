@@ -2,7 +2,7 @@ import bson.errors
 import bson.objectid
 
 from .. import config
-from . import consistencychecker, containerutil
+from . import consistencychecker, containerutil, identitymap
 from . import APIStorageException, APIConflictException
 
 log = config.log
@@ -32,13 +32,13 @@ class ListStorage(object):
         """
         if self.use_object_id:
             _id = bson.objectid.ObjectId(_id)
-        query = {'_id': _id}
-        projection = None
-        if query_params:
-            query[self.list_name] = {
-                '$elemMatch': query_params
-            }
-            projection = {self.list_name + '.$': 1, 'permissions': 1, 'public': 1}
+        if not query_params:
+            return identitymap.find_one(self.cont_name, _id)
+        query = {
+            '_id': _id,
+            self.list_name: {'$elemMatch': query_params}
+        }
+        projection = {self.list_name + '.$': 1, 'permissions': 1, 'public': 1}
         log.debug('query {}'.format(query))
         return self.dbc.find_one(query, projection)
 
@@ -72,6 +72,7 @@ class ListStorage(object):
         update = {'$push': {self.list_name: payload} }
         log.debug('query {}'.format(query))
         log.debug('update {}'.format(update))
+        identitymap.discard(self.cont_name, _id)
         result = self.dbc.update_one(query, update)
         if result.matched_count < 1:
             raise APIConflictException('Item already exists in list.')
@@ -96,6 +97,7 @@ class ListStorage(object):
         }
         log.debug('query {}'.format(query))
         log.debug('update {}'.format(update))
+        identitymap.discard(self.cont_name, _id)
         return self.dbc.update_one(query, update)
 
     def _delete_el(self, _id, query_params):
@@ -104,6 +106,7 @@ class ListStorage(object):
         update = {'$pull': {self.list_name: query_params} }
         log.debug('query {}'.format(query))
         log.debug('update {}'.format(update))
+        identitymap.discard(self.cont_name, _id)
         return self.dbc.update_one(query, update)
 
     def _get_el(self, _id, query_params):
@@ -131,9 +134,7 @@ class StringListStorage(ListStorage):
                 _id = bson.objectid.ObjectId(_id)
             except bson.errors.InvalidId as e:
                 raise APIStorageException(e.message)
-        query = {'_id': _id}
-        projection = {self.list_name : 1, 'permissions': 1, 'public': 1, 'roles': 1}
-        return self.dbc.find_one(query, projection)
+        return identitymap.find_one(self.cont_name, _id)
 
     def exec_op(self, action, _id=None, query_params=None, payload=None, exclude_params=None):
         """
@@ -153,6 +154,7 @@ class StringListStorage(ListStorage):
         update = {'$push': {self.list_name: payload}}
         log.debug('query {}'.format(query))
         log.debug('update {}'.format(update))
+        identitymap.discard(self.cont_name, _id)
         result = self.dbc.update_one(query, update)
         if result.matched_count < 1:
             raise APIConflictException('Item already exists in list.')
@@ -171,6 +173,7 @@ class StringListStorage(ListStorage):
         update = {'$set': {self.list_name + '.$': payload}}
         log.debug('query {}'.format(query))
         log.debug('update {}'.format(update))
+        identitymap.discard(self.cont_name, _id)
         return self.dbc.update_one(query, update)
 
     def _get_el(self, _id, query_params):
@@ -213,6 +216,7 @@ class AnalysesStorage(ListStorage):
                 'analyses.$.notes': payload
             }
         }
+        identitymap.discard(self.cont_name, _id)
         return self.dbc.update_one(query, update)
 
     def delete_note(self, _id, analysis_id, note_id):
@@ -228,4 +232,5 @@ class AnalysesStorage(ListStorage):
                 }
             }
         }
+        identitymap.discard(self.cont_name, _id)
         return self.dbc.update_one(query, update)
@@ -1,19 +1,48 @@
+import os
 import bson
+import time
 import json
 import pytz
+import ctypes
 import os.path
 import tarfile
 import datetime
 import cStringIO
+import ctypes.util
+import itertools
+import collections
+import multiprocessing.pool
 
 from . import base
+from . import encoder
 from . import validators
 
 from . import util
 from . import config
+from . import metrics
+from .dao import APIStorageException
 
 log = config.log
 
+# Download preflight checks the CAS for this many files at a time, in parallel
+EXISTS_CHECK_BATCH = 1000
+EXISTS_CHECK_THREADS = 16
+
+# Files between the running totals reported by the download preflight
+PREFLIGHT_PROGRESS_INTERVAL = 10000
+
+# Number of files archivestream opens and starts reading ahead of the one being sent
+PREFETCH_FILES = 8
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _posix_fadvise = getattr(_libc, 'posix_fadvise64', None) or _libc.posix_fadvise
+    _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+except (OSError, AttributeError, TypeError):
+    _posix_fadvise = None
+
 
 def _filter_check(property_filter, property_values):
     minus = set(property_filter.get('-', []))
@@ -25,8 +54,14 @@ def _filter_check(property_filter, property_values):
     return True
 
 
-def _append_targets(targets, container, prefix, total_size, total_cnt, optional, data_path, filters):
+def _file_targets(container, prefix, optional, data_path, filters, snapshot=None):
+    """
+    Yield a (filepath, arcpath, size) candidate for each of the container's files that passes the filters.
+    Files created after snapshot, if given, are skipped.
+    """
     for f in container.get('files', []):
+        if snapshot and f.get('created') and f['created'] > snapshot:
+            continue
         if filters:
             filtered = True
             for filter_ in filters:
@@ -41,14 +76,281 @@ def _append_targets(targets, container, prefix, total_size, total_cnt, optional,
                 continue
         if optional or not f.get('optional', False):
             filepath = os.path.join(data_path, util.path_from_hash(f['hash']))
-            if os.path.exists(filepath): # silently skip missing files
-                targets.append((filepath, prefix + '/' + f['name'], f['size']))
-                total_size += f['size']
-                total_cnt += 1
-    return total_size, total_cnt
-
-def symlinkarchivestream(ticket, data_path):
-    for filepath, arcpath, _ in ticket['target']:
+            yield filepath, prefix + '/' + f['name'], f['size']
+
+def _path_from_container(container, used_subpaths, parent_id):
+    """
+    Return a unique archive path segment for container among its siblings under parent_id.
+
+    used_subpaths maps parent_id -> {path: next numeric suffix to try}, so that finding a free name
+    for the n-th container with the same label doesn't rescan the n-1 before it.
+    """
+    path = None
+    if not path and container.get('label'):
+        path = container['label']
+    if not path and container.get('timestamp'):
+        timezone = container.get('timezone')
+        if timezone:
+            path = pytz.timezone('UTC').localize(container['timestamp']).astimezone(pytz.timezone(timezone)).strftime('%Y%m%d_%H%M')
+        else:
+            path = container['timestamp'].strftime('%Y%m%d_%H%M')
+    if not path and container.get('uid'):
+        path = container['uid']
+    if not path:
+        path = 'untitled'
+
+    used = used_subpaths.setdefault(parent_id, {})
+    if path in used:
+        i = used[path]
+        while path + '_' + str(i) in used:
+            i += 1
+        used[path] = i + 1
+        path = path + '_' + str(i)
+    used[path] = 0
+    return path
+
+def _find_by_id(collection, ids, fields):
+    if not ids:
+        return {}
+    return {c['_id']: c for c in config.db[collection].find({'_id': {'$in': list(ids)}}, fields)}
+
+def _group_by(containers, key):
+    grouped = collections.defaultdict(list)
+    for c in containers:
+        grouped[c[key]].append(c)
+    return grouped
+
+def _resolve_nodes(nodes):
+    """
+    Yield (container, archive prefix) for every container covered by the requested nodes, in archive order.
+
+    Everything is fetched up front with one $in query per level, rather than queries per node.
+    """
+    PROJECT_FIELDS = ['group', 'label', 'files']
+    SESSION_FIELDS = ['project', 'label', 'files', 'uid', 'timestamp', 'timezone']
+    ACQUISITION_FIELDS = ['session', 'label', 'files', 'uid', 'timestamp', 'timezone']
+
+    nodes = [(item['level'], bson.ObjectId(item['_id'])) for item in nodes]
+    requested = collections.defaultdict(set)
+    for level, _id in nodes:
+        requested[level].add(_id)
+
+    acquisitions = _find_by_id('acquisitions', requested['acquisition'], ACQUISITION_FIELDS)
+
+    session_query = {'$or': [
+        {'project': {'$in': list(requested['project'])}},
+        {'_id': {'$in': list(requested['session'] | set(a['session'] for a in acquisitions.itervalues()))}},
+    ]}
+    session_list = list(config.db.sessions.find(session_query, SESSION_FIELDS))
+    sessions = {s['_id']: s for s in session_list}
+    sessions_by_project = _group_by(session_list, 'project')
+
+    projects = _find_by_id('projects', requested['project'] | set(s['project'] for s in sessions.itervalues()), PROJECT_FIELDS)
+
+    parent_sessions = requested['session'] | set(s['_id'] for s in sessions.itervalues() if s['project'] in requested['project'])
+    child_acquisitions = []
+    if parent_sessions:
+        child_acquisitions = config.db.acquisitions.find({'session': {'$in': list(parent_sessions)}}, ACQUISITION_FIELDS)
+    acquisitions_by_session = _group_by(child_acquisitions, 'session')
+
+    def get(containers, level, _id):
+        container = containers.get(_id)
+        if container is None:
+            raise APIStorageException('no such {} {}'.format(level, _id))
+        return container
+
+    arc_prefix = 'sdm'
+    used_subpaths = {}
+    for level, _id in nodes:
+        if level == 'project':
+            project = get(projects, level, _id)
+            prefix = '/'.join([arc_prefix, project['group'], project['label']])
+            yield project, prefix
+            session_prefixes = {}
+            for session in sessions_by_project[_id]:
+                session_prefixes[session['_id']] = prefix + '/' + _path_from_container(session, used_subpaths, _id)
+                yield session, session_prefixes[session['_id']]
+            for session in sessions_by_project[_id]:
+                for acq in acquisitions_by_session[session['_id']]:
+                    yield acq, session_prefixes[session['_id']] + '/' + _path_from_container(acq, used_subpaths, session['_id'])
+        elif level == 'session':
+            session = get(sessions, level, _id)
+            project = get(projects, 'project', session['project'])
+            prefix = project['group'] + '/' + project['label'] + '/' + _path_from_container(session, used_subpaths, project['_id'])
+            yield session, prefix
+            for acq in acquisitions_by_session[_id]:
+                yield acq, prefix + '/' + _path_from_container(acq, used_subpaths, _id)
+        elif level == 'acquisition':
+            acq = get(acquisitions, level, _id)
+            session = get(sessions, 'session', acq['session'])
+            project = get(projects, 'project', session['project'])
+            prefix = project['group'] + '/' + project['label'] + '/' + _path_from_container(session, used_subpaths, project['_id']) + '/' + _path_from_container(acq, used_subpaths, session['_id'])
+            yield acq, prefix
+
+def existing_targets(targets):
+    """
+    Filter out targets whose file is missing from the CAS, checking a batch of files at a time in parallel.
+    """
+    pool = multiprocessing.pool.ThreadPool(EXISTS_CHECK_THREADS)
+    try:
+        while True:
+            batch = list(itertools.islice(targets, EXISTS_CHECK_BATCH))
+            if not batch:
+                return
+            filepaths = list(set(filepath for filepath, _, _ in batch))
+            exists = dict(zip(filepaths, pool.map(os.path.exists, filepaths)))
+            for target in batch:
+                if exists[target[0]]: # silently skip missing files
+                    yield target
+    finally:
+        pool.terminate()
+
+def resolve_targets(req_spec, data_path, snapshot=None):
+    """
+    Yield the (filepath, arcpath, size) of every file in a download request, in archive order.
+
+    Given the snapshot time of an earlier resolution, files added since are left out, so a batch
+    ticket's targets can be regenerated from its manifest instead of being stored.
+
+    Containers are resolved right away, raising APIStorageException if a node does not exist;
+    only the files are generated lazily.
+    """
+    optional = req_spec['optional']
+    filters = req_spec.get('filters')
+    containers = list(_resolve_nodes(req_spec['nodes']))
+    candidates = (
+        target
+        for container, prefix in containers
+        for target in _file_targets(container, prefix, optional, data_path, filters, snapshot)
+    )
+    return existing_targets(candidates)
+
+def parse_range(header, size):
+    """
+    Parse a Range header against a resource of the given size.
+
+    Only single byte ranges are supported. Returns an inclusive (start, end) pair; None if the whole
+    resource should be sent instead (no header, unparsable, or several ranges); or False if the range
+    cannot be satisfied.
+    """
+
+    if not header or not header.startswith('bytes='):
+        return None
+    spec = header[len('bytes='):].strip()
+    if ',' in spec:
+        return None
+    first, sep, last = spec.partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0 or size == 0:
+                # An empty resource has no bytes to satisfy any range with
+                return False
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if last and start > end:
+        return None
+    if start >= size:
+        return False
+    return start, min(end, size - 1)
+
+def _etag_matches(header, etag):
+    return header.strip() == '*' or etag in [t.strip() for t in header.split(',')]
+
+def _iter_range(fd, start, length):
+    CHUNKSIZE = 2**20
+    try:
+        fd.seek(start)
+        while length > 0:
+            chunk = fd.read(min(CHUNKSIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fd.close()
+
+def send_content(request, response, size, etag, read_range, read_all=None, ranges=True):
+    """
+    Set up response to serve some content, honouring conditional and single Range requests.
+
+    read_range(start, length) returns an iterable over that slice of the content. read_all(), if given,
+    is used instead for whole-content responses. If ranges is False, Range headers are ignored.
+    """
+
+    response.headers['ETag'] = etag
+    response.headers['Accept-Ranges'] = 'bytes' if ranges else 'none'
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and _etag_matches(if_none_match, etag):
+        response.status = 304
+        return
+
+    byte_range = parse_range(request.headers.get('Range'), size) if ranges else None
+    if_range = request.headers.get('If-Range')
+    if byte_range is not None and if_range and if_range.strip() != etag:
+        # The client's copy is stale (or identified by date, which we can't check); send the whole file
+        byte_range = None
+
+    if byte_range is False:
+        response.status = 416
+        response.headers['Content-Range'] = 'bytes */%d' % size
+        return
+
+    if byte_range is None:
+        if read_all:
+            # Left unwrapped, so that a wsgi.file_wrapper can still be served with sendfile; counted up front instead
+            response.app_iter = read_all()
+            metrics.DOWNLOADED_BYTES.inc(size)
+        else:
+            response.app_iter = metrics.counted(read_range(0, size), metrics.DOWNLOADED_BYTES)
+        response.headers['Content-Length'] = str(size) # must be set after setting app_iter
+    else:
+        start, end = byte_range
+        response.status = 206
+        response.app_iter = metrics.counted(read_range(start, end - start + 1), metrics.DOWNLOADED_BYTES)
+        response.headers['Content-Length'] = str(end - start + 1)
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+def send_file(request, response, filepath, size, hash_):
+    """
+    Set up response to serve the file at filepath; see send_content.
+
+    The ETag is derived from the file's CAS hash, so it is stable across containers and sites.
+    Whole-file responses go through the server's wsgi.file_wrapper when it has one, which lets uwsgi
+    use sendfile. The caller sets Content-Type and Content-Disposition.
+    """
+
+    def read_all():
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            return file_wrapper(open(filepath, 'rb'), 2**20)
+        return read_range(0, size)
+
+    def read_range(start, length):
+        return _iter_range(open(filepath, 'rb'), start, length)
+
+    send_content(request, response, size, '"' + hash_ + '"', read_range, read_all)
+
+def ticket_targets(ticket, data_path):
+    """
+    Lazily regenerate the targets of a batch download ticket from its manifest.
+    Raises APIStorageException, before anything is streamed, if a requested container was deleted since.
+    """
+    manifest = ticket['target']
+    if isinstance(manifest, list):
+        # Tickets issued before manifests carried the target list itself
+        return manifest
+    return resolve_targets(manifest['request'], data_path, manifest['snapshot'])
+
+def symlinkarchivestream(targets, data_path):
+    for filepath, arcpath, _ in targets:
         t = tarfile.TarInfo(name=arcpath)
         t.type = tarfile.SYMTYPE
         t.linkname = os.path.relpath(filepath, data_path)
@@ -59,18 +361,79 @@ def symlinkarchivestream(ticket, data_path):
     yield stream.getvalue() # get tar stream trailer
     stream.close()
 
-def archivestream(ticket):
-    BLOCKSIZE = 512
+def _fadvise_sequential(fd):
+    """
+    Hint to the kernel that fd will be read front to back, starting now. A no-op where unsupported.
+    """
+    if _posix_fadvise is not None:
+        _posix_fadvise(fd.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+        _posix_fadvise(fd.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+
+def _open_target(filepath, head_size):
+    """
+    Open a file and read its first head_size bytes. Run on a prefetch thread so that the open, stat
+    and first read latency of the next few files overlaps with streaming the current one.
+    """
+    fd = open(filepath, 'rb')
+    try:
+        _fadvise_sequential(fd)
+        os.fstat(fd.fileno()) # warm the attribute cache for gettarinfo
+        return fd, fd.read(head_size)
+    except:
+        fd.close()
+        raise
+
+def _prefetched_targets(targets, prefetch, head_size):
+    """
+    Yield (filepath, arcpath, fd, head) for each target in order, opening up to `prefetch` files ahead.
+    Memory use is bounded by prefetch * head_size. The caller owns and must close each fd.
+    """
+    if not prefetch:
+        for filepath, arcpath, _ in targets:
+            fd, head = _open_target(filepath, head_size)
+            yield filepath, arcpath, fd, head
+        return
+
+    pool = multiprocessing.pool.ThreadPool(prefetch)
+    window = collections.deque()
+    targets = iter(targets)
+    try:
+        while True:
+            while len(window) < prefetch:
+                target = next(targets, None)
+                if target is None:
+                    break
+                window.append((target, pool.apply_async(_open_target, (target[0], head_size))))
+            if not window:
+                return
+            (filepath, arcpath, _), result = window.popleft()
+            fd, head = result.get()
+            yield filepath, arcpath, fd, head
+    finally:
+        # Close anything opened ahead if the client went away mid-stream
+        pool.close()
+        for _, result in window:
+            try:
+                result.get()[0].close()
+            except Exception: # pylint: disable=broad-except
+                pass
+        pool.join()
+
+def archivestream(targets, prefetch=PREFETCH_FILES):
+    BLOCKSIZE = tarfile.BLOCKSIZE
     CHUNKSIZE = 2**20  # stream files in 1MB chunks
     stream = cStringIO.StringIO()
     with tarfile.open(mode='w|', fileobj=stream) as archive:
-        for filepath, arcpath, _ in ticket['target']:
-            yield archive.gettarinfo(filepath, arcpath).tobuf()
-            with open(filepath, 'rb') as fd:
-                for chunk in iter(lambda: fd.read(CHUNKSIZE), ''):
+        for filepath, arcpath, fd, chunk in _prefetched_targets(targets, prefetch, CHUNKSIZE):
+            with fd:
+                yield archive.gettarinfo(filepath, arcpath, fd).tobuf()
+                size = 0
+                while chunk:
+                    size += len(chunk)
                     yield chunk
-                if len(chunk) % BLOCKSIZE != 0:
-                    yield (BLOCKSIZE - (len(chunk) % BLOCKSIZE)) * b'\0'
+                    chunk = fd.read(CHUNKSIZE)
+                if size % BLOCKSIZE != 0:
+                    yield (BLOCKSIZE - (size % BLOCKSIZE)) * b'\0'
     yield stream.getvalue() # get tar stream trailer
     stream.close()
 
@@ -78,78 +441,47 @@ class Download(base.RequestHandler):
 
     def _preflight_archivestream(self, req_spec):
         data_path = config.get_item('persistent', 'data_path')
-        arc_prefix = 'sdm'
+        # FIXME: check permissions of everything
+        snapshot = datetime.datetime.utcnow()
+        try:
+            targets = resolve_targets(req_spec, data_path)
+        except APIStorageException as e:
+            self.abort(404, str(e))
+
+        if self.is_true('sse'):
+            self.response.headers['Content-Type'] = 'text/event-stream; charset=utf-8'
+            self.response.headers['Cache-Control'] = 'no-cache'
+            self.response.app_iter = (
+                encoder.json_sse_pack({'event': event, 'data': data})
+                for event, data in self._preflight(req_spec, snapshot, targets)
+            )
+            return None
+
+        for _, data in self._preflight(req_spec, snapshot, targets):
+            pass
+        return data
+
+    def _preflight(self, req_spec, snapshot, targets):
+        """
+        Yield ('progress', running totals) every PREFLIGHT_PROGRESS_INTERVAL files, then create the ticket
+        and yield ('result', ticket and totals).
+        """
+        start = time.time()
         file_cnt = 0
         total_size = 0
-        targets = []
-        # FIXME: check permissions of everything
-        used_subpaths = {}
-        for item in req_spec['nodes']:
-            item_id = bson.ObjectId(item['_id'])
-            if item['level'] == 'project':
-                project = config.db.projects.find_one({'_id': item_id}, ['group', 'label', 'files'])
-                prefix = '/'.join([arc_prefix, project['group'], project['label']])
-                total_size, file_cnt = _append_targets(targets, project, prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-                sessions = config.db.sessions.find({'project': item_id}, ['label', 'files', 'uid', 'timestamp', 'timezone'])
-                session_dict = {session['_id']: session for session in sessions}
-                acquisitions = config.db.acquisitions.find({'session': {'$in': session_dict.keys()}}, ['label', 'files', 'session', 'uid', 'timestamp', 'timezone'])
-                session_prefixes = {}
-                for session in session_dict.itervalues():
-                    session_prefix = prefix + '/' + self._path_from_container(session, used_subpaths, project['_id'])
-                    session_prefixes[session['_id']] = session_prefix
-                    total_size, file_cnt = _append_targets(targets, session, session_prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-                for acq in acquisitions:
-                    session = session_dict[acq['session']]
-                    acq_prefix = session_prefixes[session['_id']] + '/' + self._path_from_container(acq, used_subpaths, session['_id'])
-                    total_size, file_cnt = _append_targets(targets, acq, acq_prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-            elif item['level'] == 'session':
-                session = config.db.sessions.find_one({'_id': item_id}, ['project', 'label', 'files', 'uid', 'timestamp', 'timezone'])
-                project = config.db.projects.find_one({'_id': session['project']}, ['group', 'label'])
-                prefix = project['group'] + '/' + project['label'] + '/' + self._path_from_container(session, used_subpaths, project['_id'])
-                total_size, file_cnt = _append_targets(targets, session, prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-                acquisitions = config.db.acquisitions.find({'session': item_id}, ['label', 'files', 'uid', 'timestamp', 'timezone'])
-                for acq in acquisitions:
-                    acq_prefix = prefix + '/' + self._path_from_container(acq, used_subpaths, session['_id'])
-                    total_size, file_cnt = _append_targets(targets, acq, acq_prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-            elif item['level'] == 'acquisition':
-                acq = config.db.acquisitions.find_one({'_id': item_id}, ['session', 'label', 'files', 'uid', 'timestamp', 'timezone'])
-                session = config.db.sessions.find_one({'_id': acq['session']}, ['project', 'label', 'uid', 'timestamp', 'timezone'])
-                project = config.db.projects.find_one({'_id': session['project']}, ['group', 'label'])
-                prefix = project['group'] + '/' + project['label'] + '/' + self._path_from_container(session, used_subpaths, project['_id']) + '/' + self._path_from_container(acq, used_subpaths, session['_id'])
-                total_size, file_cnt = _append_targets(targets, acq, prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-        log.debug(json.dumps(targets, sort_keys=True, indent=4, separators=(',', ': ')))
+        for target in targets:
+            file_cnt += 1
+            total_size += target[2]
+            if file_cnt % PREFLIGHT_PROGRESS_INTERVAL == 0:
+                log.debug('Download preflight: {} files, {} so far'.format(file_cnt, util.hrsize(total_size)))
+                yield 'progress', {'file_cnt': file_cnt, 'size': total_size}
+        log.info('Download preflight: {} files, {} in {:.1f}s'.format(file_cnt, util.hrsize(total_size), time.time() - start))
         filename = 'sdm_' + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + '.tar'
-        ticket = util.download_ticket(self.request.client_addr, 'batch', targets, filename, total_size)
+        # Store how to regenerate the targets rather than the targets themselves, which can approach the BSON size limit
+        manifest = {'request': req_spec, 'snapshot': snapshot}
+        ticket = util.download_ticket(self.request.client_addr, 'batch', manifest, filename, total_size)
         config.db.downloads.insert_one(ticket)
-        return {'ticket': ticket['_id'], 'file_cnt': file_cnt, 'size': total_size}
-
-    def _path_from_container(self, container, used_subpaths, parent_id):
-        def _find_new_path(path, list_used_subpaths):
-            """from the input path finds a path that hasn't been used"""
-            if path not in list_used_subpaths:
-                return path
-            i = 0
-            while True:
-                modified_path = path + '_' + str(i)
-                if modified_path not in list_used_subpaths:
-                    return modified_path
-                i += 1
-        path = None
-        if not path and container.get('label'):
-            path = container['label']
-        if not path and container.get('timestamp'):
-            timezone = container.get('timezone')
-            if timezone:
-                path = pytz.timezone('UTC').localize(container['timestamp']).astimezone(pytz.timezone(timezone)).strftime('%Y%m%d_%H%M')
-            else:
-                path = container['timestamp'].strftime('%Y%m%d_%H%M')
-        if not path and container.get('uid'):
-            path = container['uid']
-        if not path:
-            path = 'untitled'
-        path = _find_new_path(path, used_subpaths.get(parent_id, []))
-        used_subpaths[parent_id] = used_subpaths.get(parent_id, []) + [path]
-        return path
+        yield 'result', {'ticket': ticket['_id'], 'file_cnt': file_cnt, 'size': total_size}
 
     def download(self):
         """
@@ -165,6 +497,9 @@ class Download(base.RequestHandler):
 
             Download POST Description...
 
+            :query sse: if true, respond with Server-Sent Events: "progress" events with the running file_cnt
+                and size every 10000 files, then a "result" event with the usual response
+
             :statuscode 400: describe me
             :statuscode 404: describe me
         """
@@ -205,10 +540,18 @@ class Download(base.RequestHandler):
                 self.abort(404, 'no such ticket')
             if ticket['ip'] != self.request.client_addr:
                 self.abort(400, 'ticket not for this source IP')
+            if ticket.get('type') != 'batch' or (isinstance(ticket['target'], dict) and 'request' not in ticket['target']):
+                self.abort(400, 'ticket not for this resource')
+            data_path = config.get_item('persistent', 'data_path')
+            try:
+                targets = ticket_targets(ticket, data_path)
+            except APIStorageException as e:
+                # Deleted between preflight and now; must fail here, before the response is under way
+                self.abort(404, str(e))
             if self.get_param('symlinks'):
-                self.response.app_iter = symlinkarchivestream(ticket, config.get_item('persistent', 'data_path'))
+                self.response.app_iter = metrics.counted(symlinkarchivestream(targets, data_path), metrics.DOWNLOADED_BYTES)
             else:
-                self.response.app_iter = archivestream(ticket)
+                self.response.app_iter = metrics.counted(archivestream(targets), metrics.DOWNLOADED_BYTES)
             self.response.headers['Content-Type'] = 'application/octet-stream'
             self.response.headers['Content-Disposition'] = 'attachment; filename=' + str(ticket['filename'])
             for project_id in ticket['projects']:
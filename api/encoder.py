@@ -43,3 +43,28 @@ def json_sse_pack(d):
     d['data'] = json.dumps(d['data'], default=custom_json_serializer)
 
     return sse_pack(d)
+
+def json_list_stream(iterable, chunk_size=2**16):
+    """
+    Lazily JSON-encode an iterable as a list, yielding chunks of about chunk_size bytes.
+    Memory use is flat no matter how many items there are, eg. when serving a large cursor.
+    """
+
+    buffer = ['[']
+    size = 1
+    separator = ''
+
+    for item in iterable:
+        encoded = json.dumps(item, default=custom_json_serializer)
+        buffer.append(separator)
+        buffer.append(encoded)
+        separator = ','
+        size += len(encoded) + 1
+
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+
+    buffer.append(']')
+    yield ''.join(buffer)
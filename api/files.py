@@ -3,14 +3,25 @@ import cgi
 import json
 import shutil
 import hashlib
+import zlib
+import time
+import Queue
 import zipfile
 import datetime
+import cStringIO
+import threading
 import collections
 
 from . import util
 from . import config
+from . import metrics
 from . import tempdir as tempfile
 
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
 log = config.log
 
 DEFAULT_HASH_ALG='sha384'
@@ -38,78 +49,395 @@ def move_form_file_field_into_cas(file_field):
 def hash_file_formatted(path, hash_alg=None):
     """
     Return the scitran-formatted hash of a file, specified by path.
-
-    REVIEW: if there's an intelligent io-copy in python stdlib, I missed it. This uses an arbitrary buffer size :/
     """
 
     hash_alg = hash_alg or DEFAULT_HASH_ALG
-    hasher = hashlib.new(hash_alg)
+    return util.format_hash(hash_alg, hash_file(path, [hash_alg])[hash_alg])
+
+def hash_file(path, algs):
+    """
+    Return a map of algorithm -> hex digest for a file, computing every digest in a single read.
+    """
+
+    digests = [(alg, new_digest(alg)) for alg in algs]
 
-    BUF_SIZE = 65536
+    BUF_SIZE = 2**20
 
     with open(path, 'rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            hasher.update(data)
+        for data in iter(lambda: f.read(BUF_SIZE), ''):
+            for _, digest in digests:
+                digest.update(data)
 
-    return util.format_hash(hash_alg, hasher.hexdigest())
+    return {alg: digest.hexdigest() for alg, digest in digests}
 
 
 class FileStoreException(Exception):
     pass
 
+
+class CRC32(object):
+    """
+    hashlib-style wrapper around a running CRC; crc32 comes from zlib, crc32c from the optional crc32c package.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.value = 0
+
+    def update(self, data):
+        self.value = self.func(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+def new_digest(alg):
+    """
+    Return a hashlib-style object for a digest algorithm name: anything hashlib supports, crc32 or crc32c.
+    """
+
+    if alg == 'crc32':
+        return CRC32(zlib.crc32)
+    elif alg == 'crc32c' and crc32c is not None:
+        return CRC32(getattr(crc32c, 'crc32c', None) or crc32c.crc32)
+    try:
+        return hashlib.new(alg)
+    except ValueError:
+        raise FileStoreException('Unsupported digest algorithm ' + alg)
+
+
+class DigestWorker(object):
+    """
+    Computes one or more digests of a stream of writes on a background thread.
+
+    Writes are coalesced into buffers of BUFFER_SIZE and handed over through a bounded queue, so the
+    hashing overlaps the caller's disk writes (hashlib and zlib release the GIL on large buffers)
+    while a slow hash still applies backpressure. Streams shorter than one buffer never start a thread.
+    The thread runs until hexdigests() or abort() is called; call one of them on every worker.
+    """
+
+    BUFFER_SIZE = 2**20
+    QUEUE_SIZE = 8
+
+    def __init__(self, algs):
+        self.digests = [(alg, new_digest(alg)) for alg in algs]
+        self._pending = []
+        self._pending_size = 0
+        self._queue = None
+        self._thread = None
+        self._hexdigests = None
+        self._size = 0
+        self._hash_time = 0.0
+        self._aborted = False
+
+    def update(self, data):
+        self._size += len(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.BUFFER_SIZE:
+            self._flush()
+
+    def hexdigests(self):
+        """
+        Wait for all pending data to be hashed and return a map of algorithm -> hex digest. No further updates are allowed.
+        """
+        if self._hexdigests is None:
+            if self._thread is None:
+                self._update_all(''.join(self._pending))
+            else:
+                self._flush()
+                self._queue.put(None)
+                self._thread.join()
+            self._pending = None
+            self._hexdigests = {alg: digest.hexdigest() for alg, digest in self.digests}
+            metrics.HASHED_BYTES.inc(self._size)
+            metrics.HASH_SECONDS.inc(self._hash_time)
+        return self._hexdigests
+
+    def abort(self):
+        """
+        Stop hashing and end the thread, discarding pending data. No further updates or digests are allowed.
+        Does nothing once hexdigests() has been called.
+        """
+        if self._hexdigests is None and self._pending is not None:
+            self._aborted = True
+            self._pending = None
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        buf = self._pending[0] if len(self._pending) == 1 else ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        if self._thread is None:
+            self._queue = Queue.Queue(maxsize=self.QUEUE_SIZE)
+            self._thread = threading.Thread(target=self._run, name='digest')
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(buf)
+
+    def _run(self):
+        for buf in iter(self._queue.get, None):
+            if not self._aborted:
+                self._update_all(buf)
+
+    def _update_all(self, buf):
+        start = time.time()
+        for _, digest in self.digests:
+            digest.update(buf)
+        self._hash_time += time.time() - start
+
+
 class HashingFile(file):
-    def __init__(self, file_path, hash_alg):
+    """
+    A file opened for writing that computes the CAS hash, plus any extra digests, of everything written to it.
+    Closing it finishes the digests, so that its hashing thread ends with the file rather than when the hash is read.
+    """
+
+    def __init__(self, file_path, hash_alg, digests=None):
         super(HashingFile, self).__init__(file_path, "wb")
-        self.hash_alg = hashlib.new(hash_alg)
         self.hash_name = hash_alg
+        self.digest_names = []
+        for alg in digests or []:
+            if alg not in self.digest_names:
+                self.digest_names.append(alg)
+        # The CAS algorithm is computed once, even if also requested as a digest
+        self.digest_worker = DigestWorker([hash_alg] + [alg for alg in self.digest_names if alg != hash_alg])
 
     def write(self, data):
-        self.hash_alg.update(data)
+        self.digest_worker.update(data)
+        metrics.UPLOADED_BYTES.inc(len(data))
         return file.write(self, data)
 
+    def close(self):
+        if not self.closed:
+            self.digest_worker.hexdigests()
+        file.close(self)
+
     def get_hash(self):
-        return self.hash_alg.hexdigest()
+        return self.digest_worker.hexdigests()[self.hash_name]
 
     def get_formatted_hash(self):
         return util.format_hash(self.hash_name, self.get_hash())
 
+    def get_digests(self):
+        """
+        Return the extra digests requested on creation, as a map of algorithm -> hex digest.
+        """
+        hexdigests = self.digest_worker.hexdigests()
+        return {alg: hexdigests[alg] for alg in self.digest_names}
+
+    def abort(self):
+        """
+        Stop hashing the file and close it, for uploads that fail before it is complete.
+        """
+        self.digest_worker.abort()
+        file.close(self)
+
+def abort_form(form):
+    """
+    Stop hashing the files of a processed form whose hashes have not been read, when the upload fails.
+    """
+    for field in form.itervalues():
+        if field.filename is not None:
+            field.file.abort()
+
 ParsedFile = collections.namedtuple('ParsedFile', ['info', 'path'])
 
-def process_form(request, hash_alg=None):
+def process_form(request, hash_alg=None, digests=None):
     """
-    Some workarounds to make webapp2 process forms in an intelligent way, and hash files we process.
-    Could subsume getHashingFieldStorage.
-
-    This is a bit arcane, and deals with webapp2 / uwsgi / python complexities. Ask a team member, sorry!
+    Parse a multipart form upload, storing and hashing any files as they stream in.
+    Each file also gets any extra digests requested; see HashingFile.get_digests().
 
     Returns the processed form, and the tempdir it was stored in.
     Keep tempdir in scope until you don't need it anymore; it will be deleted on GC.
     """
 
     hash_alg = hash_alg or DEFAULT_HASH_ALG
+    digests = digests or []
+
+    # Reject unknown digests before receiving the upload
+    for alg in digests:
+        new_digest(alg)
 
     # Store form file fields in a tempdir
     tempdir = tempfile.TemporaryDirectory(prefix='.tmp', dir=config.get_item('persistent', 'data_path'))
-    tempdir_path = tempdir.name
+    upload_dir = tempdir.name
 
-    # Deep vodoo; docs?
-    env = request.environ.copy()
-    env.setdefault('CONTENT_LENGTH', '0')
-    env['QUERY_STRING'] = ''
+    def make_file(filename):
+        return HashingFile(os.path.join(upload_dir, filename), hash_alg, digests)
 
-    # Wall-clock warning: despite its name, getHashingFieldStorage will actually process the entire form to disk. This involves recieving the entire upload stream and storing any files in the tempdir.
-    form = getHashingFieldStorage(tempdir.name, DEFAULT_HASH_ALG)(
-        fp=request.body_file, environ=env, keep_blank_values=True
-    )
+    # Wall-clock warning: this receives the entire upload stream and stores any files in the tempdir.
+    _, params = cgi.parse_header(request.headers.get('Content-Type', ''))
+    content_length = request.environ.get('CONTENT_LENGTH')
+    content_length = int(content_length) if content_length else None
+    form = MultipartParser(params.get('boundary'), make_file).parse(request.body_file, content_length)
 
     return (form, tempdir)
 
+
+class FormField(object):
+    """
+    A single part of a multipart form.
+
+    Mirrors the subset of cgi.FieldStorage used by the upload code: file fields have a filename
+    and an already-closed file; other fields have filename None and their contents in value.
+    """
+
+    def __init__(self, name, filename, content_type, file_):
+        self.name = name
+        self.filename = filename
+        self.type = content_type
+        self.file = file_
+
+    @property
+    def value(self):
+        if self.filename is None:
+            return self.file.getvalue()
+        with open(self.file.name, 'rb') as f:
+            return f.read()
+
+
+class MultipartParser(object):
+    """
+    Streaming multipart/form-data parser.
+
+    Reads the body in large chunks and searches each for the part boundary, so file contents are
+    written out without being split into lines. File parts are written to make_file(filename),
+    which receives the sanitized filename and returns a writable file; it is closed when the part ends.
+    """
+
+    CHUNK_SIZE = 2**20
+    MAX_HEADER_SIZE = 2**16
+
+    def __init__(self, boundary, make_file):
+        if not boundary:
+            raise FileStoreException('Multipart upload is missing its boundary')
+        self.delimiter = '\r\n--' + boundary
+        self.make_file = make_file
+
+    def parse(self, fp, content_length=None):
+        form = collections.OrderedDict()
+        # Prepending a CRLF lets the first boundary, which directly opens the body, match the same delimiter as the rest.
+        self._buf = '\r\n'
+        self._pos = 0
+        self._fp = fp
+        self._remaining = content_length
+
+        field = None
+        try:
+            self._skip_to_delimiter()
+            while self._start_part():
+                field = self._read_headers()
+                if field.name in form:
+                    raise FileStoreException('Form field "{}" is repeated'.format(field.name))
+                form[field.name] = field
+                try:
+                    self._read_body(field.file)
+                finally:
+                    if field.filename is not None:
+                        field.file.close()
+        except:
+            # Nobody will read these files' hashes; end their digest threads
+            abort_form(form)
+            if field is not None and field.filename is not None:
+                field.file.abort()
+            raise
+
+        return form
+
+    def _fill(self):
+        """
+        Read another chunk into the buffer, discarding what has been consumed. Returns False at end of stream.
+        """
+        size = self.CHUNK_SIZE
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+        chunk = self._fp.read(size) if size else ''
+        if self._remaining is not None:
+            self._remaining -= len(chunk)
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return bool(chunk)
+
+    def _skip_to_delimiter(self):
+        # Anything before the first boundary is preamble, and ignored.
+        while True:
+            i = self._buf.find(self.delimiter, self._pos)
+            if i != -1:
+                self._pos = i + len(self.delimiter)
+                return
+            self._pos = max(self._pos, len(self._buf) - len(self.delimiter) + 1)
+            if not self._fill():
+                raise FileStoreException('Malformed multipart upload: no boundary found')
+
+    def _start_part(self):
+        """
+        Having just consumed a delimiter, returns True if a part follows or False at the closing delimiter.
+        """
+        while len(self._buf) - self._pos < 2:
+            if not self._fill():
+                raise FileStoreException('Malformed multipart upload: truncated')
+        marker = self._buf[self._pos:self._pos+2]
+        if marker == '--':
+            return False
+        elif marker == '\r\n':
+            self._pos += 2
+            return True
+        raise FileStoreException('Malformed multipart upload: bad boundary')
+
+    def _read_headers(self):
+        while True:
+            i = self._buf.find('\r\n\r\n', self._pos)
+            if i != -1:
+                break
+            if len(self._buf) - self._pos > self.MAX_HEADER_SIZE:
+                raise FileStoreException('Malformed multipart upload: part headers too large')
+            if not self._fill():
+                raise FileStoreException('Malformed multipart upload: truncated')
+
+        headers = {}
+        for line in self._buf[self._pos:i].split('\r\n'):
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        self._pos = i + 4
+
+        _, params = cgi.parse_header(headers.get('content-disposition', ''))
+        name = params.get('name')
+        if name is None:
+            raise FileStoreException('Malformed multipart upload: part has no field name')
+        content_type = headers.get('content-type', 'text/plain')
+
+        # A file input left empty by a browser is sent with filename="", treat it as a plain field.
+        filename = params.get('filename')
+        if filename:
+            # Sanitize form's filename (read: prevent malicious escapes, bad characters, etc)
+            filename = os.path.basename(filename)
+            return FormField(name, filename, content_type, self.make_file(filename))
+        return FormField(name, None, content_type, cStringIO.StringIO())
+
+    def _read_body(self, out):
+        keep = len(self.delimiter) - 1
+        while True:
+            i = self._buf.find(self.delimiter, self._pos)
+            if i != -1:
+                out.write(self._buf[self._pos:i])
+                self._pos = i + len(self.delimiter)
+                return
+            # Hold back a possible partial delimiter at the end of the buffer.
+            safe = len(self._buf) - keep
+            if safe > self._pos:
+                out.write(self._buf[self._pos:safe])
+                self._pos = safe
+            if not self._fill():
+                raise FileStoreException('Malformed multipart upload: truncated')
+
 def getHashingFieldStorage(upload_dir, hash_alg):
     class HashingFieldStorage(cgi.FieldStorage):
         bufsize = 2**20
+        open_files = [] # every HashingFile made while parsing, so that they can be aborted
 
         def make_file(self, binary=None):
             # Sanitize form's filename (read: prevent malicious escapes, bad characters, etc)
@@ -117,8 +445,23 @@ def getHashingFieldStorage(upload_dir, hash_alg):
             # self.filename = util.sanitize_string_to_filename(self.filename)
 
             self.open_file = HashingFile(os.path.join(upload_dir, self.filename), hash_alg)
+            self.open_files.append(self.open_file)
             return self.open_file
 
+        # FieldStorage leaves files open for reading, so the digests are finished as each part ends instead.
+        # This keeps at most one hashing thread running per upload.
+        def read_lines(self):
+            cgi.FieldStorage.read_lines(self)
+            self._finish_digests()
+
+        def read_binary(self):
+            cgi.FieldStorage.read_binary(self)
+            self._finish_digests()
+
+        def _finish_digests(self):
+            if isinstance(self.file, HashingFile):
+                self.file.digest_worker.hexdigests()
+
         # override private method __write of superclass FieldStorage
         # _FieldStorage__file is the private variable __file of the same class
         def _FieldStorage__write(self, line):
@@ -157,25 +500,33 @@ class FileStore(object):
         self.environ.setdefault('CONTENT_LENGTH', '0')
         self.environ['QUERY_STRING'] = ''
         self.hash_alg = hash_alg
+        self.hashing_files = []
         start_time = datetime.datetime.utcnow()
-        if request.content_type == 'multipart/form-data':
-            self._save_multipart_file(dest_path, hash_alg)
-            self.payload = request.POST.mixed()
-        else:
-            self.payload = request.POST.mixed()
-            self.filename = filename or self.payload.get('filename')
-            self._save_body_file(dest_path, filename, hash_alg)
-        self.mimetype = util.guess_mimetype(self.filename)
-        self.path = os.path.join(dest_path, self.filename)
-        self.duration = datetime.datetime.utcnow() - start_time
-        # the hash format is:
-        # <version>-<hashing algorithm>-<actual hash>
-        # version will track changes on hash related methods like for example how we check for identical files.
-        self.hash = util.format_hash(hash_alg, self.received_file.get_hash())
-        self.size = os.path.getsize(self.path)
+        try:
+            if request.content_type == 'multipart/form-data':
+                self._save_multipart_file(dest_path, hash_alg)
+                self.payload = request.POST.mixed()
+            else:
+                self.payload = request.POST.mixed()
+                self.filename = filename or self.payload.get('filename')
+                self._save_body_file(dest_path, filename, hash_alg)
+            self.mimetype = util.guess_mimetype(self.filename)
+            self.path = os.path.join(dest_path, self.filename)
+            self.duration = datetime.datetime.utcnow() - start_time
+            # the hash format is:
+            # <version>-<hashing algorithm>-<actual hash>
+            # version will track changes on hash related methods like for example how we check for identical files.
+            self.hash = util.format_hash(hash_alg, self.received_file.get_hash())
+            self.size = os.path.getsize(self.path)
+        finally:
+            # Ends the digest threads of files whose hash was never read: those of a failed upload, or extra file fields
+            for f in self.hashing_files:
+                f.digest_worker.abort()
 
     def _save_multipart_file(self, dest_path, hash_alg):
-        form = getHashingFieldStorage(dest_path, hash_alg)(fp=self.body, environ=self.environ, keep_blank_values=True)
+        storage_class = getHashingFieldStorage(dest_path, hash_alg)
+        self.hashing_files = storage_class.open_files
+        form = storage_class(fp=self.body, environ=self.environ, keep_blank_values=True)
 
         self.received_file = form['file'].file
         self.filename = os.path.basename(form['file'].filename)
@@ -187,6 +538,7 @@ class FileStore(object):
             raise FileStoreException('filename is required for body uploads')
         self.filename = os.path.basename(filename)
         self.received_file = HashingFile(os.path.join(dest_path, filename), hash_alg)
+        self.hashing_files = [self.received_file]
         for chunk in iter(lambda: self.body.read(2**20), ''):
             self.received_file.write(chunk)
         self.tags = None
@@ -197,6 +549,8 @@ class FileStore(object):
         self.path = target_path
 
 def identical(hash_0, path_0, hash_1, path_1):
+    if hash_0 == hash_1:
+        return True
     if zipfile.is_zipfile(path_0) and zipfile.is_zipfile(path_1):
         with zipfile.ZipFile(path_0) as zf1, zipfile.ZipFile(path_1) as zf2:
             zf1_infolist = sorted(zf1.infolist(), key=lambda zi: zi.filename)
@@ -229,17 +583,23 @@ class MultiFileStore(object):
         self.payload = request.POST.mixed()
 
     def _save_multipart_files(self, dest_path, hash_alg):
-        form = getHashingFieldStorage(dest_path, hash_alg)(fp=self.body, environ=self.environ, keep_blank_values=True)
-        self.metadata = json.loads(form['metadata'].file.getvalue()) if 'metadata' in form else None
-        for field in form:
-            if form[field].filename:
-                filename = os.path.basename(form[field].filename)
-                self.files[filename] = ParsedFile(
-                    {
-                        'hash': util.format_hash(hash_alg, form[field].file.get_hash()),
-                        'size': os.path.getsize(os.path.join(dest_path, filename)),
-                        'mimetype': util.guess_mimetype(filename)
-                    }, os.path.join(dest_path, filename))
+        storage_class = getHashingFieldStorage(dest_path, hash_alg)
+        try:
+            form = storage_class(fp=self.body, environ=self.environ, keep_blank_values=True)
+            self.metadata = json.loads(form['metadata'].file.getvalue()) if 'metadata' in form else None
+            for field in form:
+                if form[field].filename:
+                    filename = os.path.basename(form[field].filename)
+                    self.files[filename] = ParsedFile(
+                        {
+                            'hash': util.format_hash(hash_alg, form[field].file.get_hash()),
+                            'size': os.path.getsize(os.path.join(dest_path, filename)),
+                            'mimetype': util.guess_mimetype(filename)
+                        }, os.path.join(dest_path, filename))
+        finally:
+            # Ends the digest threads of files whose hash was never read
+            for f in storage_class.open_files:
+                f.digest_worker.abort()
 
 
 # File extension --> scitran file type detection hueristics.
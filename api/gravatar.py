@@ -0,0 +1,94 @@
+"""
+Gravatar lookups, kept off the request path.
+
+Probing gravatar.com costs a full HTTPS round trip, so results are cached per worker and
+logins resolve them on a background thread rather than while the user waits.
+"""
+
+import hashlib
+import Queue
+import threading
+
+import requests
+
+from . import cache
+from . import config
+
+log = config.log
+
+GRAVATAR_URL = 'https://gravatar.com/avatar/'
+LOOKUP_TIMEOUT = 5
+
+# Maps email -> gravatar url, or False if the email has none.
+# Negative results are cached too; a user adding a gravatar is picked up once the entry expires.
+result_cache = cache.TTLCache(maxsize=10000, ttl=3600)
+
+_pending = Queue.Queue(maxsize=1000)
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def gravatar_url(email):
+    return GRAVATAR_URL + hashlib.md5(email).hexdigest() + '?s=512'
+
+
+def resolve(email):
+    """
+    Given an email, returns a URL if that email has a gravatar set.
+    Otherwise returns None.
+
+    Blocks on gravatar.com if the result is not cached.
+    """
+
+    result = result_cache.get(email)
+    if result is None:
+        url = gravatar_url(email)
+        try:
+            found = bool(requests.head(url, params={'d': '404'}, timeout=LOOKUP_TIMEOUT))
+        except requests.exceptions.RequestException as e:
+            # Don't cache failures to reach gravatar, only its answers
+            log.warn('Could not resolve gravatar for {}: {}'.format(email, e))
+            return None
+        result = url if found else False
+        result_cache.set(email, result)
+    return result or None
+
+
+def resolve_async(email, callback):
+    """
+    Resolve an email's gravatar in the background, calling callback(email, url) if one exists.
+
+    Returns immediately. Cached results are still handed to the background thread so that
+    callback never runs on the caller's thread. If the backlog is full the lookup is dropped;
+    it will be retried on the user's next login.
+    """
+
+    _ensure_worker()
+    try:
+        _pending.put_nowait((email, callback))
+    except Queue.Full:
+        log.warn('Gravatar lookup backlog full, skipping ' + email)
+
+
+def _ensure_worker():
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='gravatar')
+            _worker.daemon = True
+            _worker.start()
+
+
+def _work():
+    while True:
+        email, callback = _pending.get()
+        try:
+            url = resolve(email)
+            if url is not None:
+                callback(email, url)
+        except Exception: # pylint: disable=broad-except
+            log.exception('Gravatar lookup for {} failed'.format(email))
+        finally:
+            _pending.task_done()
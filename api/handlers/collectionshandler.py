@@ -77,8 +77,7 @@ class CollectionsHandler(ContainerHandler):
                 self.abort(400, 'not a valid object id')
             item_id = bson.ObjectId(item['_id'])
             if item['level'] == 'project':
-                sess_ids = [s['_id'] for s in config.db.sessions.find({'project': item_id}, [])]
-                acq_ids += [a['_id'] for a in config.db.acquisitions.find({'session': {'$in': sess_ids}}, [])]
+                acq_ids += [a['_id'] for a in config.db.acquisitions.find({'project': item_id}, [])]
             elif item['level'] == 'session':
                 acq_ids += [a['_id'] for a in config.db.acquisitions.find({'session': item_id}, [])]
             elif item['level'] == 'acquisition':
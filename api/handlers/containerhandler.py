@@ -11,6 +11,7 @@ from .. import validators
 from ..auth import containerauth, always_ok
 from ..dao import APIStorageException, containerstorage, containerutil, noop
 from ..types import Origin
+from ..jobs import rules
 from ..jobs.queue import Queue
 
 log = config.log
@@ -362,6 +363,10 @@ class ContainerHandler(base.RequestHandler):
         if cont_name == 'sessions':
             payload['group'] = parent_container['group']
             payload['subject'] = containerutil.add_id_to_subject(payload.get('subject'), payload.get('project'))
+        # Acquisitions carry the ids of all their ancestors
+        if cont_name == 'acquisitions':
+            payload['project'] = parent_container['project']
+            payload['group'] = parent_container['group']
         # Optionally inherit permissions of a project from the parent group. The default behaviour
         # for projects is to give admin permissions to the requestor.
         # The default for other containers is to inherit.
@@ -414,9 +419,20 @@ class ContainerHandler(base.RequestHandler):
 
             if cont_name == 'sessions':
                 payload['group'] = target_parent_container['group']
-                # Propagate permissions down to acquisitions
+                # Propagate permissions and ancestor ids down to acquisitions
                 rec = True
                 r_payload['permissions'] = parent_perms
+                r_payload['project'] = payload['project']
+                r_payload['group'] = payload['group']
+
+            if cont_name == 'acquisitions':
+                payload['project'] = target_parent_container['project']
+                payload['group'] = target_parent_container['group']
+
+            if cont_name == 'projects':
+                # Propagate the new group id down to sessions and acquisitions
+                rec = True
+                r_payload['group'] = target_parent_container['_id']
 
 
         payload['modified'] = datetime.datetime.utcnow()
@@ -439,6 +455,8 @@ class ContainerHandler(base.RequestHandler):
             self.abort(400, e.message)
 
         if result.modified_count == 1:
+            if cont_name == 'projects':
+                rules.invalidate_rules(_id)
             return {'modified': result.modified_count}
         else:
             self.abort(404, 'Element not updated in container {} {}'.format(self.storage.cont_name, _id))
@@ -15,6 +15,8 @@ from ..jobs.jobs import Job
 from .. import tempdir as tempfile
 from .. import upload
 from .. import download
+from .. import metrics
+from .. import zipindex
 from .. import util
 from .. import validators
 from ..auth import listauth, always_ok
@@ -347,25 +349,6 @@ class FileListHandler(ListHandler):
             self.abort(400, 'ticket not for this resource or source IP')
         return ticket
 
-    def _build_zip_info(self, filepath):
-        """
-        Builds a json response containing member and comment info for a zipfile
-        """
-        with zipfile.ZipFile(filepath) as zf:
-            info = {}
-            info['comment'] = zf.comment
-            info['members'] = []
-            for zi in zf.infolist():
-                m = {}
-                m['path']      = zi.filename
-                m['size']      = zi.file_size
-                m['timestamp'] = datetime.datetime(*zi.date_time)
-                m['comment']   = zi.comment
-
-                info['members'].append(m)
-
-            return info
-
     def get(self, cont_name, list_name, **kwargs):
         """
         .. http:get:: /api/(cont_name)/(cid)/files/(file_name)
@@ -437,7 +420,7 @@ class FileListHandler(ListHandler):
         # Request for info about zipfile
         elif self.is_true('info'):
             try:
-                info = self._build_zip_info(filepath)
+                info = zipindex.get_index(fileinfo['hash'], filepath).info()
             except zipfile.BadZipfile:
                 self.abort(400, 'not a zip file')
             return info
@@ -446,18 +429,24 @@ class FileListHandler(ListHandler):
         elif self.get_param('member') is not None:
             zip_member = self.get_param('member')
             try:
-                with zipfile.ZipFile(filepath) as zf:
-                    self.response.headers['Content-Type'] = util.guess_mimetype(zip_member)
-                    self.response.write(zf.open(zip_member).read())
+                member = zipindex.get_index(fileinfo['hash'], filepath).members[zip_member]
             except zipfile.BadZipfile:
                 self.abort(400, 'not a zip file')
             except KeyError:
                 self.abort(400, 'zip file contains no such member')
+            try:
+                zipindex.check_supported(member)
+            except zipfile.BadZipfile as e:
+                self.abort(400, str(e))
+            # Members are identified by their offset within the (immutable) zip
+            etag = '"{}-{}"'.format(fileinfo['hash'], member.header_offset)
+            read_range = lambda start, length: zipindex.member_stream(filepath, member, start, length)
+            download.send_content(self.request, self.response, member.file_size, etag, read_range, ranges=zipindex.is_seekable(member))
+            self.response.headers['Content-Type'] = util.guess_mimetype(zip_member)
 
         # Authenticated or ticketed download request
         else:
-            self.response.app_iter = open(filepath, 'rb')
-            self.response.headers['Content-Length'] = str(fileinfo['size']) # must be set after setting app_iter
+            download.send_file(self.request, self.response, filepath, fileinfo['size'], fileinfo['hash'])
             if self.is_true('view'):
                 self.response.headers['Content-Type'] = str(fileinfo.get('mimetype', 'application/octet-stream'))
             else:
@@ -590,21 +579,24 @@ class FileListHandler(ListHandler):
 
 class AnalysesHandler(ListHandler):
 
-    def _check_ticket(self, ticket_id, _id, filename):
+    def _check_ticket(self, ticket_id, _id, filename, analysis_id=None):
         ticket = config.db.downloads.find_one({'_id': ticket_id})
         if not ticket:
             self.abort(404, 'no such ticket')
         if ticket['ip'] != self.request.client_addr:
             self.abort(400, 'ticket not for this source IP')
         if not filename:
-            return self._check_ticket_for_batch(ticket)
+            return self._check_ticket_for_batch(ticket, analysis_id)
         if ticket.get('filename') != filename or ticket['target'] != _id:
             self.abort(400, 'ticket not for this resource')
         return ticket
 
-    def _check_ticket_for_batch(self, ticket):
+    def _check_ticket_for_batch(self, ticket, analysis_id):
         if ticket.get('type') != 'batch':
             self.abort(400, 'ticket not for this resource')
+        # Tickets issued before manifests carried the target list itself, and can't be checked
+        if isinstance(ticket['target'], dict) and ticket['target'] != {'analysis': analysis_id}:
+            self.abort(400, 'ticket not for this resource')
         return ticket
 
     def put(self, *args, **kwargs):
@@ -845,9 +837,13 @@ class AnalysesHandler(ListHandler):
                 file_cnt = 1
                 ticket = util.download_ticket(self.request.client_addr, 'file', _id, filename, total_size)
             else:
-                targets, total_size, file_cnt = self._prepare_batch(fileinfo)
+                total_size = file_cnt = 0
+                for _, _, size in self._prepare_batch(fileinfo):
+                    total_size += size
+                    file_cnt += 1
                 filename = 'analysis_' + analysis_id + '.tar'
-                ticket = util.download_ticket(self.request.client_addr, 'batch', targets, filename, total_size)
+                # The targets are regenerated from the analysis when the ticket is used
+                ticket = util.download_ticket(self.request.client_addr, 'batch', {'analysis': analysis_id}, filename, total_size)
             return {
                 'ticket': config.db.downloads.insert_one(ticket).inserted_id,
                 'size': total_size,
@@ -855,9 +851,9 @@ class AnalysesHandler(ListHandler):
                 'filename': filename
             }
         else:
-            ticket = self._check_ticket(ticket_id, _id, filename)
+            ticket = self._check_ticket(ticket_id, _id, filename, analysis_id)
             if not filename:
-                self._send_batch(ticket)
+                self._send_batch(ticket, fileinfo)
                 return
             if not fileinfo:
                 self.abort(404, '{} doesn''t exist'.format(filename))
@@ -867,8 +863,7 @@ class AnalysesHandler(ListHandler):
                 util.path_from_hash(fileinfo['hash'])
             )
             filename = fileinfo['name']
-            self.response.app_iter = open(filepath, 'rb')
-            self.response.headers['Content-Length'] = str(fileinfo['size']) # must be set after setting app_iter
+            download.send_file(self.request, self.response, filepath, fileinfo['size'], fileinfo['hash'])
             if self.is_true('view'):
                 self.response.headers['Content-Type'] = str(fileinfo.get('mimetype', 'application/octet-stream'))
             else:
@@ -876,21 +871,18 @@ class AnalysesHandler(ListHandler):
                 self.response.headers['Content-Disposition'] = 'attachment; filename=' + str(filename)
 
     def _prepare_batch(self, fileinfo):
-        ## duplicated code from download.py
-        ## we need a way to avoid this
-        targets = []
-        total_size = total_cnt = 0
+        """
+        Yield the download targets for an analysis' files, skipping any missing from the CAS.
+        """
         data_path = config.get_item('persistent', 'data_path')
-        for f in fileinfo:
-            filepath = os.path.join(data_path, util.path_from_hash(f['hash']))
-            if os.path.exists(filepath): # silently skip missing files
-                targets.append((filepath, 'analyses/' + f['name'], f['size']))
-                total_size += f['size']
-                total_cnt += 1
-        return targets, total_size, total_cnt
-
-    def _send_batch(self, ticket):
-        self.response.app_iter = download.archivestream(ticket)
+        candidates = (
+            (os.path.join(data_path, util.path_from_hash(f['hash'])), 'analyses/' + f['name'], f['size'])
+            for f in fileinfo
+        )
+        return download.existing_targets(candidates)
+
+    def _send_batch(self, ticket, fileinfo):
+        self.response.app_iter = metrics.counted(download.archivestream(self._prepare_batch(fileinfo)), metrics.DOWNLOADED_BYTES)
         self.response.headers['Content-Type'] = 'application/octet-stream'
         self.response.headers['Content-Disposition'] = 'attachment; filename=' + str(ticket['filename'])
 
@@ -98,6 +98,41 @@ class SearchHandler(base.RequestHandler):
             container_name = result_type
         result['_source'].update(self._get_parents(container, container_name))
 
+    def _add_hierarchy(self, results):
+        """
+        Add to each result its container and the containers above it, with one query per level for all results.
+        """
+        # Containers to fetch, by collection, and the results to fill in with each
+        wanted = {}
+        for result in results:
+            cont_id = bson.objectid.ObjectId(result.pop('container_id'))
+            wanted.setdefault(result['container_name'], {}).setdefault(cont_id, []).append(result)
+
+        # Walk up from acquisitions to groups; each level queues the parents of the level below it
+        for cont_name in ['collections', 'acquisitions', 'sessions', 'projects', 'groups']:
+            requested = wanted.get(cont_name)
+            if not requested:
+                continue
+            containers = config.db[cont_name].find({'_id': {'$in': list(requested)}})
+            containers = {c['_id']: c for c in containers}
+            parent_cont_name = parent_container_dict.get(cont_name)
+
+            for cont_id, cont_results in requested.iteritems():
+                container = containers.get(cont_id)
+                # Ancestors are shown without other users' permissions; a copy keeps them on the result's own container
+                stripped = None
+                if container is not None:
+                    stripped = dict(container)
+                    self._strip_other_permissions(stripped, cont_name)
+                for result in cont_results:
+                    result[cont_name[:-1]] = container if result['container_name'] == cont_name else stripped
+
+                if container is not None and parent_cont_name:
+                    parent_id = container[parent_cont_name[:-1]]
+                    if parent_cont_name != 'groups':
+                        parent_id = bson.objectid.ObjectId(parent_id)
+                    wanted.setdefault(parent_cont_name, {}).setdefault(parent_id, []).extend(cont_results)
+
     def _strip_other_permissions(self, container, cont_name):
         perm_list = container.pop('roles', None) if cont_name == 'groups' else container.pop('permissions', None)
         if perm_list:
@@ -140,27 +175,12 @@ class SearchHandler(base.RequestHandler):
             es_results = config.es.search(index='scitran', body=query, size=size or 10) # pylint: disable=unexpected-keyword-arg
             ## elastic search results are wrapped in subkey ['hits']['hits']
             es_results = es_results['hits']['hits']
-            results = []
-            for result in es_results:
-                # extract the source of the result
-                result = result['_source']
-                # add to the result the container hierarchy references
-                cont_id = bson.objectid.ObjectId(result.pop('container_id'))
-                cont_name = result['container_name']
-                container = config.db[cont_name].find_one({'_id': cont_id})
-                result[cont_name[:-1]] = container
-                while parent_container_dict.get(cont_name):
-                    parent_cont_name = parent_container_dict[cont_name]
-                    parent_id = container[parent_cont_name[:-1]]
-                    if parent_cont_name != 'groups':
-                        parent_id = bson.objectid.ObjectId(parent_id)
-                    container = config.db[parent_cont_name].find_one({'_id': parent_id})
-                    self._strip_other_permissions(container, parent_cont_name)
-                    result[parent_cont_name[:-1]] = container
-                    cont_name = parent_cont_name
-                if collection:
+            # extract the source of the results
+            results = [result['_source'] for result in es_results]
+            self._add_hierarchy(results)
+            if collection:
+                for result in results:
                     result['collection'] = collection
-                results.append(result)
         except elasticsearch.exceptions.ConnectionError as e:
             self.abort(503, 'elasticsearch is not available')
         return results
@@ -3,6 +3,7 @@ import pymongo
 
 from .. import base
 from .. import util
+from .. import gravatar
 from .. import config
 from .. import validators
 from ..auth import userauth, always_ok, ROLES
@@ -58,6 +59,7 @@ class UserHandler(base.RequestHandler):
         self._cleanup_user_permissions(user.get('_id'))
         log.debug('2')
         result = self.storage.exec_op('DELETE', _id)
+        base.invalidate_cached_user(_id)
         if result.deleted_count == 1:
             return {'deleted': result.deleted_count}
         else:
@@ -110,6 +112,7 @@ class UserHandler(base.RequestHandler):
         payload['modified'] = datetime.datetime.utcnow()
         result = mongo_validator(permchecker(self.storage.exec_op))('PUT', _id=_id, payload=payload)
         if result.modified_count == 1:
+            base.invalidate_cached_user(_id)
             return {'modified': result.modified_count}
         else:
             self.abort(404, 'User {} not updated'.format(_id))
@@ -205,15 +208,15 @@ class UserHandler(base.RequestHandler):
 
         # If the user exists but has no set avatar, try to get one
         if user and avatar is None:
-            gravatar = util.resolve_gravatar(email)
+            gravatar_url = gravatar.resolve(email)
 
-            if gravatar is not None:
+            if gravatar_url is not None:
                 user = config.db['users'].find_one_and_update({
                         '_id': email,
                     }, {
                         '$set': {
-                            'avatar': gravatar,
-                            'avatars.gravatar': gravatar,
+                            'avatar': gravatar_url,
+                            'avatars.gravatar': gravatar_url,
                         }
                     },
                     return_document=pymongo.collection.ReturnDocument.AFTER
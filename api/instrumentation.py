@@ -0,0 +1,165 @@
+"""
+Per-request database timing and slow-request profiling.
+
+A pymongo command listener and an Elasticsearch transport record every call made by the thread serving a request:
+how many, how long they took in total and which were slowest. The dispatcher reports them in a Server-Timing
+header, and logs them for requests slower than core.slow_request_threshold seconds.
+
+If core.profile_path is set, every request is run under cProfile, and the profiles of slow requests are dumped
+there for inspection with pstats. Profiling slows requests down noticeably, so only enable it while investigating.
+"""
+
+import os
+import time
+import pstats
+import cProfile
+import datetime
+import logging
+import threading
+
+import elasticsearch
+import pymongo.monitoring
+
+# Not config.log; config imports this module to instrument its clients
+log = logging.getLogger('scitran.api')
+
+# Number of slowest commands kept for each request
+SLOWEST_COMMANDS = 3
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    def __init__(self, profile=False):
+        self.start = time.time()
+        self.db_count = 0
+        self.db_time = 0.0
+        self.es_count = 0
+        self.es_time = 0.0
+        self.slowest = [] # (seconds, description), slowest first
+        self.started = {} # (connection, request id) -> description of commands in flight
+        self.profiler = cProfile.Profile() if profile else None
+
+    def _record_slowest(self, seconds, description):
+        if len(self.slowest) < SLOWEST_COMMANDS or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, description))
+            self.slowest.sort(reverse=True)
+            del self.slowest[SLOWEST_COMMANDS:]
+
+    def record_db(self, seconds, description):
+        self.db_count += 1
+        self.db_time += seconds
+        self._record_slowest(seconds, description)
+
+    def record_es(self, seconds, description):
+        self.es_count += 1
+        self.es_time += seconds
+        self._record_slowest(seconds, description)
+
+    def server_timing(self, total):
+        """
+        Return the value of the Server-Timing header, given the request's total duration.
+        """
+        metrics = [
+            'db;desc="MongoDB, {} commands";dur={:.1f}'.format(self.db_count, self.db_time * 1000),
+            'es;desc="Elasticsearch, {} requests";dur={:.1f}'.format(self.es_count, self.es_time * 1000),
+        ]
+        for i, (seconds, description) in enumerate(self.slowest, 1):
+            metrics.append('slowest-{};desc="{}";dur={:.1f}'.format(i, description.replace('"', "'"), seconds * 1000))
+        metrics.append('total;dur={:.1f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+
+def begin(profile=False):
+    """
+    Start recording the calls made by the current thread's request.
+    """
+    stats = RequestStats(profile)
+    _local.stats = stats
+    if stats.profiler is not None:
+        stats.profiler.enable()
+    return stats
+
+def end(request, response, slow_threshold=None, profile_path=None):
+    """
+    Stop recording, and report on the request in its response headers and, if it was slow, the log.
+    """
+    stats = current()
+    _local.stats = None
+    if stats is None:
+        return None
+    if stats.profiler is not None:
+        stats.profiler.disable()
+
+    total = time.time() - stats.start
+    response.headers['Server-Timing'] = stats.server_timing(total)
+
+    if slow_threshold is not None and total >= float(slow_threshold):
+        log.warning('Slow request: {} {} took {:.0f}ms, {} MongoDB commands in {:.0f}ms, {} Elasticsearch requests in {:.0f}ms, slowest: {}'.format(
+            request.method, request.path, total * 1000, stats.db_count, stats.db_time * 1000, stats.es_count, stats.es_time * 1000,
+            ', '.join('{} {:.0f}ms'.format(d, s * 1000) for s, d in stats.slowest)
+        ))
+        if stats.profiler is not None and profile_path:
+            dump_profile(stats.profiler, request, profile_path)
+
+    return stats
+
+def current():
+    return getattr(_local, 'stats', None)
+
+def dump_profile(profiler, request, profile_path):
+    filename = '{}-{}-{}.prof'.format(
+        datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'),
+        request.method,
+        request.path.strip('/').replace('/', '_')[:100]
+    )
+    try:
+        if not os.path.exists(profile_path):
+            os.makedirs(profile_path)
+        pstats.Stats(profiler).dump_stats(os.path.join(profile_path, filename))
+    except (IOError, OSError):
+        log.exception('Could not write request profile to {}'.format(profile_path))
+
+
+class CommandTimer(pymongo.monitoring.CommandListener):
+    """
+    Records the duration of each MongoDB command against the request of the thread that ran it.
+    """
+
+    def started(self, event):
+        stats = current()
+        if stats is None:
+            return
+        target = event.command.get(event.command_name)
+        if not isinstance(target, basestring):
+            # getMore and killCursors name the collection separately
+            target = event.command.get('collection', '')
+        stats.started[(event.connection_id, event.request_id)] = '{} {}'.format(event.command_name, target).strip()
+
+    def _finished(self, event):
+        stats = current()
+        if stats is None:
+            return
+        description = stats.started.pop((event.connection_id, event.request_id), event.command_name)
+        stats.record_db(event.duration_micros / 1e6, description)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+
+class TimedTransport(elasticsearch.Transport):
+    """
+    Records the duration of each Elasticsearch request against the request of the thread that made it.
+    """
+
+    def perform_request(self, method, url, params=None, body=None):
+        start = time.time()
+        try:
+            return super(TimedTransport, self).perform_request(method, url, params=params, body=body)
+        finally:
+            stats = current()
+            if stats is not None:
+                stats.record_es(time.time() - start, '{} {}'.format(method, url))
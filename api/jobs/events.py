@@ -0,0 +1,157 @@
+"""
+Job state change events.
+
+The queue records every job transition in jobevents, a capped collection, and /api/jobs/events streams them to
+clients as Server-Sent Events by tailing it. Being capped, the collection keeps only recent history; a client that
+reconnects with a Last-Event-ID older than that misses the events in between.
+
+A stream holds a server thread for as long as it is open, so each process serves at most queue.max_event_streams at
+a time and answers further subscribers with 503 and Retry-After. Size the deployment for the expected subscribers:
+the server accepts max_event_streams times the number of processes, and each process needs max_event_streams
+threads plus those for the rest of the API (see docker/uwsgi-config.ini). Otherwise streams can take every thread
+of a process. The setting is read once per process.
+"""
+
+import time
+import datetime
+import threading
+
+import pymongo
+import pymongo.errors
+
+from .. import config
+
+log = config.log
+
+# How long a single stream stays open. Each stream holds a server thread, so clients are made to reconnect,
+# which EventSource does by itself, resuming from the last event it saw.
+STREAM_DURATION = 60
+
+# Seconds without events before tail() yields None, so that the stream can send a keepalive
+KEEPALIVE_INTERVAL = 15
+
+# Seconds a subscriber turned away for lack of streams is told to wait before retrying
+RETRY_AFTER = 10
+
+_streams = None
+_streams_lock = threading.Lock()
+
+
+class Stream(object):
+    """
+    A response body holding one of this process's stream slots until the server closes it.
+    """
+
+    def __init__(self, iterable, semaphore):
+        self.iterable = iterable
+        self.semaphore = semaphore
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            if not self.released:
+                self.released = True
+                self.semaphore.release()
+
+def _stream_slots():
+    global _streams
+    with _streams_lock:
+        if _streams is None:
+            _streams = threading.BoundedSemaphore(int(config.get_item('queue', 'max_event_streams')))
+        return _streams
+
+def open_stream(iterable):
+    """
+    Return iterable as a Stream taking one of queue.max_event_streams slots, or None if they are all in use.
+    """
+    semaphore = _stream_slots()
+    if not semaphore.acquire(False):
+        return None
+    return Stream(iterable, semaphore)
+
+
+def event(job, state, previous_state=None):
+    """
+    Build the event for a Job or job document entering a state.
+    """
+    if isinstance(job, dict):
+        _id, name, tags = job['_id'], job['name'], job['tags']
+    else:
+        _id, name, tags = job._id, job.name, job.tags
+
+    return {
+        'job': str(_id),
+        'name': name,
+        'tags': tags,
+        'state': state,
+        'previous_state': previous_state,
+        'timestamp': datetime.datetime.utcnow(),
+    }
+
+def publish(events):
+    events = list(events)
+    if not events:
+        return
+    try:
+        config.db.jobevents.insert_many(events, ordered=False)
+    except pymongo.errors.PyMongoError:
+        # Events are best-effort; losing some must not fail the job change that caused them
+        log.exception('Could not publish job events')
+
+def tail(last_event_id=None, job_ids=None, tags=None, duration=STREAM_DURATION, timer=time.time):
+    """
+    Yield job events after last_event_id, or from now if not given, for up to duration seconds.
+    Each event has its id in _id. None is yielded when the stream has been idle for KEEPALIVE_INTERVAL.
+
+    Events can be limited to some jobs, or to jobs with any of some tags.
+    """
+
+    # Event ids are made by the publishing processes, so they are not in insertion order across processes and hosts.
+    # Streams follow the capped collection's natural order instead, which is, and resume right after the last event
+    # seen by scanning up to it. Starting "from now" means after the latest event, whatever the clocks say.
+    if last_event_id is None:
+        latest = config.db.jobevents.find_one({}, {'_id': True}, sort=[('$natural', pymongo.DESCENDING)])
+        last_event_id = latest['_id'] if latest else None
+
+    query = {}
+    if job_ids:
+        query['job'] = {'$in': job_ids}
+    if tags:
+        query['tags'] = {'$in': tags}
+
+    deadline = timer() + duration
+    last_sent = timer()
+
+    while timer() < deadline:
+        # If the last event has already been dropped from the collection, everything left in it is newer
+        skipping = last_event_id is not None and config.db.jobevents.find_one({'_id': last_event_id}, {'_id': True}) is not None
+        cursor_query = {'$or': [query, {'_id': last_event_id}]} if skipping and query else query
+        cursor = config.db.jobevents.find(cursor_query, cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+
+        while cursor.alive and timer() < deadline:
+            # With an awaitData cursor, this waits a while for new events before giving up on the batch
+            for doc in cursor:
+                if skipping:
+                    skipping = doc['_id'] != last_event_id
+                    continue
+                last_event_id = doc['_id']
+                last_sent = timer()
+                yield doc
+            # Reached the end without meeting the last event: it was dropped while scanning
+            skipping = False
+
+            if timer() - last_sent >= KEEPALIVE_INTERVAL:
+                last_sent = timer()
+                yield None
+
+        alive = cursor.alive
+        cursor.close()
+        if not alive:
+            # An empty capped collection can't be tailed; wait for the first event
+            time.sleep(1)
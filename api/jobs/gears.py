@@ -2,6 +2,9 @@
 Gears
 """
 
+import copy
+
+from .. import cache
 from .. import config
 
 log = config.log
@@ -9,6 +12,11 @@ log = config.log
 # For now, gears are in a singleton, prefixed by a key
 SINGLETON_KEY = 'gear_list'
 
+# Holds this worker's name -> gear registry under a single key.
+# Gear changes made through this worker clear it; other workers reload once it expires.
+GEAR_CACHE_TTL = 60
+gear_cache = cache.TTLCache(maxsize=1, ttl=GEAR_CACHE_TTL)
+
 def get_gears(fields=None):
     """
     Fetch the install-global gears from the database
@@ -32,33 +40,50 @@ def get_gears(fields=None):
     # print gear_doc
     return gear_doc[SINGLETON_KEY]
 
+def _load_gear_registry():
+    gear_doc = config.db.singletons.find_one({'_id': 'gears'}) or {}
+    registry = {}
+    for gear in gear_doc.get(SINGLETON_KEY) or []:
+        # Like $elemMatch, the first gear with a name wins
+        registry.setdefault(gear.get('name'), gear)
+    gear_cache.set(SINGLETON_KEY, registry)
+    return registry
+
 def get_gear_by_name(name):
+    """
+    Find a gear from the list by name, from the cached registry.
+    """
 
-    # Find a gear from the list by name
-    gear_doc = config.db.singletons.find_one(
-        {'_id': 'gears'},
-        {SINGLETON_KEY: { '$elemMatch': {
-            'name': name
-        }}
-    })
+    registry = gear_cache.get(SINGLETON_KEY)
+    if registry is None or name not in registry:
+        # Reload on a miss too, in case another worker added the gear
+        registry = _load_gear_registry()
 
-    if gear_doc is None or gear_doc.get(SINGLETON_KEY) is None:
+    gear = registry.get(name)
+    if gear is None:
         raise Exception('Unknown gear ' + name)
 
-    # Mongo returns the full document: { '_id' : 'gears', 'gear_list' : [ { .. } ] }, so strip that out
-    return gear_doc[SINGLETON_KEY][0]
+    # Callers are free to modify the gear they get back
+    return copy.deepcopy(gear)
+
+def invalidate_gears():
+    gear_cache.clear()
 
 def insert_gear(doc):
-    config.db.singletons.update(
+    result = config.db.singletons.update(
         {"_id" : "gears"},
         {'$push': {'gear_list': doc} }
     )
+    invalidate_gears()
+    return result
 
 def remove_gear(name):
-    config.db.singletons.update(
+    result = config.db.singletons.update(
         {"_id" : "gears"},
         {'$pull': {'gear_list':{ 'name': name }} }
     )
+    invalidate_gears()
+    return result
 
 def upsert_gear(doc):
     remove_gear(doc['name'])
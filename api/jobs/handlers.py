@@ -1,20 +1,29 @@
 """
 API request handlers for the jobs module
 """
+import bson.errors
 import bson.objectid
+import urllib
 
 from ..auth.containerauth import list_permission_checker, default_container
 from ..dao.containerutil import create_filereference_from_dictionary, create_containerreference_from_dictionary, create_containerreference_from_filereference
 from ..dao.containerstorage import ContainerStorage
 from .. import base
 from .. import config
+from .. import encoder
 
+from . import events
+from . import stats
 from .gears import get_gears, get_gear_by_name, remove_gear, upsert_gear
 from .jobs import Job
-from .queue import Queue
+from .queue import Queue, MAX_JOBS_PER_CLAIM, PAGE_SORTS
+from .rules import invalidate_rules
 
 log = config.log
 
+# Most jobs listed per page by JobsHandler.get
+MAX_PAGE_SIZE = 1000
+
 
 class GearsHandler(base.RequestHandler):
 
@@ -267,6 +276,7 @@ class RulesHandler(base.RequestHandler):
 
         doc = self.request.json
         config.db.singletons.replace_one({"_id" : "rules"}, {'rule_list': doc}, upsert=True)
+        invalidate_rules()
 
 
 class JobsHandler(base.RequestHandler):
@@ -275,12 +285,94 @@ class JobsHandler(base.RequestHandler):
 
     def get(self):
         """
-        List all jobs.
+        .. http:get:: /api/jobs
+
+            List jobs, streamed as a JSON array.
+
+            Without a limit, every matching job is returned. With one, a Link header with rel="next" is sent
+            when there are more jobs; follow it to get the next page.
+
+            :query states: only list jobs in one of these states
+            :query tags: only list jobs with one of these tags
+            :query gear: only list jobs of one of these gears
+            :query sort: "_id" (the default) or "modified". Jobs modified during a listing sorted by modified can move between pages.
+            :query limit: maximum number of jobs to return, up to 1000
+            :query after: continue a listing, as given in the Link header
+            :query fields: comma-separated fields to return; _id and the sort fields are always included
+
+            :statuscode 200: no error
+            :statuscode 400: malformed parameters
+
+            **Example request**:
+
+            .. sourcecode:: http
+
+                GET /api/jobs?states=failed&limit=100&fields=name,state HTTP/1.1
+
+            **Example response**:
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json; charset=utf-8
+                Link: <https://localhost/api/jobs?states=failed&limit=100&fields=name%2Cstate&after=573cb66b135d87002660597c>; rel="next"
+                [
+                    {
+                        "_id": "573cb66b135d87002660597b",
+                        "name": "dcm_convert",
+                        "state": "failed"
+                    },
+                    ...
+                ]
         """
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
 
-        return list(config.db.jobs.find())
+        sort = self.get_param('sort', '_id')
+        if sort not in PAGE_SORTS:
+            self.abort(400, 'sort must be one of ' + ', '.join(sorted(PAGE_SORTS)))
+
+        limit = self.get_param('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if limit < 1 or limit > MAX_PAGE_SIZE:
+                self.abort(400, 'limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+
+        after = self.get_param('after')
+        if after is not None:
+            try:
+                after = Queue.parse_page_token(after, sort)
+            except ValueError as e:
+                self.abort(400, str(e))
+
+        fields = self.get_param('fields')
+        if fields is not None:
+            fields = [f for f in fields.split(',') if f]
+
+        cursor = Queue.find_jobs(
+            states=self.request.GET.getall('states'),
+            tags=self.request.GET.getall('tags'),
+            gears=self.request.GET.getall('gear'),
+            sort=sort, after=after, fields=fields,
+            # One extra job tells whether there is a next page
+            limit=limit + 1 if limit else None
+        )
+
+        if limit:
+            jobs = list(cursor)
+            if len(jobs) > limit:
+                jobs = jobs[:limit]
+                params = [(k, v.encode('utf-8')) for k, v in self.request.GET.items() if k != 'after']
+                params.append(('after', Queue.page_token(jobs[-1], sort)))
+                self.response.headers['Link'] = '<{}?{}>; rel="next"'.format(self.request.path_url, urllib.urlencode(params))
+        else:
+            jobs = cursor
+
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.app_iter = encoder.json_list_stream(jobs)
 
     def add(self):
         """
@@ -314,7 +406,9 @@ class JobsHandler(base.RequestHandler):
 
                     "tags": [
                         "ad-hoc"
-                    ]
+                    ],
+
+                    "priority": 0
                 }
 
             **Example response**:
@@ -342,6 +436,10 @@ class JobsHandler(base.RequestHandler):
         tags            = submit.get('tags', None)
         attempt_n       = submit.get('attempt_n', 1)
         previous_job_id = submit.get('previous_job_id', None)
+        priority        = submit.get('priority', 0)
+
+        if isinstance(priority, bool) or not isinstance(priority, (int, long)):
+            self.abort(400, 'Job priority must be an integer')
 
         # Add destination container, or select one
         destination = None
@@ -357,7 +455,7 @@ class JobsHandler(base.RequestHandler):
                 inputs[x].check_access(self.uid, 'ro')
             destination.check_access(self.uid, 'rw')
 
-        job = Job(gear_name, inputs, destination=destination, tags=tags, attempt=attempt_n, previous_job_id=previous_job_id)
+        job = Job(gear_name, inputs, destination=destination, tags=tags, attempt=attempt_n, previous_job_id=previous_job_id, priority=priority)
         result = job.insert()
 
         return { "_id": result }
@@ -368,7 +466,43 @@ class JobsHandler(base.RequestHandler):
 
         return Queue.get_statistics()
 
+    def reconcile_stats(self):
+        """
+        .. http:post:: /api/jobs/stats/reconcile
+
+            Recount the job statistics from scratch, correct the maintained counters, and return the drift found.
+            Should be called periodically.
+
+            **Example response**:
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json; charset=utf-8
+                {
+                    "timestamp": "2016-06-01T12:00:00+00:00",
+                    "drift": 0
+                }
+        """
+
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        return stats.reconcile()
+
     def next(self):
+        """
+        .. http:get:: /api/jobs/next
+
+            Start the next pending job and return it.
+
+            :query tags: only start jobs with one of these tags
+            :query count: start up to this many jobs, and return them as a list. An empty list means there are no jobs to process.
+
+            :statuscode 200: no error
+            :statuscode 400: no jobs to process, when count is not given
+        """
+
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
 
@@ -376,6 +510,16 @@ class JobsHandler(base.RequestHandler):
         if len(tags) <= 0:
             tags = None
 
+        count = self.get_param('count')
+        if count is not None:
+            try:
+                count = int(count)
+            except ValueError:
+                count = 0
+            if count < 1 or count > MAX_JOBS_PER_CLAIM:
+                self.abort(400, 'count must be between 1 and {}'.format(MAX_JOBS_PER_CLAIM))
+            return Queue.start_jobs(tags=tags, count=count)
+
         job = Queue.start_job(tags=tags)
 
         if job is None:
@@ -383,6 +527,109 @@ class JobsHandler(base.RequestHandler):
         else:
             return job
 
+    def events(self):
+        """
+        .. http:get:: /api/jobs/events
+
+            Stream job state changes as Server-Sent Events, starting from now or after the Last-Event-ID header.
+            Each stream closes after a minute; EventSource clients reconnect and resume by themselves.
+            Each server process serves a limited number of streams at once; beyond that, subscribers get a 503
+            with a Retry-After header.
+
+            :query job: only send events for these job ids
+            :query tags: only send events for jobs with one of these tags
+
+            :statuscode 200: no error
+            :statuscode 503: too many open streams, retry after the number of seconds in Retry-After
+
+            **Example response**:
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: text/event-stream; charset=utf-8
+
+                retry: 1000
+
+                id: 574f3d8a8d5a4a0013a39a5e
+                event: job
+                data: {"job": "573cb66b135d87002660597c", "name": "dcm_convert", "tags": ["dcm_convert"], "state": "running", "previous_state": "pending", "timestamp": "2016-06-01T12:00:00+00:00"}
+        """
+
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        last_event_id = self.request.headers.get('Last-Event-ID') or self.get_param('last_event_id')
+        if last_event_id is not None:
+            try:
+                last_event_id = bson.objectid.ObjectId(last_event_id)
+            except bson.errors.InvalidId:
+                self.abort(400, 'Malformed Last-Event-ID')
+
+        job_events = events.tail(last_event_id, job_ids=self.request.GET.getall('job'), tags=self.request.GET.getall('tags'))
+        stream = events.open_stream(self._event_stream(job_events))
+        if stream is None:
+            self.response.headers['Retry-After'] = str(events.RETRY_AFTER)
+            self.abort(503, 'Too many event streams open, retry later')
+
+        self.response.headers['Content-Type'] = 'text/event-stream; charset=utf-8'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.app_iter = stream
+
+    @staticmethod
+    def _event_stream(job_events):
+        yield encoder.sse_pack({'retry': 1000})
+        for event in job_events:
+            if event is None:
+                # Keepalive comment
+                yield ':\n\n'
+            else:
+                yield encoder.json_sse_pack({'id': str(event.pop('_id')), 'event': 'job', 'data': event})
+
+    def heartbeat(self):
+        """
+        .. http:post:: /api/jobs/heartbeat
+
+            Mark running jobs as alive, so they are not reaped as orphans.
+            Ids of jobs that are not running are ignored.
+
+            :statuscode 200: no error
+            :statuscode 400: malformed job ids
+
+            **Example request**:
+
+            .. sourcecode:: http
+
+                POST /api/jobs/heartbeat HTTP/1.1
+                {
+                    "ids": ["573cb66b135d87002660597c", "573cb66b135d87002660597d"]
+                }
+
+            **Example response**:
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json; charset=utf-8
+                {
+                    "updated": 2
+                }
+        """
+
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        body = self.request.json
+        ids = body.get('ids') if isinstance(body, dict) else None
+        if not isinstance(ids, list):
+            self.abort(400, 'Expected a list of job ids')
+        try:
+            updated = Queue.heartbeat(ids)
+        except (bson.errors.InvalidId, TypeError):
+            self.abort(400, 'Malformed job id')
+
+        return { 'updated': updated }
+
     def reap_stale(self):
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
@@ -8,13 +8,28 @@ import datetime
 from ..dao.containerutil import create_filereference_from_dictionary, create_containerreference_from_dictionary, create_containerreference_from_filereference
 
 from .. import config
+from . import events
 from . import gears
+from . import stats
 
 log = config.log
 
 
+def input_containers(inputs):
+    """
+    Given a job's inputs, as stored, return the distinct containers they live in.
+    """
+
+    containers = []
+    for i in inputs.itervalues():
+        ref = {'type': i['type'], 'id': i['id']}
+        if ref not in containers:
+            containers.append(ref)
+    return containers
+
+
 class Job(object):
-    def __init__(self, name, inputs, destination=None, tags=None, attempt=1, previous_job_id=None, created=None, modified=None, state='pending', request=None, _id=None):
+    def __init__(self, name, inputs, destination=None, tags=None, attempt=1, previous_job_id=None, created=None, modified=None, state='pending', request=None, priority=0, _id=None):
         """
         Creates a job.
 
@@ -38,7 +53,9 @@ class Job(object):
         state: string (optional)
             The state of this job. Defaults to 'pending'.
         request: map (optional)
-            The request that is used for the engine. Generated when job is started.
+            The request that is used for the engine. Generated when job is inserted.
+        priority: integer (optional)
+            Higher priority jobs are started first. Defaults to 0.
         _id: string (optional)
             The database identifier for this job.
         """
@@ -75,6 +92,7 @@ class Job(object):
         self.modified        = modified
         self.state           = state
         self.request         = request
+        self.priority        = priority
         self._id             = _id
 
     @classmethod
@@ -89,7 +107,7 @@ class Job(object):
 
         d['_id'] = str(d['_id'])
 
-        return cls(d['name'], d['inputs'], destination=d['destination'], tags=d['tags'], attempt=d['attempt'], previous_job_id=d.get('previous_job_id', None), created=d['created'], modified=d['modified'], state=d['state'], request=d.get('request', None), _id=d['_id'])
+        return cls(d['name'], d['inputs'], destination=d['destination'], tags=d['tags'], attempt=d['attempt'], previous_job_id=d.get('previous_job_id', None), created=d['created'], modified=d['modified'], state=d['state'], request=d.get('request', None), priority=d.get('priority', 0), _id=d['_id'])
 
     @classmethod
     def get(cls, _id):
@@ -124,15 +142,47 @@ class Job(object):
         if d.get('_id', None):
             d['_id'] = bson.ObjectId(d['_id'])
 
+        # Denormalised so that Queue.search can find jobs by input container with an index
+        d['input_containers'] = input_containers(d['inputs'])
+
         return d
 
     def insert(self):
         if self._id is not None:
             raise Exception('Cannot insert job that has already been inserted')
 
-        result = config.db.jobs.insert_one(self.mongo())
+        result = config.db.jobs.insert_one(self._prepare_insert())
+        stats.record_inserted([self])
+        events.publish([events.event(self, self.state)])
         return result.inserted_id
 
+    @staticmethod
+    def insert_many(jobs):
+        """
+        Insert several new jobs in one batch, returning their ids in order.
+        """
+
+        if any(job._id is not None for job in jobs):
+            raise Exception('Cannot insert job that has already been inserted')
+        if not jobs:
+            return []
+
+        result = config.db.jobs.insert_many([job._prepare_insert() for job in jobs])
+        stats.record_inserted(jobs)
+        events.publish(events.event(job, job.state) for job in jobs)
+        return result.inserted_ids
+
+    def _prepare_insert(self):
+        """
+        Assign the job its id and generate its request, so that starting it takes a single update.
+        Returns the document to insert.
+        """
+
+        # The request embeds the job id, so any request carried over (eg. by a retry) is replaced
+        self._id = str(bson.ObjectId())
+        self.generate_request()
+        return self.mongo()
+
     def generate_request(self, gear=None):
         """
         Generate the job's request, save it to the class, and return it
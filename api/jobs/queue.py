@@ -3,11 +3,16 @@ A simple FIFO queue for jobs.
 """
 
 import bson
+import bson.errors
 import copy
+import calendar
 import pymongo
 import datetime
 
 from .. import config
+from .. import metrics
+from . import events
+from . import stats
 from .jobs import Job
 
 log = config.log
@@ -39,6 +44,22 @@ def max_attempts():
 def retry_on_explicit_fail():
     return config.get_item('queue', 'retry_on_fail')
 
+# Most jobs handed out by a single start_jobs call
+MAX_JOBS_PER_CLAIM = 100
+
+# Keyset pagination orders for find_jobs, each ending in _id so that the order is total
+PAGE_SORTS = {
+    '_id':      [('_id', pymongo.ASCENDING)],
+    'modified': [('modified', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+}
+
+# Highest priority first, then oldest first. Must be kept in sync with the jobs indexes in config.initialize_db.
+DEQUEUE_SORT = [('priority', pymongo.DESCENDING), ('modified', pymongo.ASCENDING)]
+
+# Seconds a running job may go without a heartbeat before it is considered orphaned
+def orphan_timeout():
+    return int(config.get_item('queue', 'orphan_timeout'))
+
 def valid_transition(from_state, to_state):
     return (from_state + ' --> ' + to_state) in JOB_TRANSITIONS or from_state == to_state
 
@@ -69,6 +90,13 @@ class Queue(object):
         if result.modified_count != 1:
             raise Exception('Job modification not saved')
 
+        old_bucket = stats.job_bucket(job)
+        new_bucket = stats.bucket(mutation.get('state', job.state), mutation.get('tags', job.tags), mutation.get('attempt', job.attempt))
+        if new_bucket != old_bucket:
+            stats.record_moved([(old_bucket, new_bucket)])
+        if mutation.get('state', job.state) != job.state:
+            events.publish([events.event(job, mutation['state'], job.state)])
+
         # If the job did not succeed, check to see if job should be retried.
         if 'state' in mutation and mutation['state'] == 'failed' and retry_on_explicit_fail():
             job.state = 'failed'
@@ -119,6 +147,7 @@ class Queue(object):
         Will return None if there are no jobs to offer.
 
         Potential jobs must match at least one tag, if provided.
+        Jobs are offered highest priority first, then oldest first.
         """
 
         query = { 'state': 'pending' }
@@ -126,7 +155,8 @@ class Queue(object):
         if tags is not None:
             query['tags'] = {'$in': tags }
 
-        # First, atomically mark document as running.
+        # Jobs carry their request from insertion, so marking one as running also hands it out.
+        # Served by the (state, priority, modified) and (state, tags, priority, modified) indexes.
         result = config.db.jobs.find_one_and_update(
             query,
 
@@ -134,20 +164,47 @@ class Queue(object):
                 'state': 'running',
                 'modified': datetime.datetime.utcnow()}
             },
-            sort=[('modified', 1)],
+            sort=DEQUEUE_SORT,
             return_document=pymongo.collection.ReturnDocument.AFTER
         )
 
         if result is None:
             return None
 
-        job = Job.load(result)
+        stats.record_moved([(stats.bucket('pending', result['tags'], result['attempt']), stats.job_bucket(result))])
+        events.publish([events.event(result, 'running', 'pending')])
+        if result.get('created') is not None:
+            metrics.JOB_DEQUEUE_LATENCY.observe((result['modified'] - result['created']).total_seconds())
+
+        if result.get('request') is None:
+            # Job was queued before requests were generated on insert
+            result = Queue._store_request(result)
+
+        return result
+
+    @staticmethod
+    def start_jobs(tags=None, count=1):
+        """
+        Start up to count jobs, as start_job does, and return them in dequeue order.
+        Each job is claimed atomically on its own, so concurrent callers never receive the same job.
+        """
+
+        started = []
+        for _ in xrange(min(count, MAX_JOBS_PER_CLAIM)):
+            job = Queue.start_job(tags=tags)
+            if job is None:
+                break
+            started.append(job)
+        return started
+
+    @staticmethod
+    def _store_request(doc):
+        job = Job.load(copy.deepcopy(doc))
         request = job.generate_request()
 
-        # Second, update document to store formula request.
         result = config.db.jobs.find_one_and_update(
             {
-                '_id': bson.ObjectId(job._id)
+                '_id': doc['_id']
             },
             { '$set': {
                 'request': request }
@@ -166,15 +223,7 @@ class Queue(object):
         Search the queue for jobs that mention a specific container and (optionally) match some set of states or tags.
         """
 
-        filter = """
-            for (var key in this['inputs']) {
-                var ct = this['inputs'][key]['type']
-                var ci = this['inputs'][key]['id']
-                if (ct === '$cT$' && ci == '$cI$') { return true }
-            }
-        """.replace('$cT$', container.type).replace('$cI$', container.id)
-
-        query = { "$where": filter }
+        query = {'input_containers': {'$elemMatch': {'type': container.type, 'id': container.id}}}
 
         if states is not None and len(states) > 0:
             query['state'] = {"$in": states}
@@ -187,33 +236,148 @@ class Queue(object):
             ('modified', pymongo.DESCENDING)
         ])
 
+    @staticmethod
+    def find_jobs(states=None, tags=None, gears=None, sort='_id', after=None, limit=None, fields=None):
+        """
+        Return a cursor over jobs matching all the given filters, in keyset order.
+
+        sort is a PAGE_SORTS key. after is a page_token() of the last job of the previous page.
+        fields limits the fields returned; _id and the sort keys are always included.
+        """
+
+        query = {}
+        if states:
+            query['state'] = {'$in': states}
+        if tags:
+            query['tags'] = {'$in': tags}
+        if gears:
+            query['name'] = {'$in': gears}
+
+        if after is not None:
+            if sort == 'modified':
+                modified, _id = after
+                query['$or'] = [
+                    {'modified': {'$gt': modified}},
+                    {'modified': modified, '_id': {'$gt': _id}},
+                ]
+            else:
+                query['_id'] = {'$gt': after}
+
+        projection = None
+        if fields:
+            projection = list(set(fields) | set(key for key, _ in PAGE_SORTS[sort]))
+
+        cursor = config.db.jobs.find(query, projection).sort(PAGE_SORTS[sort])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    @staticmethod
+    def page_token(doc, sort):
+        """
+        Return the string clients pass back to continue a find_jobs listing after this job.
+        """
+        if sort == 'modified':
+            # Mongo stores milliseconds, so the token is exact
+            modified = doc['modified']
+            millis = calendar.timegm(modified.utctimetuple()) * 1000 + modified.microsecond // 1000
+            return '{}:{}'.format(millis, doc['_id'])
+        return str(doc['_id'])
+
+    @staticmethod
+    def parse_page_token(token, sort):
+        """
+        Inverse of page_token. Raises ValueError if the token is malformed.
+        """
+        try:
+            if sort == 'modified':
+                millis, _id = token.split(':')
+                modified = datetime.datetime.utcfromtimestamp(0) + datetime.timedelta(milliseconds=int(millis))
+                return modified, bson.ObjectId(_id)
+            return bson.ObjectId(token)
+        except (bson.errors.InvalidId, TypeError):
+            raise ValueError('Malformed page token ' + token)
+
     @staticmethod
     def get_statistics():
         """
         Return a variety of interesting information about the job queue.
+        Read from the counters in jobs/stats.py, which are maintained as jobs change.
         """
 
+        counts, by_tag, permafailed = stats.get_counts(max_attempts())
+
         # Count jobs by state
-        result = config.db.jobs.aggregate([{"$group": {"_id": "$state", "count": {"$sum": 1}}}])
-        # Map mongo result to a useful object
         by_state = {s: 0 for s in JOB_STATES}
-        by_state.update({r['_id']: r['count'] for r in result})
-
-        # Count jobs by tag grouping
-        result = list(config.db.jobs.aggregate([{"$group": {"_id": "$tags", "count": {"$sum": 1}}}]))
-        by_tag = []
-        for r in result:
-            by_tag.append({'tags': r['_id'], 'count': r['count']})
-
-        # Count jobs that will not be retried
-        permafailed = config.db.jobs.count({"attempt": {"$gte": max_attempts()}, "state":"failed"})
+        by_state.update(counts)
 
         return {
             'by-state': by_state,
             'by-tag': by_tag,
-            'permafailed': permafailed
+            'permafailed': permafailed,
+            'reconciliation': stats.get_reconciliation(),
         }
 
+    @staticmethod
+    def retry_many(jobs):
+        """
+        Given failed jobs, retry or permanently fail each of them as retry() would, with one query and one insert.
+        Jobs that have already been retried are skipped. Returns the ids of the new jobs.
+        """
+
+        to_retry = []
+        for job in jobs:
+            if job.state != 'failed':
+                raise Exception('Can only retry a job that is failed')
+            if job.attempt >= max_attempts():
+                log.info('Permanently failed job %s (after %d attempts)' % (job._id, job.attempt))
+            else:
+                to_retry.append(job)
+
+        if not to_retry:
+            return []
+
+        # Same best-hope check as retry(), for the whole batch
+        retried = config.db.jobs.find({'previous_job_id': {'$in': [job._id for job in to_retry]}}, ['previous_job_id'])
+        retried = set(doc['previous_job_id'] for doc in retried)
+
+        now = datetime.datetime.utcnow()
+        new_jobs = []
+        for job in to_retry:
+            if job._id in retried:
+                log.warning('Job %s has already been retried' % job._id)
+                continue
+
+            new_job = copy.deepcopy(job)
+            new_job._id = None
+            new_job.previous_job_id = job._id
+
+            new_job.state = 'pending'
+            new_job.attempt += 1
+
+            new_job.created = now
+            new_job.modified = now
+            new_jobs.append(new_job)
+
+        new_ids = Job.insert_many(new_jobs)
+        for job, new_id in zip(new_jobs, new_ids):
+            log.info('respawned job %s as %s (attempt %d)' % (job.previous_job_id, new_id, job.attempt))
+
+        return new_ids
+
+    @staticmethod
+    def heartbeat(job_ids):
+        """
+        Mark running jobs as alive, so they are not reaped as orphans.
+        Returns the number of jobs updated; ids of jobs that are not running are ignored.
+        """
+
+        result = config.db.jobs.update_many(
+            {'_id': {'$in': [bson.ObjectId(_id) for _id in job_ids]}, 'state': 'running'},
+            {'$set': {'modified': datetime.datetime.utcnow()}}
+        )
+        return result.modified_count
+
     @staticmethod
     def scan_for_orphans():
         """
@@ -221,26 +385,26 @@ class Queue(object):
         Should be called periodically.
         """
 
-        orphaned = 0
-
-        while True:
-            doc = config.db.jobs.find_one_and_update(
-                {
-                    'state': 'running',
-                    'modified': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=100)},
-                },
-                {
-                    '$set': {
-                        'state': 'failed', },
-                },
-                return_document=pymongo.collection.ReturnDocument.AFTER
-            )
-
-            if doc is None:
-                break
-            else:
-                orphaned += 1
-                j = Job.load(doc)
-                Queue.retry(j)
+        # Mongo stores milliseconds; truncate so the timestamp can be matched below
+        now = datetime.datetime.utcnow()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        query = {
+            'state': 'running',
+            'modified': {'$lt': now - datetime.timedelta(seconds=orphan_timeout())},
+        }
 
-        return orphaned
+        # Served by the (state, modified) index
+        ids = [doc['_id'] for doc in config.db.jobs.find(query, ['_id'])]
+        if not ids:
+            return 0
+
+        # Repeat the query's conditions, so a job that sent a heartbeat meanwhile is left alone.
+        # The reap timestamp then identifies exactly the jobs this scan failed.
+        query['_id'] = {'$in': ids}
+        config.db.jobs.update_many(query, {'$set': {'state': 'failed', 'modified': now}})
+        orphans = [Job.load(doc) for doc in config.db.jobs.find({'_id': {'$in': ids}, 'state': 'failed', 'modified': now})]
+        stats.record_moved((stats.bucket('running', job.tags, job.attempt), stats.job_bucket(job)) for job in orphans)
+        events.publish(events.event(job, 'failed', 'running') for job in orphans)
+
+        Queue.retry_many(orphans)
+        return len(orphans)
@@ -1,6 +1,9 @@
 import fnmatch
 import json
+import os
+import re
 
+from .. import cache
 from .. import config
 from ..dao.containerutil import FileReference
 
@@ -38,6 +41,11 @@ MATCH_TYPES = [
     'container.has-type'
 ]
 
+# Maps project id -> RuleSet of the project's rules followed by the base rules.
+# Invalidated by this worker on rule changes; other workers pick them up once their entry expires.
+RULESET_CACHE_TTL = 60
+ruleset_cache = cache.TTLCache(maxsize=1000, ttl=RULESET_CACHE_TTL)
+
 def get_base_rules():
     """
     Fetch the install-global gear rules from the database
@@ -112,10 +120,182 @@ def eval_rule(rule, file_, container):
 
     return True
 
-def queue_job_legacy(db, algorithm_id, input):
+def _compile_match(match_type, match_param):
+    """
+    Return a function(file_, container) equivalent to eval_match for this match entry.
+    """
+
+    if match_type == 'file.type':
+        def match(file_, container):
+            try:
+                return file_['type'] == match_param
+            except KeyError:
+                _log_file_key_error(file_, container, 'has no type key')
+                return False
+
+    elif match_type == 'file.name':
+        # Same as fnmatch.fnmatch, minus its per-call translation and pattern cache lookup
+        regex_match = re.compile(fnmatch.translate(os.path.normcase(match_param))).match
+        if os.name == 'posix':
+            # normcase is a no-op here, and as costly as the match itself
+            def match(file_, container):
+                return regex_match(file_['name']) is not None
+        else:
+            def match(file_, container):
+                return regex_match(os.path.normcase(file_['name'])) is not None
+
+    elif match_type == 'file.measurements':
+        def match(file_, container):
+            try:
+                return match_param in file_['measurements']
+            except KeyError:
+                _log_file_key_error(file_, container, 'has no measurements key')
+                return False
+
+    elif match_type == 'container.measurement':
+        def match(file_, container):
+            return container['measurement'] == match_param
+
+    elif match_type == 'container.has-type':
+        def match(file_, container):
+            for c_file in container['files']:
+                if match_param in c_file['measurements']:
+                    return True
+            return False
+
+    else:
+        # Raise on evaluation rather than compilation, as eval_match does
+        def match(file_, container):
+            raise Exception('Unimplemented match type ' + match_type)
+
+    return match
+
+def _compile_any(matches):
+    """
+    Compile an 'any' array, folding its file.type and file.measurements entries into one set lookup each.
+    The set lookup takes the place of the first entry it replaces.
+    """
+
+    compiled = []
+    types = set()
+    measurements = set()
+
+    for match in matches:
+        match_type, match_param = match[0], match[1]
+
+        if match_type == 'file.type':
+            if not types:
+                compiled.append(_compile_type_set(types))
+            types.add(match_param)
+
+        elif match_type == 'file.measurements':
+            if not measurements:
+                compiled.append(_compile_measurement_set(measurements))
+            measurements.add(match_param)
+
+        else:
+            compiled.append(_compile_match(match_type, match_param))
+
+    return compiled
+
+def _compile_type_set(types):
+    def match(file_, container):
+        try:
+            return file_['type'] in types
+        except KeyError:
+            _log_file_key_error(file_, container, 'has no type key')
+            return False
+    return match
+
+def _compile_measurement_set(measurements):
+    def match(file_, container):
+        try:
+            return not measurements.isdisjoint(file_['measurements'])
+        except KeyError:
+            _log_file_key_error(file_, container, 'has no measurements key')
+            return False
+    return match
+
+class CompiledRule(object):
+    """
+    A rule with its matches compiled; matches() gives the same result as eval_rule.
+    """
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.any  = _compile_any(rule.get('any', []))
+        self.all  = [_compile_match(match[0], match[1]) for match in rule.get('all', [])]
+
+    def matches(self, file_, container):
+        if self.any:
+            for match in self.any:
+                if match(file_, container):
+                    break
+            else:
+                return False
+
+        for match in self.all:
+            if not match(file_, container):
+                return False
+
+        return True
+
+class RuleSet(object):
+    """
+    An ordered list of compiled rules.
+    """
+
+    def __init__(self, rules):
+        self.rules = [CompiledRule(rule) for rule in rules]
+
+    def matching_rules(self, file_, container):
+        """
+        Return the rules, in order, that should spawn a job for this file.
+        """
+        return [compiled.rule for compiled in self.rules if compiled.matches(file_, container)]
+
+def get_ruleset(db, container):
+    """
+    Return the cached RuleSet that applies to files in this container.
+    """
+
+    # Resolve the project, as get_rules_for_container does, but only fetch its rules on a cache miss
+    if 'project' in container:
+        project_id, project = container['project'], None
+    elif 'session' in container:
+        # Acquisition without its ancestor ids
+        session = db.sessions.find_one({'_id': container['session']}, ['project'])
+        project_id, project = session['project'], None
+    else:
+        # Assume container is a project, or a collection (which currently cannot have a rules property)
+        project_id, project = container['_id'], container
+
+    key = str(project_id)
+    ruleset = ruleset_cache.get(key)
+    if ruleset is None:
+        if project is None:
+            project = db.projects.find_one({'_id': project_id}, ['rules']) or {}
+
+        # Hardcoded rules that cannot be removed or changed come last
+        ruleset = RuleSet(project.get('rules', []) + get_base_rules())
+        ruleset_cache.set(key, ruleset)
+
+    return ruleset
+
+def invalidate_rules(project_id=None):
+    """
+    Drop this worker's compiled rules for a project, or for every project if none is given.
+    """
+
+    if project_id is None:
+        ruleset_cache.clear()
+    else:
+        ruleset_cache.pop(str(project_id))
+
+def create_job_legacy(algorithm_id, input):
     """
     Tie together logic used from the no-manifest, single-file era.
-    Takes a single FileReference instead of a map.
+    Takes a single FileReference instead of a map, and returns the Job without inserting it.
     """
 
     gear = gears.get_gear_by_name(algorithm_id)
@@ -129,8 +309,14 @@ def queue_job_legacy(db, algorithm_id, input):
         input_name: input
     }
 
-    job = Job(algorithm_id, inputs)
-    return job.insert()
+    return Job(algorithm_id, inputs)
+
+def queue_job_legacy(db, algorithm_id, input):
+    """
+    Create and insert a job as create_job_legacy does, returning its id.
+    """
+
+    return create_job_legacy(algorithm_id, input).insert()
 
 def create_jobs(db, container, container_type, file_):
     """
@@ -138,36 +324,36 @@ def create_jobs(db, container, container_type, file_):
     Returns the algorithm names that were queued.
     """
 
-    job_list = []
+    return create_jobs_for_files(db, container, container_type, [file_])
 
-    # Get configured rules for this project
-    rules = get_rules_for_container(db, container)
+def create_jobs_for_files(db, container, container_type, files):
+    """
+    Check all rules that apply to each of these files in the container, and enqueue the jobs that should be run.
+    The jobs are inserted in one batch. Returns the algorithm names that were queued, in file order.
+    """
 
-    # Add hardcoded rules that cannot be removed or changed
-    for hardcoded_rule in get_base_rules():
-        rules.append(hardcoded_rule)
+    jobs = []
+    ruleset = get_ruleset(db, container)
 
-    for rule in rules:
-        if eval_rule(rule, file_, container):
-            alg_name = rule['alg']
+    for file_ in files:
+        for rule in ruleset.matching_rules(file_, container):
             input = FileReference(type=container_type, id=str(container['_id']), name=file_['name'])
+            jobs.append(create_job_legacy(rule['alg'], input))
 
-            queue_job_legacy(db, alg_name, input)
-            job_list.append(alg_name)
-
-    return job_list
+    Job.insert_many(jobs)
+    return [job.name for job in jobs]
 
 # TODO: consider moving to a module that has a variety of hierarchy-management helper functions
 def get_rules_for_container(db, container):
     """
     Recursively walk the hierarchy until the project object is found.
     """
-    if 'session' in container:
-        session = db.sessions.find_one({'_id': container['session']})
-        return get_rules_for_container(db, session)
-    elif 'project' in container:
+    if 'project' in container:
         project = db.projects.find_one({'_id': container['project']})
         return get_rules_for_container(db, project)
+    elif 'session' in container:
+        session = db.sessions.find_one({'_id': container['session']})
+        return get_rules_for_container(db, session)
     else:
         # Assume container is a project, or a collection (which currently cannot have a rules property)
         return container.get('rules', [])
@@ -0,0 +1,146 @@
+"""
+Materialised job queue statistics.
+
+Jobs are counted in buckets of (state, tags, attempt), kept in the jobstats collection and updated with $inc
+wherever the queue inserts jobs or changes them. Queue.get_statistics reads the buckets instead of aggregating
+over every job. reconcile() recounts from the jobs collection, corrects the buckets and records how far they
+had drifted.
+"""
+
+import json
+import collections
+import datetime
+
+import pymongo
+import pymongo.errors
+
+from .. import config
+
+log = config.log
+
+# Key of the reconciliation record in the singletons collection
+RECONCILE_KEY = 'jobstats'
+
+
+def bucket(state, tags, attempt):
+    return (state, tuple(tags), attempt)
+
+def job_bucket(job):
+    """
+    The bucket of a Job or a job document.
+    """
+    if isinstance(job, dict):
+        return bucket(job['state'], job['tags'], job['attempt'])
+    return bucket(job.state, job.tags, job.attempt)
+
+def _bucket_id(key):
+    # Tags can contain characters that can't be used in field names, so buckets are documents keyed by a string
+    return json.dumps(list(key[:1]) + [list(key[1])] + list(key[2:]))
+
+def _inc_op(key, delta):
+    state, tags, attempt = key
+    return pymongo.UpdateOne(
+        {'_id': _bucket_id(key)},
+        {'$inc': {'count': delta}, '$setOnInsert': {'state': state, 'tags': list(tags), 'attempt': attempt}},
+        upsert=True
+    )
+
+def record(changes):
+    """
+    Apply a {bucket: delta} map of count changes.
+    """
+
+    ops = [_inc_op(key, delta) for key, delta in changes.iteritems() if delta != 0]
+
+    if ops:
+        try:
+            config.db.jobstats.bulk_write(ops, ordered=False)
+        except pymongo.errors.PyMongoError:
+            # Counters are advisory; the next reconcile() puts them right
+            log.exception('Could not update job statistics')
+
+def record_inserted(jobs):
+    record(collections.Counter(job_bucket(job) for job in jobs))
+
+def record_moved(pairs):
+    """
+    Record jobs changing bucket, given (old bucket, new bucket) pairs.
+    """
+    changes = collections.Counter()
+    for old, new in pairs:
+        changes[old] -= 1
+        changes[new] += 1
+    record(changes)
+
+def _summarise(buckets, max_attempts):
+    """
+    Given (bucket, count) pairs, return the statistics served by /api/jobs/stats.
+    """
+
+    by_state = collections.Counter()
+    by_tag = collections.OrderedDict()
+    permafailed = 0
+
+    for (state, tags, attempt), count in buckets:
+        if count == 0:
+            continue
+        by_state[state] += count
+        by_tag[tags] = by_tag.get(tags, 0) + count
+        if state == 'failed' and attempt >= max_attempts:
+            permafailed += count
+
+    return by_state, [{'tags': list(tags), 'count': count} for tags, count in by_tag.iteritems()], permafailed
+
+def get_counts(max_attempts):
+    buckets = ((bucket(d['state'], d['tags'], d['attempt']), d['count']) for d in config.db.jobstats.find())
+    return _summarise(buckets, max_attempts)
+
+def get_reconciliation():
+    """
+    Return the record left by the last reconcile(), or None if it has never run.
+    """
+    doc = config.db.singletons.find_one({'_id': RECONCILE_KEY})
+    if doc is not None:
+        doc.pop('_id')
+    return doc
+
+def aggregate():
+    """
+    Count every job by bucket, with a full aggregation over the jobs collection.
+    """
+
+    result = config.db.jobs.aggregate([
+        {'$group': {'_id': {'state': '$state', 'tags': '$tags', 'attempt': '$attempt'}, 'count': {'$sum': 1}}}
+    ])
+    return dict((bucket(r['_id']['state'], r['_id'].get('tags') or [], r['_id'].get('attempt')), r['count']) for r in result)
+
+def reconcile():
+    """
+    Recount the jobs, correct the counters to match and record the drift.
+
+    Drift is the total absolute difference between the counters and the recount. Jobs that change while this
+    runs can show up as drift, so small values are expected on a busy queue.
+    """
+
+    started = datetime.datetime.utcnow()
+    actual = aggregate()
+    counted = dict((bucket(d['state'], d['tags'], d['attempt']), d['count']) for d in config.db.jobstats.find())
+
+    drift = 0
+    ops = []
+    for key in set(actual) | set(counted):
+        difference = actual.get(key, 0) - counted.get(key, 0)
+        if difference:
+            # Applied as an increment, so changes recorded while this ran are kept
+            drift += abs(difference)
+            ops.append(_inc_op(key, difference))
+
+    if ops:
+        config.db.jobstats.bulk_write(ops, ordered=False)
+    config.db.jobstats.delete_many({'count': 0})
+
+    result = {'timestamp': started, 'drift': drift}
+    config.db.singletons.replace_one({'_id': RECONCILE_KEY}, result, upsert=True)
+    if drift:
+        log.warning('Job statistics had drifted by {}'.format(drift))
+    return result
@@ -0,0 +1,319 @@
+"""
+Counters and histograms, served at /api/metrics in the Prometheus text format.
+
+Each uwsgi worker keeps its own values in memory and a background thread writes them to a file of its own in the
+spool directory (core.metrics_path, by default a directory under the system tempdir) every FLUSH_INTERVAL seconds.
+/api/metrics adds up the files of every worker, so the values are those of the whole server, at most
+FLUSH_INTERVAL seconds old. So that counters never go down, the files of workers that have exited are not dropped
+but folded, when metrics are served, into a single file per host that keeps their totals.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import time
+import socket
+import tempfile
+import threading
+import collections
+
+from . import config
+
+log = config.log
+
+# Seconds between writes of a worker's values to the spool directory
+FLUSH_INTERVAL = 10
+
+# Name of the file, per host, holding the totals of exited workers
+RETIRED_FILENAME = '{}-retired.json'
+
+# Upper bounds, in seconds, of the request duration histogram buckets
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric(object):
+    type_ = None
+
+    def __init__(self, registry, name, help_, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        registry.add(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def empty(self):
+        raise NotImplementedError
+
+    def combine(self, total, value):
+        raise NotImplementedError
+
+    def samples(self, key, value):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry.update(self, self._key(labels), lambda value: value + amount)
+
+    def empty(self):
+        return 0
+
+    def combine(self, total, value):
+        return total + value
+
+    def samples(self, key, value):
+        yield self.name, zip(self.labels, key), value
+
+
+class Histogram(Metric):
+    type_ = 'histogram'
+
+    def __init__(self, registry, name, help_, buckets, labels=()):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(registry, name, help_, labels)
+
+    def observe(self, amount, **labels):
+        def add(value):
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    value[i] += 1
+                    break
+            else:
+                value[len(self.buckets)] += 1
+            value[-1] += amount
+            return value
+        self.registry.update(self, self._key(labels), add)
+
+    def empty(self):
+        # A count per bucket, then one for +Inf, then the sum of observations
+        return [0] * (len(self.buckets) + 2)
+
+    def combine(self, total, value):
+        return [t + v for t, v in zip(total, value)]
+
+    def samples(self, key, value):
+        labels = zip(self.labels, key)
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), value):
+            cumulative += count
+            yield self.name + '_bucket', labels + [('le', str(bound))], cumulative
+        yield self.name + '_sum', labels, value[-1]
+        yield self.name + '_count', labels, cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.values = {} # name -> {label values: value}, for this process only
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        self.values[metric.name] = {}
+
+    def update(self, metric, key, f):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._start()
+            values = self.values[metric.name]
+            values[key] = f(values.get(key, metric.empty()))
+
+    def _start(self):
+        # First use in this process. Values inherited from before a fork are the parent's to report.
+        self.pid = os.getpid()
+        self.filename = '{}-{}-{}.json'.format(socket.gethostname(), self.pid, int(time.time()))
+        for values in self.values.itervalues():
+            values.clear()
+        flusher = threading.Thread(target=self._flush_loop, name='metrics-flush')
+        flusher.daemon = True
+        flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception: # pylint: disable=broad-except
+                log.exception('Could not write metrics to {}'.format(spool_path()))
+
+    def flush(self):
+        """
+        Write this process's values to its file in the spool directory.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            snapshot = dict((name, values.items()) for name, values in self.values.iteritems())
+
+        path = spool_path()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # Written aside and renamed, so that readers never see a partial file
+        tmp_path = os.path.join(path, '.' + self.filename)
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(tmp_path, os.path.join(path, self.filename))
+
+    def collect(self):
+        """
+        Return {name: {label values: value}}, added up over every file in the spool directory.
+        """
+        totals = collections.OrderedDict((name, {}) for name in self.metrics)
+        path = spool_path()
+        filenames = os.listdir(path) if os.path.isdir(path) else []
+        for filename in filenames:
+            if filename.startswith('.') or not filename.endswith('.json'):
+                continue
+            snapshot = _read(os.path.join(path, filename))
+            if snapshot is not None:
+                self._add(totals, snapshot)
+        return totals
+
+    def retire(self):
+        """
+        Fold the files of this host's exited workers into its retired file, and remove them.
+        """
+        path = spool_path()
+        if not os.path.isdir(path):
+            return
+        hostname = socket.gethostname()
+        retired_path = os.path.join(path, RETIRED_FILENAME.format(hostname))
+
+        # Serialized between workers, so that none of them folds a file in twice
+        with open(os.path.join(path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            dead = []
+            for filename in os.listdir(path):
+                pid = _worker_pid(filename, hostname)
+                if pid is not None and not _is_running(pid):
+                    dead.append(filename)
+            if not dead:
+                return
+
+            totals = dict((name, {}) for name in self.metrics)
+            retired = _read(retired_path) or {}
+            self._add(totals, retired)
+            for filename in dead:
+                snapshot = _read(os.path.join(path, filename))
+                if snapshot is not None:
+                    self._add(totals, snapshot)
+
+            tmp_path = os.path.join(path, '.' + RETIRED_FILENAME.format(hostname))
+            with open(tmp_path, 'w') as f:
+                json.dump(dict((name, values.items()) for name, values in totals.iteritems()), f)
+            os.rename(tmp_path, retired_path)
+            for filename in dead:
+                os.remove(os.path.join(path, filename))
+
+    def _add(self, totals, snapshot):
+        for name, values in snapshot.iteritems():
+            metric = self.metrics.get(name)
+            if metric is None:
+                continue
+            for key, value in values:
+                key = tuple(key)
+                totals[name][key] = metric.combine(totals[name].get(key, metric.empty()), value)
+
+    def render(self, gauges=()):
+        """
+        Return every metric, and the given (name, help, [(labels, value)]) gauges, in the text exposition format.
+        """
+        self.flush()
+        try:
+            self.retire()
+        except (IOError, OSError):
+            log.exception('Could not fold the metrics of exited workers in {}'.format(spool_path()))
+        lines = []
+        for name, values in self.collect().iteritems():
+            metric = self.metrics[name]
+            lines += _header(name, metric.help, metric.type_)
+            for key in sorted(values):
+                for sample_name, labels, value in metric.samples(key, values[key]):
+                    lines.append(_sample(sample_name, labels, value))
+        for name, help_, samples in gauges:
+            lines += _header(name, help_, 'gauge')
+            for labels, value in samples:
+                lines.append(_sample(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def spool_path():
+    return config.get_snapshot()['core'].get('metrics_path') or os.path.join(tempfile.gettempdir(), 'scitran-metrics')
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        log.warning('Skipping unreadable metrics file {}'.format(os.path.basename(path)))
+        return None
+
+def _worker_pid(filename, hostname):
+    """
+    Return the pid of the worker that writes filename, if it is a worker's file from this host.
+    """
+    prefix = hostname + '-'
+    if not filename.startswith(prefix) or not filename.endswith('.json'):
+        return None
+    parts = filename[len(prefix):-len('.json')].split('-')
+    if len(parts) != 2 or not parts[0].isdigit():
+        return None
+    return int(parts[0])
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: running, as another user
+        return e.errno == errno.EPERM
+    return True
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _header(name, help_, type_):
+    return ['# HELP {} {}'.format(name, help_), '# TYPE {} {}'.format(name, type_)]
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+    return '{} {}'.format(name, repr(float(value)))
+
+
+registry = Registry()
+
+REQUEST_DURATION = Histogram(
+    registry, 'scitran_request_duration_seconds', 'Time spent handling requests, by route template, not including streaming the response body.',
+    REQUEST_BUCKETS, labels=('route', 'method', 'status')
+)
+UPLOADED_BYTES = Counter(registry, 'scitran_uploaded_bytes_total', 'Bytes of files received.')
+DOWNLOADED_BYTES = Counter(registry, 'scitran_downloaded_bytes_total', 'Bytes of files and archives sent.')
+HASHED_BYTES = Counter(registry, 'scitran_hashed_bytes_total', 'Bytes of uploads hashed.')
+HASH_SECONDS = Counter(registry, 'scitran_hash_seconds_total', 'Time spent hashing uploads, with every requested digest.')
+JOB_DEQUEUE_LATENCY = Histogram(
+    registry, 'scitran_job_dequeue_latency_seconds', 'Time from a job being queued to it being started.',
+    (1, 5, 15, 60, 300, 900, 3600, 14400, 86400)
+)
+
+
+def counted(iterable, counter):
+    """
+    Pass through an iterable of strings, such as a response body, adding their length to counter.
+    """
+    size = 0
+    try:
+        for chunk in iterable:
+            size += len(chunk)
+            yield chunk
+    finally:
+        counter.inc(size)
+        if hasattr(iterable, 'close'):
+            iterable.close()
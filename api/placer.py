@@ -1,6 +1,7 @@
 import bson
 import copy
 import datetime
+import collections
 import dateutil
 import os
 import pymongo
@@ -40,6 +41,9 @@ class Placer(object):
         # Should the caller expect a normal map return, or a generator that gets mapped to Server-Sent Events?
         self.sse            = False
 
+        # File infos saved but not yet written to the database, by container. See save_file().
+        self.pending_files  = collections.OrderedDict()
+
 
     def check(self):
         """
@@ -76,8 +80,8 @@ class Placer(object):
     def save_file(self, field=None, info=None):
         """
         Helper function that moves a file saved via a form field into our CAS.
-        May trigger jobs, if applicable, so this should only be called once we're ready for that.
 
+        The file info is queued for the current target container, and only written by flush_files().
         Requires an augmented file field; see process_upload() for details.
         """
 
@@ -85,12 +89,25 @@ class Placer(object):
         if field is not None:
             files.move_form_file_field_into_cas(field)
 
-        # Update the DB
         if info is not None:
-            hierarchy.upsert_fileinfo(self.container_type, self.id, info)
+            key = (self.container_type, str(self.id))
+            if key not in self.pending_files:
+                self.pending_files[key] = (self.container, [])
+            self.pending_files[key][1].append(info)
+
+    def flush_files(self):
+        """
+        Write all queued file infos, with one bulk write per container.
+        May trigger jobs, if applicable, so this should only be called once we're ready for that.
+        """
+
+        for (container_type, _id), (container, infos) in self.pending_files.iteritems():
+            hierarchy.upsert_fileinfos(container_type, _id, infos)
 
             # Queue any jobs as a result of this upload
-            rules.create_jobs(config.db, self.container, self.container_type, info)
+            rules.create_jobs_for_files(config.db, container, container_type, infos)
+
+        self.pending_files.clear()
 
 
 class TargetedPlacer(Placer):
@@ -113,6 +130,7 @@ class TargetedPlacer(Placer):
         self.saved.append(info)
 
     def finalize(self):
+        self.flush_files()
         return self.saved
 
 
@@ -167,6 +185,7 @@ class UIDPlacer(Placer):
         self.saved.append(info)
 
     def finalize(self):
+        self.flush_files()
         return self.saved
 
 
@@ -215,6 +234,8 @@ class EnginePlacer(Placer):
         self.saved.append(info)
 
     def finalize(self):
+        self.flush_files()
+
         # Updating various properties of the hierarchy; currently assumes acquisitions; might need fixing for other levels.
         # NOTE: only called in EnginePlacer
         bid = bson.ObjectId(self.id)
@@ -446,6 +467,8 @@ class PackfilePlacer(Placer):
         # Extra properties on insert
         insert_map = copy.deepcopy(query)
         insert_map['created'] = self.timestamp
+        insert_map['project'] = bson.ObjectId(self.p_id)
+        insert_map['group'] = self.g_id
         insert_map.update(self.metadata['acquisition'])
 
         acquisition = config.db['acquisition' + 's'].find_one_and_update(
@@ -463,6 +486,7 @@ class PackfilePlacer(Placer):
         self.container	  = acquisition
 
         self.save_file(cgi_field, cgi_info)
+        self.flush_files()
 
         # Delete token
         token  = self.context['token']
@@ -54,6 +54,9 @@ def process_upload(request, strategy, container_type=None, id=None, origin=None,
         MUST send metadata about the files     |          |     X     |        |     X
 
         Creates a packfile from uploaded files |          |           |        |     X
+
+    Extra digests of each file (eg md5, crc32c) can be requested with the "digests" query param.
+    They are returned and stored in the file info under "digests", which includes the CAS algorithm's if requested.
     """
 
     if not isinstance(strategy, Strategy):
@@ -71,75 +74,86 @@ def process_upload(request, strategy, container_type=None, id=None, origin=None,
     if container_type and id:
         container = hierarchy.get_container(container_type, id)
 
+    # Extra digests to compute alongside the CAS hash, as a comma-separated list, eg ?digests=md5,crc32c
+    digests = filter(None, [alg.strip() for alg in request.GET.get('digests', '').split(',')])
+
     # The vast majority of this function's wall-clock time is spent here.
     # Tempdir is deleted off disk once out of scope, so let's hold onto this reference.
-    form, tempdir = files.process_form(request)
-
-    if 'metadata' in form:
-        try:
-            metadata = json.loads(form['metadata'].value)
-        except Exception:
-            raise files.FileStoreException('wrong format for field "metadata"')
-
-    placer_class = strategy.value
-    placer = placer_class(container_type, container, id, metadata, timestamp, origin, context)
-    placer.check()
-
-    # Browsers, when sending a multipart upload, will send files with field name "file" (if sinuglar)
-    # or "file1", "file2", etc (if multiple). Following this convention is probably a good idea.
-    # Here, we accept any
-    file_fields = filter(lambda x: form[x].filename is not None, form)
-
-    # TODO: Change schemas to enabled targeted uploads of more than one file.
-    # Ref docs from placer.TargetedPlacer for details.
-    if strategy == Strategy.targeted and len(file_fields) > 1:
-        raise Exception("Targeted uploads can only send one file")
-
-    for field in file_fields:
-        field = form[field]
-
-        # Augment the cgi.FieldStorage with a variety of custom fields.
-        # Not the best practice. Open to improvements.
-        # These are presumbed to be required by every function later called with field as a parameter.
-        field.path	 = os.path.join(tempdir.name, field.filename)
-        field.size	 = os.path.getsize(field.path)
-        field.hash	 = field.file.get_formatted_hash()
-        field.mimetype = util.guess_mimetype(field.filename) # TODO: does not honor metadata's mime type if any
-        field.modified = timestamp
-
-        # create a file-info map commonly used elsewhere in the codebase.
-        # Stands in for a dedicated object... for now.
-        info = {
-            'name':	 field.filename,
-            'modified': field.modified, #
-            'size':	 field.size,
-            'mimetype': field.mimetype,
-            'hash':	 field.hash,
-            'origin': origin,
-
-            'type': None,
-            'instrument': None,
-            'measurements': [],
-            'tags': [],
-            'metadata': {}
-        }
+    form, tempdir = files.process_form(request, digests=digests)
+
+    try:
+        if 'metadata' in form:
+            try:
+                metadata = json.loads(form['metadata'].value)
+            except Exception:
+                raise files.FileStoreException('wrong format for field "metadata"')
+
+        placer_class = strategy.value
+        placer = placer_class(container_type, container, id, metadata, timestamp, origin, context)
+        placer.check()
+
+        # Browsers, when sending a multipart upload, will send files with field name "file" (if sinuglar)
+        # or "file1", "file2", etc (if multiple). Following this convention is probably a good idea.
+        # Here, we accept any
+        file_fields = filter(lambda x: form[x].filename is not None, form)
+
+        # TODO: Change schemas to enabled targeted uploads of more than one file.
+        # Ref docs from placer.TargetedPlacer for details.
+        if strategy == Strategy.targeted and len(file_fields) > 1:
+            raise Exception("Targeted uploads can only send one file")
+
+        for field in file_fields:
+            field = form[field]
+
+            # Augment the form field with a variety of custom fields.
+            # Not the best practice. Open to improvements.
+            # These are presumbed to be required by every function later called with field as a parameter.
+            field.path	 = os.path.join(tempdir.name, field.filename)
+            field.size	 = os.path.getsize(field.path)
+            field.hash	 = field.file.get_formatted_hash()
+            field.mimetype = util.guess_mimetype(field.filename) # TODO: does not honor metadata's mime type if any
+            field.modified = timestamp
+
+            # create a file-info map commonly used elsewhere in the codebase.
+            # Stands in for a dedicated object... for now.
+            info = {
+                'name':	 field.filename,
+                'modified': field.modified, #
+                'size':	 field.size,
+                'mimetype': field.mimetype,
+                'hash':	 field.hash,
+                'origin': origin,
+
+                'type': None,
+                'instrument': None,
+                'measurements': [],
+                'tags': [],
+                'metadata': {}
+            }
 
-        # Guess upload type by extension on request
-        if request.GET.get('guess-type', '').lower() in ('1', 'true'):
-            info['type'] = files.guess_type_from_filename(info['name'])
+            if digests:
+                info['digests'] = field.file.get_digests()
 
-        placer.process_file_field(field, info)
+            # Guess upload type by extension on request
+            if request.GET.get('guess-type', '').lower() in ('1', 'true'):
+                info['type'] = files.guess_type_from_filename(info['name'])
 
-    # Respond either with Server-Sent Events or a standard json map
-    if placer.sse and not response:
-        raise Exception("Programmer error: response required")
-    elif placer.sse:
-        log.debug('SSE')
-        response.headers['Content-Type'] = 'text/event-stream; charset=utf-8'
-        response.headers['Connection']   = 'keep-alive'
-        response.app_iter = placer.finalize()
-    else:
-        return placer.finalize()
+            placer.process_file_field(field, info)
+
+        # Respond either with Server-Sent Events or a standard json map
+        if placer.sse and not response:
+            raise Exception("Programmer error: response required")
+        elif placer.sse:
+            log.debug('SSE')
+            response.headers['Content-Type'] = 'text/event-stream; charset=utf-8'
+            response.headers['Connection']   = 'keep-alive'
+            response.app_iter = placer.finalize()
+        else:
+            return placer.finalize()
+    except:
+        # Nobody will read the hashes of the remaining files; end their digest threads
+        files.abort_form(form)
+        raise
 
 
 class Upload(base.RequestHandler):
@@ -282,16 +296,17 @@ class Upload(base.RequestHandler):
                     fileinfo['origin'] = self.origin
                     acquisition_obj = hierarchy.add_fileinfo('acquisitions', acquisition_obj['_id'], fileinfo)
 
+            uploaded = []
             for f in acquisition_obj['files']:
                 if f['name'] in file_store.files:
-                    file_ = {
+                    uploaded.append({
                         'name': f['name'],
                         'hash': f['hash'],
                         'type': f.get('type'),
                         'measurements': f.get('measurements', []),
                         'mimetype': f.get('mimetype')
-                    }
-                    rules.create_jobs(config.db, acquisition_obj, 'acquisition', file_)
+                    })
+            rules.create_jobs_for_files(config.db, acquisition_obj, 'acquisition', uploaded)
             return [{'name': k, 'hash': v.info.get('hash'), 'size': v.info.get('size')} for k, v in merged_files.items()]
 
     def clean_packfile_tokens(self):
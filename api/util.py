@@ -6,8 +6,6 @@ import mimetypes
 import os
 import tempdir as tempfile
 import uuid
-import requests
-import hashlib
 
 from . import config
 MIMETYPES = [
@@ -74,19 +72,6 @@ def user_perm(permissions, _id, site=None):
     else:
         return {}
 
-def resolve_gravatar(email):
-    """
-    Given an email, returns a URL if that email has a gravatar set.
-    Otherwise returns None.
-    """
-
-    gravatar = 'https://gravatar.com/avatar/' + hashlib.md5(email).hexdigest() + '?s=512'
-    if requests.head(gravatar, params={'d': '404'}):
-        return gravatar
-    else:
-        return None
-
-
 def container_fileinfo(container, filename):
     for fileinfo in container.get('files', []):
         if fileinfo['filename'] == filename:
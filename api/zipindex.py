@@ -0,0 +1,150 @@
+"""
+Random access to members of zip files in the CAS.
+
+Files in the CAS never change, so a zip's central directory is parsed once and cached by hash.
+Members are then streamed straight from their offset in the archive, without zipfile buffering them.
+"""
+
+import zlib
+import struct
+import zipfile
+import datetime
+import collections
+
+from . import cache
+from . import config
+
+log = config.log
+
+CHUNKSIZE = 2**20
+
+# Maps CAS hash -> ZipIndex. Never needs invalidating; bounded because DICOM zips can list thousands of members.
+index_cache = cache.TTLCache(maxsize=64)
+
+Member = collections.namedtuple('Member', [
+    'filename', 'header_offset', 'compress_type', 'compress_size', 'file_size', 'CRC', 'flag_bits', 'date_time', 'comment'
+])
+
+
+class ZipIndex(object):
+    def __init__(self, comment, members):
+        self.comment = comment
+        self.members = members # OrderedDict of filename -> Member, in archive order
+
+    def info(self):
+        """
+        Return the member and comment listing served by ?info=true.
+        """
+        return {
+            'comment': self.comment,
+            'members': [{
+                'path':      m.filename,
+                'size':      m.file_size,
+                'timestamp': timestamp(m),
+                'comment':   m.comment,
+            } for m in self.members.itervalues()],
+        }
+
+
+def get_index(hash_, filepath):
+    """
+    Return the ZipIndex of the CAS file with the given hash. Raises zipfile.BadZipfile if it isn't a zip.
+    """
+    index = index_cache.get(hash_)
+    if index is None:
+        with zipfile.ZipFile(filepath) as zf:
+            members = collections.OrderedDict()
+            for zi in zf.infolist():
+                members[zi.filename] = Member(
+                    zi.filename, zi.header_offset, zi.compress_type, zi.compress_size, zi.file_size,
+                    zi.CRC, zi.flag_bits, zi.date_time, zi.comment
+                )
+            index = ZipIndex(zf.comment, members)
+        index_cache.set(hash_, index)
+    return index
+
+def timestamp(member):
+    """
+    Return the modification time of a member as a datetime, or None if the archive records an invalid one.
+    """
+    # Kept as zipfile's raw tuple until needed; zeroed DOS dates, as some tools write, are not valid datetimes
+    try:
+        return datetime.datetime(*member.date_time)
+    except ValueError:
+        return None
+
+def is_seekable(member):
+    """
+    Whether byte ranges of a member can be served without decompressing from its start.
+    """
+    return member.compress_type == zipfile.ZIP_STORED
+
+def check_supported(member):
+    """
+    Raise zipfile.BadZipfile if member_stream() can't read this member.
+    """
+    if member.flag_bits & 0x1:
+        raise zipfile.BadZipfile('encrypted zip members are not supported')
+    if member.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise zipfile.BadZipfile('unsupported zip compression method {}'.format(member.compress_type))
+
+def _data_offset(fd, member):
+    # The local header's variable fields can differ from the central directory's, so it has to be read.
+    fd.seek(member.header_offset)
+    header = fd.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipfile('truncated zip member header')
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile('bad zip member header')
+    return member.header_offset + zipfile.sizeFileHeader + fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+def member_stream(filepath, member, start=0, length=None):
+    """
+    Yield the uncompressed contents of a zip member in chunks.
+
+    start and length select a byte range, and are only supported for stored members (see is_seekable).
+    """
+    check_supported(member)
+    if length is None:
+        length = member.file_size - start
+    if (start or length != member.file_size) and not is_seekable(member):
+        raise ValueError('byte ranges are only supported for stored zip members')
+
+    with open(filepath, 'rb') as fd:
+        offset = _data_offset(fd, member)
+
+        if is_seekable(member):
+            fd.seek(offset + start)
+            remaining = length
+            while remaining > 0:
+                chunk = fd.read(min(CHUNKSIZE, remaining))
+                if not chunk:
+                    raise zipfile.BadZipfile('truncated zip member')
+                remaining -= len(chunk)
+                yield chunk
+            return
+
+        fd.seek(offset)
+        decompressor = zlib.decompressobj(-15)
+        remaining = member.compress_size
+        crc = 0
+        while remaining > 0:
+            compressed = fd.read(min(CHUNKSIZE, remaining))
+            if not compressed:
+                raise zipfile.BadZipfile('truncated zip member')
+            remaining -= len(compressed)
+            # Bound each output chunk; DICOM pixel data can compress by orders of magnitude
+            while compressed:
+                chunk = decompressor.decompress(compressed, CHUNKSIZE)
+                compressed = decompressor.unconsumed_tail
+                if chunk:
+                    crc = zlib.crc32(chunk, crc)
+                    yield chunk
+        chunk = decompressor.flush()
+        if chunk:
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+        if crc & 0xffffffff != member.CRC:
+            # Too late to fail the response; the client sees a short or corrupt body
+            log.error('CRC mismatch streaming {} from {}'.format(member.filename, filepath))
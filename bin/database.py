@@ -5,11 +5,14 @@ import copy
 import dateutil.parser
 import json
 import logging
+import pymongo
 import sys
 
 from api import config
+from api.jobs import stats
+from api.jobs.jobs import input_containers
 
-CURRENT_DATABASE_VERSION = 10 # An int that is bumped when a new schema change is made
+CURRENT_DATABASE_VERSION = 14 # An int that is bumped when a new schema change is made
 
 def get_db_version():
 
@@ -311,6 +314,66 @@ def upgrade_to_10():
             job
         )
 
+def upgrade_to_11():
+    """
+    Jobs gain a priority, used to order the queue.
+
+    Jobs without one would sort after every priority 0 job, so give them the default.
+    Pending jobs without a pre-generated request still get one when they are started.
+    """
+
+    config.db.jobs.update_many({'priority': {'$exists': False}}, {'$set': {'priority': 0}})
+
+def upgrade_to_12():
+    """
+    Jobs gain input_containers, an indexed list of the containers their inputs are in.
+    Used by Queue.search instead of a $where scan over every job's inputs.
+    """
+
+    cursor = config.db.jobs.find({'input_containers': {'$exists': False}}, {'inputs': 1})
+    ops = []
+    for job in cursor:
+        ops.append(pymongo.UpdateOne(
+            {'_id': job['_id']},
+            {'$set': {'input_containers': input_containers(job['inputs'])}}
+        ))
+        if len(ops) == 1000:
+            config.db.jobs.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        config.db.jobs.bulk_write(ops, ordered=False)
+
+def upgrade_to_13():
+    """
+    Job statistics are now maintained as counters in the jobstats collection. Count the existing jobs.
+    """
+
+    stats.reconcile()
+
+def upgrade_to_14():
+    """
+    Acquisitions carry the ids of their project and group, so that propagation and lookups
+    from any ancestor are a single indexed query.
+
+    Sessions already have a group, but it was not updated when their project moved; set it from the project first.
+    Every acquisition is updated, including those created by packfile uploads.
+    """
+
+    for project in config.db.projects.find({}, ['group']):
+        config.db.sessions.update_many({'project': project['_id']}, {'$set': {'group': project['group']}})
+
+    ops = []
+    for session in config.db.sessions.find({}, ['project', 'group']):
+        ops.append(pymongo.UpdateMany(
+            {'session': session['_id']},
+            {'$set': {'project': session['project'], 'group': session['group']}}
+        ))
+        if len(ops) == 1000:
+            config.db.acquisitions.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        config.db.acquisitions.bulk_write(ops, ordered=False)
+
 def upgrade_schema():
     """
     Upgrades db to the current schema version
@@ -340,6 +403,14 @@ def upgrade_schema():
             upgrade_to_9()
         if db_version < 10:
             upgrade_to_10()
+        if db_version < 11:
+            upgrade_to_11()
+        if db_version < 12:
+            upgrade_to_12()
+        if db_version < 13:
+            upgrade_to_13()
+        if db_version < 14:
+            upgrade_to_14()
 
     except Exception as e:
         logging.exception('Incremental upgrade of db failed')
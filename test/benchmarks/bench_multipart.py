@@ -0,0 +1,113 @@
+"""
+Compare multipart upload parsing throughput: files.MultipartParser vs the cgi based HashingFieldStorage.
+
+Usage: PYTHONPATH=. python test/benchmarks/bench_multipart.py [size_mb]   (default 1024)
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import cStringIO
+
+from api import files
+
+
+BOUNDARY = 'benchmarkboundary9876543210'
+BLOCK = os.urandom(2**20)
+
+
+class SyntheticUpload(object):
+    """
+    File-like multipart body with a metadata field and one file field of the given size, generated on the fly.
+    """
+
+    def __init__(self, size):
+        head = (
+            '--' + BOUNDARY + '\r\n'
+            'Content-Disposition: form-data; name="metadata"\r\n\r\n'
+            '{}\r\n'
+            '--' + BOUNDARY + '\r\n'
+            'Content-Disposition: form-data; name="file"; filename="upload.zip"\r\n'
+            'Content-Type: application/zip\r\n\r\n'
+        )
+        tail = '\r\n--' + BOUNDARY + '--\r\n'
+        self.length = len(head) + size + len(tail)
+        self._chunks = self._generate(head, size, tail)
+        self._cur = cStringIO.StringIO()
+
+    @staticmethod
+    def _generate(head, size, tail):
+        yield head
+        while size > 0:
+            block = BLOCK[:size]
+            size -= len(block)
+            yield block
+        yield tail
+
+    def _next_chunk(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self._cur = cStringIO.StringIO(chunk)
+        return True
+
+    def read(self, n=-1):
+        data = []
+        while n != 0:
+            piece = self._cur.read(n) if n > 0 else self._cur.read()
+            data.append(piece)
+            if n > 0:
+                n -= len(piece)
+            if n != 0 and not self._next_chunk():
+                break
+        return ''.join(data)
+
+    def readline(self, limit=-1):
+        data = []
+        while True:
+            piece = self._cur.readline(limit) if limit > 0 else self._cur.readline()
+            data.append(piece)
+            if limit > 0:
+                limit -= len(piece)
+            if piece.endswith('\n') or limit == 0 or not self._next_chunk():
+                break
+        return ''.join(data)
+
+
+def run_parser(upload, upload_dir):
+    make_file = lambda filename: files.HashingFile(os.path.join(upload_dir, filename), files.DEFAULT_HASH_ALG)
+    form = files.MultipartParser(BOUNDARY, make_file).parse(upload, upload.length)
+    return form['file'].file.get_hash()
+
+def run_field_storage(upload, upload_dir):
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': 'multipart/form-data; boundary=' + BOUNDARY,
+        'CONTENT_LENGTH': str(upload.length),
+        'QUERY_STRING': '',
+    }
+    form = files.getHashingFieldStorage(upload_dir, files.DEFAULT_HASH_ALG)(fp=upload, environ=environ, keep_blank_values=True)
+    return form['file'].file.get_hash()
+
+def bench(name, func, size):
+    upload_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        digest = func(SyntheticUpload(size), upload_dir)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(upload_dir)
+    print '{:<24} {:8.1f} MB/s  ({:.2f}s)'.format(name, size / 2.0**20 / elapsed, elapsed)
+    return digest
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 1024) * 2**20
+    print 'Parsing a {} MB upload'.format(size / 2**20)
+    d1 = bench('MultipartParser', run_parser, size)
+    d2 = bench('HashingFieldStorage', run_field_storage, size)
+    assert d1 == d2, 'parsers disagree on file contents'
+
+if __name__ == '__main__':
+    main()
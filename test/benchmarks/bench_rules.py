@@ -0,0 +1,69 @@
+"""
+Compare gear rule evaluation: the compiled rules.RuleSet vs calling rules.eval_rule per rule.
+
+Usage: PYTHONPATH=. python test/benchmarks/bench_rules.py [files] [rules]   (default 10000 x 50)
+"""
+
+import sys
+import time
+import random
+
+from api.jobs import rules
+
+
+TYPES = ['dicom', 'nifti', 'bval', 'bvec', 'text', 'image', 'pdf', 'tabular', 'archive', 'qa']
+MEASUREMENTS = ['anatomy', 'functional', 'diffusion', 'localizer', 'fieldmap', 'spectroscopy']
+EXTENSIONS = ['.dcm', '.dcm.zip', '.nii.gz', '.bval', '.bvec', '.txt', '.png', '.pdf', '.csv', '.json']
+
+
+def random_match(rng):
+    kind = rng.choice(['file.type', 'file.name', 'file.measurements', 'container.measurement'])
+    if kind == 'file.type':
+        return [kind, rng.choice(TYPES)]
+    elif kind == 'file.name':
+        return [kind, '*' + rng.choice(EXTENSIONS)]
+    else:
+        return [kind, rng.choice(MEASUREMENTS)]
+
+def make_rules(count, rng):
+    return [{
+        'alg': 'gear-{}'.format(i),
+        'any': [random_match(rng) for _ in range(rng.randint(0, 4))],
+        'all': [random_match(rng) for _ in range(rng.randint(0, 2))],
+    } for i in range(count)]
+
+def make_files(count, rng):
+    return [{
+        'name': 'file-{}{}'.format(i, rng.choice(EXTENSIONS)),
+        'type': rng.choice(TYPES),
+        'measurements': rng.sample(MEASUREMENTS, rng.randint(0, 2)),
+    } for i in range(count)]
+
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rule_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    rng = random.Random(0)
+    rule_list = make_rules(rule_count, rng)
+    file_list = make_files(file_count, rng)
+    container = {'_id': 'bench', 'measurement': 'anatomy', 'files': file_list[:20]}
+
+    start = time.time()
+    expected = [[rule['alg'] for rule in rule_list if rules.eval_rule(rule, f, container)] for f in file_list]
+    interpreted = time.time() - start
+
+    start = time.time()
+    ruleset = rules.RuleSet(rule_list)
+    compiled_result = [[rule['alg'] for rule in ruleset.matching_rules(f, container)] for f in file_list]
+    compiled = time.time() - start
+
+    assert compiled_result == expected
+    matches = sum(len(m) for m in expected)
+    print('{} files x {} rules, {} matches'.format(file_count, rule_count, matches))
+    print('eval_rule: {:.3f}s'.format(interpreted))
+    print('RuleSet:   {:.3f}s ({:.1f}x)'.format(compiled, interpreted / compiled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import bson
+import pytest
+
+from api import config
+
+
+def matches(doc, query):
+    """
+    Whether doc matches a query, for the subset of query operators used by the code under test.
+    """
+    if not isinstance(query, dict):
+        query = {'_id': query}
+    for key, cond in query.iteritems():
+        if key == '$or':
+            if not any(matches(doc, q) for q in cond):
+                return False
+            continue
+        value = doc
+        for part in key.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        values = value if isinstance(value, list) else [value]
+        if isinstance(cond, dict) and any(k.startswith('$') for k in cond):
+            if '$in' in cond and not set(values) & set(cond['$in']):
+                return False
+            if '$ne' in cond and cond['$ne'] in values:
+                return False
+            if '$exists' in cond and (value is not None) != cond['$exists']:
+                return False
+        elif cond not in values and cond != value:
+            return False
+    return True
+
+
+class FakeCollection(object):
+    """
+    Just enough of a pymongo collection for unit tests: documents in a list, and a record of every call.
+    """
+
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+        self.queries = 0
+        self.inserts = []
+        self.updates = []
+        self.bulk_writes = []
+
+    def find(self, query=None, projection=None, **kwargs):
+        self.queries += 1
+        return [d for d in self.docs if matches(d, query or {})]
+
+    def find_one(self, query=None, projection=None, **kwargs):
+        self.queries += 1
+        for d in self.docs:
+            if matches(d, query or {}):
+                return d
+        return None
+
+    def insert_one(self, doc):
+        self.inserts.append(doc)
+        self.docs.append(doc)
+
+    def insert_many(self, docs, ordered=True):
+        self.inserts.append(docs)
+        self.docs.extend(docs)
+        return type('InsertManyResult', (), {'inserted_ids': range(len(docs))})
+
+    def update_one(self, query, update, upsert=False):
+        self.updates.append((query, update))
+        for d in self.docs:
+            if matches(d, query):
+                d.update(update.get('$set', {}))
+                break
+
+    def update_many(self, query, update, upsert=False):
+        self.updates.append((query, update))
+        for d in self.docs:
+            if matches(d, query):
+                d.update(update.get('$set', {}))
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=None, **kwargs):
+        self.updates.append((query, update))
+        doc = self.find_one(query)
+        if doc is None and upsert:
+            doc = dict((k, v) for k, v in query.iteritems() if not isinstance(v, dict))
+            doc.update(update.get('$setOnInsert', {}))
+            doc['_id'] = bson.ObjectId()
+            self.docs.append(doc)
+        if doc is not None:
+            doc.update(update.get('$set', {}))
+        return doc
+
+    def delete_one(self, query):
+        for d in self.docs:
+            if matches(d, query):
+                self.docs.remove(d)
+                break
+
+    def bulk_write(self, ops, ordered=True):
+        self.bulk_writes.append((ops, ordered))
+
+
+class FakeDB(dict):
+    """
+    A database of FakeCollections, made on first access by item or attribute.
+    """
+
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def load(self, **collections):
+        """
+        Set the documents of some collections, given as lists.
+        """
+        for name, docs in collections.iteritems():
+            self[name] = FakeCollection(docs)
+        return self
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """
+    An empty FakeDB, installed as config.db.
+    """
+    db = FakeDB()
+    monkeypatch.setattr(config, 'db', db)
+    return db
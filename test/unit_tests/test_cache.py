@@ -0,0 +1,49 @@
+from api import cache
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_expiry():
+    timer = FakeTimer()
+    c = cache.TTLCache(maxsize=10, ttl=60, timer=timer)
+    c.set('a', 1)
+    assert c.get('a') == 1
+    timer.now += 61
+    assert c.get('a') is None
+    assert len(c) == 0
+
+def test_explicit_expiry_is_capped_by_ttl():
+    timer = FakeTimer()
+    c = cache.TTLCache(maxsize=10, ttl=60, timer=timer)
+    c.set('short', 1, expires=timer.now + 10)
+    c.set('long', 2, expires=timer.now + 3600)
+    timer.now += 30
+    assert c.get('short') is None
+    assert c.get('long') == 2
+    timer.now += 31
+    assert c.get('long') is None
+
+def test_lru_eviction():
+    c = cache.TTLCache(maxsize=2)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+    assert 'a' in c
+    assert 'b' not in c
+    assert 'c' in c
+
+def test_discard_if():
+    c = cache.TTLCache(maxsize=10)
+    c.set('t1', {'uid': 'alice'})
+    c.set('t2', {'uid': 'bob'})
+    c.set('t3', {'uid': 'alice'})
+    assert c.discard_if(lambda v: v['uid'] == 'alice') == 2
+    assert len(c) == 1
+    assert c.get('t2') == {'uid': 'bob'}
@@ -0,0 +1,75 @@
+import copy
+
+from api import config
+
+
+class FakeSingletons(object):
+    def __init__(self, doc):
+        self.doc = doc
+
+    def find_one(self, query):
+        return copy.deepcopy(self.doc)
+
+
+class FakeDB(object):
+    def __init__(self, doc):
+        self.singletons = FakeSingletons(doc)
+
+
+def test_refresh_swaps_snapshot(monkeypatch):
+    stored = copy.deepcopy(config.DEFAULT_CONFIG)
+    stored['site']['name'] = 'Refreshed'
+    monkeypatch.setattr(config, 'db', FakeDB(stored))
+    monkeypatch.setattr(config, '__config_persisted', True)
+    monkeypatch.setattr(config, '__config', copy.deepcopy(config.DEFAULT_CONFIG))
+    monkeypatch.setattr(config, '__last_update', 0)
+
+    old = config.get_config()
+    assert config.get_item('site', 'name') == 'Local'
+    assert config.get_snapshot_age() > 60
+
+    config._refresh_config()
+    assert config.get_item('site', 'name') == 'Refreshed'
+    assert config.get_snapshot_age() < 60
+
+    # Readers holding the previous snapshot are unaffected
+    assert old['site']['name'] == 'Local'
+
+def test_refresh_keeps_snapshot_without_db_config(monkeypatch):
+    monkeypatch.setattr(config, 'db', FakeDB(None))
+    monkeypatch.setattr(config, '__config_persisted', True)
+    monkeypatch.setattr(config, '__config', copy.deepcopy(config.DEFAULT_CONFIG))
+
+    config._refresh_config()
+    assert config.get_item('site', 'name') == 'Local'
+
+def test_persist_keeps_defaults_missing_from_db_config(monkeypatch):
+    stored = copy.deepcopy(config.DEFAULT_CONFIG)
+    stored['site']['name'] = 'Stored'
+    del stored['queue']['orphan_timeout']
+    db = FakeDB(stored)
+    db.singletons.replace_one = lambda query, doc, upsert=False: None
+    monkeypatch.setattr(config, 'db', db)
+    monkeypatch.setattr(config, 'initialize_db', lambda: None)
+    monkeypatch.setattr(config, '__config', copy.deepcopy(config.DEFAULT_CONFIG))
+    monkeypatch.setattr(config, '__config_persisted', False)
+
+    config._persist_config()
+    assert config.__config['site']['name'] == 'Stored'
+    assert config.__config['queue']['orphan_timeout'] == config.DEFAULT_CONFIG['queue']['orphan_timeout']
+
+def test_refresh_keeps_defaults_missing_from_db_config(monkeypatch):
+    stored = copy.deepcopy(config.DEFAULT_CONFIG)
+    stored['site']['name'] = 'Refreshed'
+    del stored['queue']['orphan_timeout']
+    monkeypatch.setattr(config, 'db', FakeDB(stored))
+    monkeypatch.setattr(config, '__config_persisted', True)
+    monkeypatch.setattr(config, '__config', copy.deepcopy(config.DEFAULT_CONFIG))
+
+    config._refresh_config()
+    assert config.get_item('site', 'name') == 'Refreshed'
+    assert config.get_item('queue', 'orphan_timeout') == config.DEFAULT_CONFIG['queue']['orphan_timeout']
+
+def test_merge_config():
+    merged = config.merge_config({'queue': {'max_retries': 3, 'orphan_timeout': 100}}, {'queue': {'max_retries': 5}, 'created': 1})
+    assert merged == {'queue': {'max_retries': 5, 'orphan_timeout': 100}, 'created': 1}
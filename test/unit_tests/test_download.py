@@ -0,0 +1,206 @@
+import datetime
+
+import pytest
+import webapp2
+
+from api import download
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None,              None),
+    ('bytes=0-99',      (0, 99)),
+    ('bytes=100-',      (100, 999)),
+    ('bytes=900-5000',  (900, 999)),
+    ('bytes=-100',      (900, 999)),
+    ('bytes=-5000',     (0, 999)),
+    ('bytes=1000-',     False),
+    ('bytes=-0',        False),
+    ('bytes=0-1,5-6',   None),
+    ('bytes=5-1',       None),
+    ('bytes=a-b',       None),
+    ('items=0-1',       None),
+])
+def test_parse_range(header, expected):
+    assert download.parse_range(header, 1000) == expected
+
+@pytest.mark.parametrize('header', ['bytes=-100', 'bytes=0-', 'bytes=0-0'])
+def test_parse_range_empty(header):
+    assert download.parse_range(header, 0) is False
+
+
+@pytest.fixture
+def datafile(tmpdir):
+    path = tmpdir.join('data')
+    path.write(''.join(chr(i % 256) for i in xrange(1000)), 'wb')
+    return str(path)
+
+def serve(datafile, environ=None, **headers):
+    request = webapp2.Request.blank('/', environ=environ, headers=headers)
+    response = webapp2.Response()
+    download.send_file(request, response, datafile, 1000, 'v0-sha384-abc')
+    return response
+
+def test_send_whole_file(datafile):
+    response = serve(datafile)
+    assert response.status_int == 200
+    assert response.headers['ETag'] == '"v0-sha384-abc"'
+    assert response.headers['Content-Length'] == '1000'
+    assert response.body == open(datafile, 'rb').read()
+
+def test_send_file_wrapper(datafile):
+    wrapped = []
+    def file_wrapper(fd, blksize):
+        wrapped.append(iter(lambda: fd.read(blksize), ''))
+        return wrapped[-1]
+    response = serve(datafile, environ={'wsgi.file_wrapper': file_wrapper})
+    assert len(wrapped) == 1
+    # Served as is, so that the server can recognise it and use sendfile
+    assert response.app_iter is wrapped[0]
+    assert len(response.body) == 1000
+
+def test_send_range(datafile):
+    response = serve(datafile, Range='bytes=10-19')
+    assert response.status_int == 206
+    assert response.headers['Content-Range'] == 'bytes 10-19/1000'
+    assert response.body == open(datafile, 'rb').read()[10:20]
+
+def test_send_if_range(datafile):
+    assert serve(datafile, Range='bytes=10-19', **{'If-Range': '"v0-sha384-abc"'}).status_int == 206
+    assert serve(datafile, Range='bytes=10-19', **{'If-Range': '"v0-sha384-old"'}).status_int == 200
+
+def test_send_not_modified(datafile):
+    assert serve(datafile, **{'If-None-Match': '"x", "v0-sha384-abc"'}).status_int == 304
+    assert serve(datafile, **{'If-None-Match': '"x"'}).status_int == 200
+
+def test_send_unsatisfiable(datafile):
+    response = serve(datafile, Range='bytes=2000-')
+    assert response.status_int == 416
+    assert response.headers['Content-Range'] == 'bytes */1000'
+
+def test_send_empty_range(tmpdir):
+    path = tmpdir.join('empty')
+    path.write('')
+    request = webapp2.Request.blank('/', headers={'Range': 'bytes=-100'})
+    response = webapp2.Response()
+    download.send_file(request, response, str(path), 0, 'v0-sha384-abc')
+    assert response.status_int == 416
+    assert response.headers['Content-Range'] == 'bytes */0'
+
+
+def reference_archivestream(targets):
+    # The original sequential implementation, kept here to check the stream stays byte-identical
+    import cStringIO, tarfile
+    stream = cStringIO.StringIO()
+    with tarfile.open(mode='w|', fileobj=stream) as archive:
+        for filepath, arcpath, _ in targets:
+            yield archive.gettarinfo(filepath, arcpath).tobuf()
+            with open(filepath, 'rb') as fd:
+                for chunk in iter(lambda: fd.read(2**20), ''):
+                    yield chunk
+                if len(chunk) % 512 != 0:
+                    yield (512 - (len(chunk) % 512)) * b'\0'
+    yield stream.getvalue()
+
+@pytest.fixture
+def targets(tmpdir):
+    targets = []
+    for i, size in enumerate([1, 511, 512, 513, 5000, 2**20, 2**20 + 7, 3 * 2**20]):
+        path = tmpdir.join(str(i))
+        path.write(chr(i) * size, 'wb')
+        targets.append((str(path), 'sdm/f{}'.format(i), size))
+    return targets
+
+@pytest.mark.parametrize('prefetch', [0, 1, 3, 32])
+def test_archivestream_identical(targets, prefetch):
+    expected = ''.join(reference_archivestream(targets))
+    assert ''.join(download.archivestream(targets, prefetch=prefetch)) == expected
+
+def test_archivestream_empty_file(tmpdir, targets):
+    import cStringIO, tarfile
+    empty = tmpdir.join('empty')
+    empty.write('')
+    targets.insert(2, (str(empty), 'sdm/empty', 0))
+    stream = ''.join(download.archivestream(targets))
+    with tarfile.open(fileobj=cStringIO.StringIO(stream)) as archive:
+        members = archive.getmembers()
+        assert [m.name for m in members] == [arcpath for _, arcpath, _ in targets]
+        assert archive.extractfile('sdm/empty').read() == ''
+        assert archive.extractfile('sdm/f4').read() == chr(4) * 5000
+
+def test_archivestream_closed_early(targets):
+    stream = download.archivestream(targets, prefetch=4)
+    next(stream)
+    stream.close()
+
+
+def test_path_from_container_dedup():
+    used = {}
+    paths = [download._path_from_container({'label': label}, used, 'p') for label in ['a', 'a', 'a_0', 'a', None]]
+    assert paths == ['a', 'a_0', 'a_0_0', 'a_1', 'untitled']
+    # Siblings are only de-duplicated under the same parent
+    assert download._path_from_container({'label': 'a'}, used, 'q') == 'a'
+
+
+def test_resolve_targets(tmpdir, fake_db):
+    import bson
+    p, s1, s2, a1, a2 = [bson.ObjectId() for _ in range(5)]
+    hashes = ['v0-sha384-' + c * 96 for c in 'abcde']
+    created = datetime.datetime(2016, 1, 1)
+    f = lambda name, h, **kw: dict(dict(name=name, hash=h, size=10, created=created), **kw)
+    db = fake_db.load(
+        projects=[{'_id': p, 'group': 'g', 'label': 'proj', 'files': [f('p.txt', hashes[0])]}],
+        sessions=[
+            {'_id': s1, 'project': p, 'label': 'ses', 'files': [f('s.txt', hashes[1], optional=True)]},
+            {'_id': s2, 'project': p, 'label': 'ses', 'files': []},
+        ],
+        acquisitions=[
+            {'_id': a1, 'session': s1, 'label': 'acq', 'files': [f('a.dcm', hashes[2], type='dicom')]},
+            {'_id': a2, 'session': s2, 'label': 'acq', 'files': [f('b.dcm', hashes[3]), f('missing', hashes[4])]},
+        ],
+    )
+    data_path = str(tmpdir)
+    for h in hashes[:4]:
+        path = tmpdir.join(download.util.path_from_hash(h))
+        path.ensure()
+
+    req_spec = {'optional': False, 'nodes': [{'level': 'project', '_id': str(p)}, {'level': 'acquisition', '_id': str(a1)}]}
+    arcpaths = [arcpath for _, arcpath, _ in download.resolve_targets(req_spec, data_path)]
+    assert arcpaths == [
+        'sdm/g/proj/p.txt',
+        'sdm/g/proj/ses/acq/a.dcm',
+        'sdm/g/proj/ses_0/acq/b.dcm',
+        'g/proj/ses_1/acq_0/a.dcm',
+    ]
+    assert sum(c.queries for c in db.values()) == 4
+
+    req_spec = {'optional': True, 'nodes': [{'level': 'session', '_id': str(s1)}], 'filters': [{'types': {'-': ['dicom']}}]}
+    arcpaths = [arcpath for _, arcpath, _ in download.resolve_targets(req_spec, data_path)]
+    assert arcpaths == ['g/proj/ses/s.txt']
+
+    # A ticket's targets are regenerated as of its snapshot; files added since are left out
+    req_spec = {'optional': False, 'nodes': [{'level': 'acquisition', '_id': str(a2)}]}
+    ticket = {'target': {'request': req_spec, 'snapshot': created}}
+    assert len(list(download.ticket_targets(ticket, data_path))) == 1
+    db.acquisitions.docs[1]['files'].append(f('new.dcm', hashes[0], created=created + datetime.timedelta(seconds=1)))
+    assert len(list(download.ticket_targets(ticket, data_path))) == 1
+    ticket['target']['snapshot'] = created + datetime.timedelta(seconds=1)
+    assert len(list(download.ticket_targets(ticket, data_path))) == 2
+
+    # Containers deleted since the preflight fail the ticket up front, not part way through the archive
+    del db.acquisitions.docs[1]
+    with pytest.raises(download.APIStorageException):
+        download.ticket_targets(ticket, data_path)
+
+def test_preflight_progress(monkeypatch, fake_db):
+    inserted = fake_db.downloads.inserts
+    monkeypatch.setattr(download, 'PREFLIGHT_PROGRESS_INTERVAL', 2)
+    handler = download.Download.__new__(download.Download)
+    handler.request = webapp2.Request.blank('/api/download')
+    targets = iter([('a', 'x/a', 10), ('b', 'x/b', 20), ('c', 'x/c', 30)])
+
+    events = list(handler._preflight({'nodes': []}, datetime.datetime(2016, 1, 1), targets))
+    assert events == [
+        ('progress', {'file_cnt': 2, 'size': 30}),
+        ('result', {'ticket': inserted[0]['_id'], 'file_cnt': 3, 'size': 60}),
+    ]
+    assert inserted[0]['size'] == 60
@@ -0,0 +1,20 @@
+import json
+import datetime
+
+import bson
+
+from api import encoder
+
+
+def test_json_list_stream():
+    _id = bson.ObjectId()
+    items = [{'_id': _id, 'n': i, 'when': datetime.datetime(2016, 1, 1)} for i in range(1000)]
+
+    chunks = list(encoder.json_list_stream(iter(items), chunk_size=1024))
+    assert len(chunks) > 1
+    decoded = json.loads(''.join(chunks))
+    assert [d['n'] for d in decoded] == range(1000)
+    assert decoded[0]['_id'] == str(_id)
+
+    assert list(encoder.json_list_stream([])) == ['[]']
+    assert json.loads(''.join(encoder.json_list_stream([1], chunk_size=1))) == [1]
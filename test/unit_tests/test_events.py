@@ -0,0 +1,143 @@
+import bson
+
+from api.jobs import events
+
+
+def match(doc, query):
+    for key, cond in query.iteritems():
+        if key == '$or':
+            if not any(match(doc, q) for q in cond):
+                return False
+        elif isinstance(cond, dict):
+            value = doc.get(key)
+            values = value if isinstance(value, list) else [value]
+            if not set(values) & set(cond['$in']):
+                return False
+        elif doc.get(key) != cond:
+            return False
+    return True
+
+class FakeCursor(object):
+    """
+    Tails a FakeEvents in natural order; dies after its lifetime, in passes over the collection.
+    """
+
+    def __init__(self, coll, query, lifetime):
+        self.coll = coll
+        self.query = query
+        self.lifetime = lifetime
+        self.position = 0
+        self.alive = True
+        self.closed = False
+
+    def __iter__(self):
+        self.coll.on_pass()
+        docs = self.coll.docs[self.position:]
+        self.position = len(self.coll.docs)
+        self.lifetime -= 1
+        if self.lifetime <= 0:
+            self.alive = False
+        return iter([dict(d) for d in docs if match(d, self.query)])
+
+    def close(self):
+        self.closed = True
+
+class FakeEvents(object):
+    def __init__(self, docs, arriving=(), lifetime=100):
+        self.docs = list(docs) # natural order
+        self.arriving = list(arriving) # inserted one per pass of a cursor
+        self.lifetime = lifetime
+        self.queries = []
+
+    def on_pass(self):
+        if self.arriving:
+            self.docs.append(self.arriving.pop(0))
+
+    def find_one(self, query, fields=None, sort=None):
+        docs = [d for d in self.docs if match(d, query)]
+        if sort:
+            docs.reverse()
+        return docs[0] if docs else None
+
+    def find(self, query, cursor_type=None):
+        self.queries.append(query)
+        return FakeCursor(self, query, self.lifetime)
+
+class FakeDB(object):
+    def __init__(self, jobevents):
+        self.jobevents = jobevents
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+def make_events(n, job='j'):
+    # Ids generated in the opposite order of insertion, as by publishers with different clocks or pids
+    ids = sorted(bson.ObjectId() for _ in range(n))
+    return [{'_id': _id, 'job': job, 'tags': ['t']} for _id in reversed(ids)]
+
+def tail_ids(db, monkeypatch, *args, **kwargs):
+    monkeypatch.setattr(events.config, 'db', db)
+    monkeypatch.setattr(events.time, 'sleep', lambda s: None)
+    kwargs.setdefault('duration', 20)
+    return [e['_id'] if e else None for e in events.tail(*args, timer=FakeTimer(), **kwargs)]
+
+
+def test_tail_resumes_in_insertion_order(monkeypatch):
+    docs = make_events(4)
+    coll = FakeEvents(docs)
+    result = tail_ids(FakeDB(coll), monkeypatch, docs[1]['_id'])
+    # Later events have lower ids, and are still sent, once
+    assert [i for i in result if i] == [docs[2]['_id'], docs[3]['_id']]
+
+def test_tail_from_now(monkeypatch):
+    docs = make_events(4)
+    coll = FakeEvents(docs[:2], arriving=docs[2:])
+    result = tail_ids(FakeDB(coll), monkeypatch)
+    assert [i for i in result if i] == [docs[2]['_id'], docs[3]['_id']]
+
+def test_tail_reopens_after_last_event(monkeypatch):
+    docs = make_events(4) + make_events(2, job='other')
+    coll = FakeEvents(docs[:1], arriving=docs[1:], lifetime=2)
+    result = tail_ids(FakeDB(coll), monkeypatch, docs[0]['_id'], job_ids=['j'])
+    assert [i for i in result if i] == [d['_id'] for d in docs[1:4]]
+    assert coll.queries[0] == {'$or': [{'job': {'$in': ['j']}}, {'_id': docs[0]['_id']}]}
+    assert len(coll.queries) > 1
+
+def test_tail_after_dropped_event(monkeypatch):
+    docs = make_events(3)
+    coll = FakeEvents(docs[1:])
+    result = tail_ids(FakeDB(coll), monkeypatch, docs[0]['_id'])
+    # The last event seen has left the capped collection; everything still in it is newer
+    assert [i for i in result if i] == [docs[1]['_id'], docs[2]['_id']]
+
+def test_tail_keepalive(monkeypatch):
+    monkeypatch.setattr(events, 'KEEPALIVE_INTERVAL', 5)
+    result = tail_ids(FakeDB(FakeEvents(make_events(1))), monkeypatch)
+    assert result and all(i is None for i in result)
+
+
+def test_stream_limit(monkeypatch):
+    monkeypatch.setattr(events, '_streams', None)
+    monkeypatch.setattr(events.config, 'get_item', lambda outer, inner: {('queue', 'max_event_streams'): '2'}[(outer, inner)])
+
+    body = iter(['a', 'b'])
+    first = events.open_stream(body)
+    second = events.open_stream(iter([]))
+    assert list(first) == ['a', 'b']
+    assert events.open_stream(iter([])) is None
+
+    # Closing releases the slot, once only
+    first.close()
+    first.close()
+    third = events.open_stream(iter([]))
+    assert third is not None
+    assert events.open_stream(iter([])) is None
+    second.close()
+    third.close()
@@ -1,8 +1,14 @@
 
+import threading
+
 import pytest
 from api import files
 
 
+def digest_threads():
+    return len([t for t in threading.enumerate() if t.name == 'digest'])
+
+
 def test_extension():
     assert files.guess_type_from_filename('example.pdf') == 'pdf'
 
@@ -23,3 +29,55 @@ def test_qa():
 
 def test_unknown():
     assert files.guess_type_from_filename('example.unknown') == None
+
+def test_hashing_file_digests(tmpdir):
+    import hashlib, zlib
+    data = 'x' * (files.DigestWorker.BUFFER_SIZE * 3 + 17)
+    path = str(tmpdir.join('out'))
+    f = files.HashingFile(path, 'sha384', ['md5', 'crc32', 'sha384'])
+    # Mix of small and large writes, to exercise both coalescing and the background thread
+    f.write(data[:10])
+    f.write(data[10:100])
+    f.write(data[100:])
+    f.close()
+    assert open(path, 'rb').read() == data
+    assert f.get_hash() == hashlib.sha384(data).hexdigest()
+    # Digests include the CAS algorithm when requested
+    assert f.get_digests() == {
+        'md5': hashlib.md5(data).hexdigest(),
+        'crc32': '%08x' % (zlib.crc32(data) & 0xffffffff),
+        'sha384': hashlib.sha384(data).hexdigest(),
+    }
+    assert len(f.digest_worker.digests) == 3
+    assert files.hash_file(path, ['md5', 'sha384']) == {
+        'md5': hashlib.md5(data).hexdigest(),
+        'sha384': hashlib.sha384(data).hexdigest(),
+    }
+
+def test_hashing_file_small(tmpdir):
+    import hashlib
+    f = files.HashingFile(str(tmpdir.join('out')), 'sha384')
+    f.write('hello')
+    f.close()
+    assert f.digest_worker._thread is None
+    assert f.get_formatted_hash() == 'v0-sha384-' + hashlib.sha384('hello').hexdigest()
+    assert f.get_digests() == {}
+
+def test_unknown_digest():
+    with pytest.raises(files.FileStoreException):
+        files.new_digest('nope')
+
+def test_hashing_file_abort(tmpdir):
+    f = files.HashingFile(str(tmpdir.join('out')), 'sha384', ['md5'])
+    f.write('x' * (files.DigestWorker.BUFFER_SIZE * 2))
+    assert digest_threads() == 1
+    f.abort()
+    assert f.closed
+    assert digest_threads() == 0
+
+def test_hashing_file_close_ends_thread(tmpdir):
+    f = files.HashingFile(str(tmpdir.join('out')), 'sha384')
+    f.write('x' * (files.DigestWorker.BUFFER_SIZE * 2))
+    f.close()
+    assert digest_threads() == 0
+    assert f.get_hash() is not None
@@ -0,0 +1,120 @@
+import BaseHTTPServer
+import datetime
+import hashlib
+import json
+import threading
+
+import pytest
+import webapp2
+
+from api import base
+from api import config
+from api import gravatar
+
+
+KNOWN_EMAIL = 'has-gravatar@example.com'
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stands in for both the OAuth identity endpoint and gravatar.com.
+    """
+
+    def do_GET(self):
+        if self.path.startswith('/identity'):
+            body = json.dumps({'email': KNOWN_EMAIL, 'picture': 'https://example.com/me.png?sz=50'})
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def do_HEAD(self):
+        self.server.head_count += 1
+        if self.path.startswith('/avatar/' + hashlib.md5(KNOWN_EMAIL).hexdigest()):
+            self.send_response(200)
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+    server.head_count = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_port)
+    monkeypatch.setattr(gravatar, 'GRAVATAR_URL', url + '/avatar/')
+    gravatar.result_cache.clear()
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+
+class FakeUsers(object):
+    def __init__(self):
+        self.bulk_writes = []
+        self.updates = []
+
+    def bulk_write(self, ops, ordered=True):
+        self.bulk_writes.append(ops)
+
+    def update_one(self, query, update):
+        self.updates.append((query, update))
+
+
+class FakeDB(object):
+    def __init__(self):
+        self.users = FakeUsers()
+
+
+def test_resolve_is_cached(stub_server):
+    server, url = stub_server
+    assert gravatar.resolve(KNOWN_EMAIL) == gravatar.gravatar_url(KNOWN_EMAIL)
+    assert gravatar.resolve('nobody@example.com') is None
+    assert server.head_count == 2
+
+    # Both positive and negative results are served from the cache
+    assert gravatar.resolve(KNOWN_EMAIL) == gravatar.gravatar_url(KNOWN_EMAIL)
+    assert gravatar.resolve('nobody@example.com') is None
+    assert server.head_count == 2
+
+def test_resolve_async(stub_server):
+    results = []
+    gravatar.resolve_async(KNOWN_EMAIL, lambda email, url: results.append((email, url)))
+    gravatar.resolve_async('nobody@example.com', lambda email, url: results.append((email, url)))
+    gravatar._pending.join()
+    assert results == [(KNOWN_EMAIL, gravatar.gravatar_url(KNOWN_EMAIL))]
+
+def test_login_updates():
+    timestamp = datetime.datetime.utcnow()
+    assert len(base.login_updates('user@example.com', timestamp)) == 2
+    assert len(base.login_updates('user@example.com', timestamp, 'https://example.com/me.png')) == 4
+
+def test_validate_oauth_token(stub_server, monkeypatch):
+    server, url = stub_server
+    db = FakeDB()
+    monkeypatch.setattr(config, 'db', db)
+    monkeypatch.setattr(config, 'get_item', lambda outer, inner: url + '/identity')
+
+    handler = base.RequestHandler.__new__(base.RequestHandler)
+    handler.request = webapp2.Request.blank('/api')
+    uid = handler.validate_oauth_token('token', datetime.datetime.utcnow())
+    assert uid == KNOWN_EMAIL
+
+    # All login bookkeeping goes out in a single round trip
+    assert len(db.users.bulk_writes) == 1
+    assert all(op._filter['_id'] == KNOWN_EMAIL for op in db.users.bulk_writes[0])
+
+    gravatar._pending.join()
+    assert len(db.users.updates) == 1
+    query, update = db.users.updates[0]
+    assert query['_id'] == KNOWN_EMAIL
+    assert update['$set']['avatars.gravatar'] == gravatar.gravatar_url(KNOWN_EMAIL)
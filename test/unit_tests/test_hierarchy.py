@@ -0,0 +1,26 @@
+from api.dao import hierarchy
+
+
+def test_propagate_changes_by_ancestor(fake_db):
+    update = {'$set': {'archived': True}}
+
+    def updates():
+        log = dict((name, coll.updates) for name, coll in fake_db.iteritems() if coll.updates)
+        fake_db.clear()
+        return log
+
+    hierarchy.propagate_changes('groups', 'g', {'archived': False}, update)
+    assert updates() == {
+        'projects': [({'archived': False, 'group': 'g'}, update)],
+        'sessions': [({'archived': False, 'group': 'g'}, update)],
+        'acquisitions': [({'archived': False, 'group': 'g'}, update)],
+    }
+
+    hierarchy.propagate_changes('projects', 'p1', {}, update)
+    assert updates() == {
+        'sessions': [({'project': 'p1'}, update)],
+        'acquisitions': [({'project': 'p1'}, update)],
+    }
+
+    hierarchy.propagate_changes('sessions', 's1', {}, update)
+    assert updates() == {'acquisitions': [({'session': 's1'}, update)]}
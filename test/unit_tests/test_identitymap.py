@@ -0,0 +1,85 @@
+import bson
+
+from api.dao import identitymap, consistencychecker, containerstorage, containerutil
+
+
+def setup_db(fake_db):
+    project_id, session_id = bson.ObjectId(), bson.ObjectId()
+    db = fake_db.load(
+        projects=[{'_id': project_id, 'permissions': []}],
+        sessions=[{
+            '_id': session_id,
+            'project': project_id,
+            'permissions': [{'_id': 'user@example.com', 'access': 'admin'}],
+            'files': [{'name': 'a.dcm'}],
+        }],
+    )
+    return db, project_id, session_id
+
+def load_for_put(project_id, session_id):
+    # The loads made while moving a session: the session, its new project, the consistency check on the project,
+    # then access checks and file lookups through a ContainerReference
+    containerstorage.ContainerStorage('sessions', use_object_id=True).get_container(str(session_id))
+    containerstorage.ContainerStorage('projects', use_object_id=True).get_container(str(project_id))
+    consistencychecker.get_container_storage_checker('PUT', 'sessions')({'project': project_id})
+    ref = containerutil.ContainerReference('session', str(session_id))
+    ref.check_access('user@example.com', 'rw')
+    return ref.find_file('a.dcm')
+
+
+def test_loads_each_container_once_per_request(fake_db):
+    db, project_id, session_id = setup_db(fake_db)
+
+    load_for_put(project_id, session_id)
+    assert (db.sessions.queries, db.projects.queries) == (3, 2)
+
+    db.sessions.queries = db.projects.queries = 0
+    identitymap.begin()
+    try:
+        load_for_put(project_id, session_id)
+    finally:
+        identity_map = identitymap.end()
+    assert (db.sessions.queries, db.projects.queries) == (1, 1)
+    assert (identity_map.loads, identity_map.hits) == (2, 3)
+    assert identitymap.current() is None
+
+def test_found_files_are_copies(fake_db):
+    db, project_id, session_id = setup_db(fake_db)
+
+    identitymap.begin()
+    try:
+        file_ = load_for_put(project_id, session_id)
+        file_['input'] = True
+        session = containerstorage.ContainerStorage('sessions', use_object_id=True).get_container(str(session_id))
+    finally:
+        identitymap.end()
+    assert session['files'] == [{'name': 'a.dcm'}]
+
+def test_writes_discard_documents(fake_db):
+    db, project_id, session_id = setup_db(fake_db)
+    storage = containerstorage.ContainerStorage('sessions', use_object_id=True)
+    storage.dbc = db.sessions
+
+    identitymap.begin()
+    try:
+        storage.get_container(str(session_id))
+        storage._update_el(str(session_id), {'label': 'renamed'})
+        assert storage.get_container(str(session_id))['label'] == 'renamed'
+    finally:
+        identitymap.end()
+    assert db.sessions.queries == 2
+
+def test_get_returns_copies(fake_db):
+    db, project_id, session_id = setup_db(fake_db)
+    storage = containerstorage.ContainerStorage('sessions', use_object_id=True)
+
+    identitymap.begin()
+    try:
+        result = storage.exec_op('GET', str(session_id))
+        result['permissions'] = []
+        result['files'][0]['path'] = 'aa/bb'
+        session = storage.get_container(str(session_id))
+    finally:
+        identitymap.end()
+    assert session['permissions'] == [{'_id': 'user@example.com', 'access': 'admin'}]
+    assert session['files'] == [{'name': 'a.dcm'}]
@@ -0,0 +1,65 @@
+import os
+import collections
+
+import elasticsearch
+import webob
+
+from api import instrumentation
+
+
+Started = collections.namedtuple('Started', ['command', 'command_name', 'connection_id', 'request_id'])
+Finished = collections.namedtuple('Finished', ['command_name', 'connection_id', 'request_id', 'duration_micros'])
+
+
+def run_command(listener, request_id, command_name, command, micros):
+    listener.started(Started(command, command_name, ('localhost', 9001), request_id))
+    listener.succeeded(Finished(command_name, ('localhost', 9001), request_id, micros))
+
+
+def test_records_commands_of_the_current_request():
+    listener = instrumentation.CommandTimer()
+
+    # Outside of a request, commands are ignored
+    run_command(listener, 1, 'find', {'find': 'sessions'}, 1000)
+
+    stats = instrumentation.begin()
+    run_command(listener, 2, 'find', {'find': 'sessions'}, 2000)
+    run_command(listener, 3, 'getMore', {'getMore': 12345L, 'collection': 'sessions'}, 500)
+    run_command(listener, 4, 'update', {'update': 'projects'}, 8000)
+    run_command(listener, 5, 'insert', {'insert': 'jobs'}, 1000)
+    response = webob.Response()
+    assert instrumentation.end(webob.Request.blank('/api/projects'), response) is stats
+
+    assert stats.db_count == 4
+    assert abs(stats.db_time - 0.0115) < 1e-9
+    assert stats.slowest == [(0.008, 'update projects'), (0.002, 'find sessions'), (0.001, 'insert jobs')]
+    assert stats.started == {}
+    assert instrumentation.current() is None
+
+    timing = response.headers['Server-Timing']
+    assert timing.startswith('db;desc="MongoDB, 4 commands";dur=11.5, es;desc="Elasticsearch, 0 requests";dur=0.0, ')
+    assert 'slowest-1;desc="update projects";dur=8.0' in timing
+
+def test_records_elasticsearch_requests(monkeypatch):
+    monkeypatch.setattr(elasticsearch.Transport, 'perform_request', lambda self, method, url, params=None, body=None: {'hits': {}})
+    transport = instrumentation.TimedTransport([{'host': 'localhost'}])
+
+    stats = instrumentation.begin()
+    assert transport.perform_request('GET', '/scitran/_search') == {'hits': {}}
+    instrumentation.end(webob.Request.blank('/api/search'), webob.Response())
+
+    assert stats.es_count == 1
+    assert stats.slowest[0][1] == 'GET /scitran/_search'
+
+def test_dumps_profiles_of_slow_requests(tmpdir):
+    profile_path = str(tmpdir.join('profiles'))
+
+    instrumentation.begin(profile=True)
+    instrumentation.end(webob.Request.blank('/api/projects'), webob.Response(), slow_threshold=60, profile_path=profile_path)
+    assert not os.path.exists(profile_path)
+
+    instrumentation.begin(profile=True)
+    sum(range(1000))
+    instrumentation.end(webob.Request.blank('/api/projects'), webob.Response(), slow_threshold=0, profile_path=profile_path)
+    dumps = os.listdir(profile_path)
+    assert len(dumps) == 1 and dumps[0].endswith('-GET-api_projects.prof')
@@ -0,0 +1,106 @@
+import json
+
+from api import metrics
+
+
+def setup_registry(monkeypatch, tmpdir):
+    monkeypatch.setattr(metrics, 'spool_path', lambda: str(tmpdir))
+    registry = metrics.Registry()
+    requests = metrics.Histogram(registry, 'requests_seconds', 'Request time.', (0.1, 1), labels=('route',))
+    uploaded = metrics.Counter(registry, 'uploaded_bytes_total', 'Bytes received.')
+    return registry, requests, uploaded
+
+
+def test_render(monkeypatch, tmpdir):
+    registry, requests, uploaded = setup_registry(monkeypatch, tmpdir)
+
+    requests.observe(0.05, route='jobs')
+    requests.observe(0.5, route='jobs')
+    requests.observe(5, route='jobs')
+    uploaded.inc(1024)
+    uploaded.inc(1024)
+
+    assert registry.render([('queue_depth', 'Pending jobs.', [([('state', 'pending')], 3)])]).splitlines() == [
+        '# HELP requests_seconds Request time.',
+        '# TYPE requests_seconds histogram',
+        'requests_seconds_bucket{route="jobs",le="0.1"} 1.0',
+        'requests_seconds_bucket{route="jobs",le="1"} 2.0',
+        'requests_seconds_bucket{route="jobs",le="+Inf"} 3.0',
+        'requests_seconds_sum{route="jobs"} 5.55',
+        'requests_seconds_count{route="jobs"} 3.0',
+        '# HELP uploaded_bytes_total Bytes received.',
+        '# TYPE uploaded_bytes_total counter',
+        'uploaded_bytes_total 2048.0',
+        '# HELP queue_depth Pending jobs.',
+        '# TYPE queue_depth gauge',
+        'queue_depth{state="pending"} 3.0',
+    ]
+
+def test_adds_up_workers(monkeypatch, tmpdir):
+    registry, requests, uploaded = setup_registry(monkeypatch, tmpdir)
+
+    # Another worker's last flush, and a write in progress that must be ignored
+    tmpdir.join('otherhost-1234-0.json').write(json.dumps({
+        'requests_seconds': [[['jobs'], [1, 0, 0, 0.05]], [['files'], [0, 0, 1, 2.0]]],
+        'uploaded_bytes_total': [[[], 100]],
+        'removed_metric': [[[], 1]],
+    }))
+    tmpdir.join('.otherhost-1234-0.json').write('{"uploaded_bytes_')
+
+    requests.observe(0.05, route='jobs')
+    uploaded.inc(50)
+    registry.flush()
+
+    totals = registry.collect()
+    assert totals['requests_seconds'] == {('jobs',): [2, 0, 0, 0.1], ('files',): [0, 0, 1, 2.0]}
+    assert totals['uploaded_bytes_total'] == {(): 150}
+    assert 'removed_metric' not in totals
+
+def test_counted(monkeypatch, tmpdir):
+    registry, _, uploaded = setup_registry(monkeypatch, tmpdir)
+
+    closed = []
+    def body():
+        try:
+            yield 'abc'
+            yield 'de'
+        finally:
+            closed.append(True)
+
+    assert ''.join(metrics.counted(body(), uploaded)) == 'abcde'
+    assert registry.values['uploaded_bytes_total'] == {(): 5}
+
+    # Responses abandoned part way are counted up to where they stopped, and closed
+    stream = metrics.counted(body(), uploaded)
+    next(stream)
+    stream.close()
+    assert registry.values['uploaded_bytes_total'] == {(): 8}
+    assert closed == [True, True]
+
+def test_retire(monkeypatch, tmpdir):
+    import os, socket, subprocess
+    registry, requests, uploaded = setup_registry(monkeypatch, tmpdir)
+    monkeypatch.setattr(socket, 'gethostname', lambda: 'api-1')
+
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    snapshot = json.dumps({'uploaded_bytes_total': [[[], 100]]})
+    tmpdir.join('api-1-{}-0.json'.format(exited.pid)).write(snapshot)
+    tmpdir.join('api-1-{}-0.json'.format(os.getpid())).write(snapshot)
+    tmpdir.join('api-2-{}-0.json'.format(exited.pid)).write(snapshot)
+    tmpdir.join('api-1-retired.json').write(json.dumps({
+        'requests_seconds': [[['jobs'], [1, 0, 0, 0.05]]],
+        'uploaded_bytes_total': [[[], 10]],
+    }))
+
+    registry.retire()
+    assert sorted(os.listdir(str(tmpdir))) == sorted([
+        '.lock', 'api-1-retired.json', 'api-1-{}-0.json'.format(os.getpid()), 'api-2-{}-0.json'.format(exited.pid)
+    ])
+    totals = registry.collect()
+    assert totals['uploaded_bytes_total'] == {(): 310}
+    assert totals['requests_seconds'] == {('jobs',): [1, 0, 0, 0.05]}
+
+    # Nothing left to fold
+    registry.retire()
+    assert registry.collect() == totals
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import random
+import cStringIO
+import threading
+
+import pytest
+
+from api import files
+
+
+BOUNDARY = 'testboundary1234'
+
+
+def build_body(parts, boundary=BOUNDARY, preamble=''):
+    body = preamble
+    for name, filename, content in parts:
+        body += '--' + boundary + '\r\n'
+        if filename is None:
+            body += 'Content-Disposition: form-data; name="{}"\r\n\r\n'.format(name)
+        else:
+            body += 'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'.format(name, filename)
+            body += 'Content-Type: application/octet-stream\r\n\r\n'
+        body += content + '\r\n'
+    return body + '--' + boundary + '--\r\n'
+
+def digest_threads():
+    return len([t for t in threading.enumerate() if t.name == 'digest'])
+
+def parse(tmpdir, body, chunk_size=None):
+    parser = files.MultipartParser(BOUNDARY, lambda filename: files.HashingFile(str(tmpdir.join(filename)), 'sha384'))
+    if chunk_size:
+        parser.CHUNK_SIZE = chunk_size
+    return parser.parse(cStringIO.StringIO(body), len(body))
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1, 7, len(BOUNDARY) + 3])
+def test_fields_and_files(tmpdir, chunk_size):
+    random.seed(chunk_size)
+    # Binary content with near-miss delimiters inside
+    data1 = ''.join(chr(random.randint(0, 255)) for _ in xrange(5000)) + '\r\n--' + BOUNDARY[:-1] + 'x'
+    data2 = '\r\n--\r\n' * 100
+    body = build_body([
+        ('metadata', None, '{"a": 1}'),
+        ('file1', 'one.bin', data1),
+        ('file2', '../../two.bin', data2),
+        ('empty', 'empty.bin', ''),
+    ], preamble='ignored preamble\r\n')
+
+    form = parse(tmpdir, body, chunk_size)
+    assert list(form) == ['metadata', 'file1', 'file2', 'empty']
+    assert form['metadata'].filename is None
+    assert form['metadata'].value == '{"a": 1}'
+
+    assert form['file2'].filename == 'two.bin'
+    for field, data in [('file1', data1), ('file2', data2), ('empty', '')]:
+        path = os.path.join(str(tmpdir), form[field].filename)
+        assert open(path, 'rb').read() == data
+        assert form[field].value == data
+        assert form[field].file.closed
+        assert form[field].file.get_hash() == hashlib.sha384(data).hexdigest()
+
+def test_empty_filename_is_plain_field(tmpdir):
+    form = parse(tmpdir, build_body([('file', '', '')]))
+    assert form['file'].filename is None
+    assert os.listdir(str(tmpdir)) == []
+
+def test_repeated_field(tmpdir):
+    with pytest.raises(files.FileStoreException):
+        parse(tmpdir, build_body([('file', 'a.txt', 'a'), ('file', 'b.txt', 'b')]))
+
+def test_truncated(tmpdir):
+    body = build_body([('file', 'a.txt', 'a' * 100)])
+    with pytest.raises(files.FileStoreException):
+        parse(tmpdir, body[:-30])
+
+def test_missing_boundary():
+    with pytest.raises(files.FileStoreException):
+        files.MultipartParser(None, None)
+
+def test_truncated_large_file_ends_digest_threads(tmpdir):
+    body = build_body([('file1', 'a.bin', 'a' * 100), ('file2', 'b.bin', 'b' * (files.DigestWorker.BUFFER_SIZE * 3))])
+    with pytest.raises(files.FileStoreException):
+        parse(tmpdir, body[:-30])
+    assert digest_threads() == 0
+
+def test_one_digest_thread_at_a_time(tmpdir):
+    threads = []
+    def make_file(filename):
+        threads.append(digest_threads())
+        return files.HashingFile(str(tmpdir.join(filename)), 'sha384')
+    data = 'x' * (files.DigestWorker.BUFFER_SIZE * 3)
+    body = build_body([('file{}'.format(i), '{}.bin'.format(i), data) for i in range(3)])
+    form = files.MultipartParser(BOUNDARY, make_file).parse(cStringIO.StringIO(body), len(body))
+    # Each part's hashing is over before the next part starts
+    assert threads == [0, 0, 0]
+    assert digest_threads() == 0
+    assert form['file2'].file.get_hash() == hashlib.sha384(data).hexdigest()
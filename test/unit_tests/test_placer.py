@@ -0,0 +1,64 @@
+import datetime
+
+import bson
+
+from api import placer
+from api.dao import hierarchy
+
+
+def test_fileinfo_upsert_ops():
+    _id = bson.ObjectId()
+    now = datetime.datetime.utcnow()
+    push, update = hierarchy.fileinfo_upsert_ops(_id, {'name': 'a.txt', 'modified': now, 'size': 1})
+    assert push._filter == {'_id': _id, 'files.name': {'$ne': 'a.txt'}}
+    assert push._doc['$push']['files']['created'] == now
+    assert update._filter == {'_id': _id, 'files.name': 'a.txt'}
+    assert update._doc['$set']['files.$.size'] == 1
+    assert 'files.$.created' not in update._doc['$set']
+
+def test_placer_flushes_per_container(monkeypatch, fake_db):
+    db = fake_db
+    jobs = []
+    monkeypatch.setattr(placer.rules, 'create_jobs_for_files', lambda db, container, container_type, infos: jobs.extend(i['name'] for i in infos))
+
+    a1, a2 = bson.ObjectId(), bson.ObjectId()
+    now = datetime.datetime.utcnow()
+    p = placer.Placer('acquisition', {'_id': a1}, a1, None, now, None, None)
+    for _id, name in [(a1, 'one'), (a2, 'two'), (a1, 'three')]:
+        p.id, p.container = _id, {'_id': _id}
+        p.save_file(None, {'name': name, 'modified': now})
+    assert db == {}
+
+    p.flush_files()
+    writes = db['acquisitions'].bulk_writes
+    assert len(writes) == 2
+    assert [len(ops) for ops, _ in writes] == [4, 2]
+    assert all(ordered for _, ordered in writes)
+    assert jobs == ['one', 'three', 'two']
+
+    p.flush_files()
+    assert len(writes) == 2
+
+def test_packfile_acquisitions_carry_ancestor_ids(monkeypatch, tmpdir, fake_db):
+    monkeypatch.setattr(placer.containerutil, 'add_id_to_subject', lambda subject, pid: subject)
+
+    project_id = bson.ObjectId()
+    folder = tmpdir.mkdir('token')
+    folder.join('1.dcm').write('dicom')
+
+    p = placer.PackfilePlacer(None, None, None, {
+        'packfile': {'type': 'dicom'}, 'session': {'label': 's'}, 'acquisition': {'label': 'a'},
+    }, datetime.datetime.utcnow(), {'type': 'user', 'id': 'user@example.com'}, {'token': 'token'})
+    p.folder = str(folder)
+    p.p_id, p.g_id, p.s_label, p.a_label = str(project_id), 'group', 's', 'a'
+    p.permissions, p.ziptime, p.dir, p.name = [], 315532800, 'a', 'a.zip'
+    p.path = str(tmpdir.join('temp.zip'))
+    p.zip = placer.zipfile.ZipFile(p.path, 'w')
+    monkeypatch.setattr(p, 'save_file', lambda field, info: None)
+    monkeypatch.setattr(p, 'flush_files', lambda: None)
+
+    list(p.finalize())
+
+    (_, acquisition_update), = fake_db.acquisitions.updates
+    assert acquisition_update['$setOnInsert']['project'] == project_id
+    assert acquisition_update['$setOnInsert']['group'] == 'group'
@@ -0,0 +1,314 @@
+import bson
+import copy
+import datetime
+import pymongo
+import pytest
+
+from api.jobs import gears
+from api.jobs import queue
+from api.jobs.jobs import Job
+from api.dao.containerutil import ContainerReference, FileReference
+
+
+def matches(doc, query):
+    for key, cond in query.items():
+        value = doc.get(key)
+        if isinstance(cond, dict) and '$in' in cond:
+            if value not in cond['$in'] and not (isinstance(value, list) and set(value) & set(cond['$in'])):
+                return False
+        elif isinstance(cond, dict) and '$lt' in cond:
+            if not value < cond['$lt']:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+class FakeJobs(object):
+    def __init__(self):
+        self.docs = []
+        self.updates = []
+
+    def insert_one(self, doc):
+        self.docs.append(doc)
+        return type('InsertOneResult', (), {'inserted_id': doc['_id']})
+
+    def insert_many(self, docs):
+        self.docs.extend(docs)
+        return type('InsertManyResult', (), {'inserted_ids': [d['_id'] for d in docs]})
+
+    def find(self, query, projection=None):
+        return [copy.deepcopy(d) for d in self.docs if matches(d, query)]
+
+    def find_one_and_update(self, query, update, sort=None, return_document=None):
+        self.updates.append((query, update, sort))
+        candidates = [d for d in self.docs if matches(d, query)]
+        if not candidates:
+            return None
+        doc = candidates[0]
+        doc.update(update['$set'])
+        return doc
+
+    def update_one(self, query, update):
+        self.updates.append((query, update, None))
+        updated = [d for d in self.docs if matches(d, query)][:1]
+        for doc in updated:
+            doc.update(update['$set'])
+        return type('UpdateResult', (), {'modified_count': len(updated)})
+
+    def update_many(self, query, update):
+        self.updates.append((query, update, None))
+        updated = [d for d in self.docs if matches(d, query)]
+        for doc in updated:
+            doc.update(update['$set'])
+        return type('UpdateResult', (), {'modified_count': len(updated)})
+
+class FakeJobStats(object):
+    def __init__(self):
+        self.docs = {}
+
+    def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            doc = self.docs.setdefault(op._filter['_id'], dict(op._doc['$setOnInsert'], count=0))
+            doc['count'] += op._doc['$inc']['count']
+
+    def find(self):
+        return self.docs.values()
+
+    def delete_many(self, query):
+        self.docs = dict((k, v) for k, v in self.docs.items() if v['count'] != query['count'])
+
+class FakeSingletons(object):
+    def __init__(self):
+        self.docs = {}
+
+    def replace_one(self, query, doc, upsert=False):
+        self.docs[query['_id']] = dict(doc, _id=query['_id'])
+
+    def find_one(self, query):
+        return copy.deepcopy(self.docs.get(query['_id']))
+
+class FakeJobEvents(object):
+    def __init__(self):
+        self.docs = []
+
+    def insert_many(self, docs, ordered=True):
+        for doc in docs:
+            doc['_id'] = bson.ObjectId()
+            self.docs.append(doc)
+
+class FakeDB(object):
+    def __init__(self):
+        self.jobs = FakeJobs()
+        self.jobstats = FakeJobStats()
+        self.jobevents = FakeJobEvents()
+        self.singletons = FakeSingletons()
+
+
+def gear(name):
+    return {'name': name, 'input': {'type': 'http', 'uri': '/' + name}, 'manifest': {'inputs': {'file': {}}}}
+
+def test_insert_generates_request(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(queue.config, 'db', db)
+    monkeypatch.setattr(gears, 'get_gear_by_name', gear)
+
+    job = Job('g', {'file': FileReference(type='acquisition', id='a', name='f.dcm')}, priority=5)
+    _id = job.insert()
+
+    doc = db.jobs.docs[0]
+    assert isinstance(_id, bson.ObjectId)
+    assert doc['priority'] == 5
+    assert doc['request']['inputs'][0] == {'type': 'http', 'uri': '/g'}
+    assert doc['request']['outputs'][0]['uri'].endswith('&job=' + str(_id))
+
+def test_start_job_single_update(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(queue.config, 'db', db)
+    monkeypatch.setattr(gears, 'get_gear_by_name', gear)
+
+    Job('g', {'file': FileReference(type='acquisition', id='a', name='f.dcm')}).insert()
+    started = queue.Queue.start_job(tags=['g'])
+    assert started['state'] == 'running'
+    assert started['request'] is not None
+    assert len(db.jobs.updates) == 1
+    query, _, sort = db.jobs.updates[0]
+    assert query == {'state': 'pending', 'tags': {'$in': ['g']}}
+    assert sort == [('priority', pymongo.DESCENDING), ('modified', pymongo.ASCENDING)]
+
+    assert queue.Queue.start_job() is None
+
+def test_start_legacy_job(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(queue.config, 'db', db)
+    monkeypatch.setattr(gears, 'get_gear_by_name', gear)
+
+    job = Job('g', {'file': FileReference(type='acquisition', id='a', name='f.dcm')})
+    doc = job.mongo()
+    doc['_id'] = bson.ObjectId()
+    db.jobs.docs.append(doc)
+
+    started = queue.Queue.start_job()
+    assert len(db.jobs.updates) == 2
+    assert started['request']['outputs'][0]['uri'].endswith('&job=' + str(doc['_id']))
+
+def test_search_uses_input_containers(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(queue.config, 'db', db)
+    monkeypatch.setattr(gears, 'get_gear_by_name', gear)
+
+    job = Job('g', {
+        'a': FileReference(type='acquisition', id='1', name='a.dcm'),
+        'b': FileReference(type='acquisition', id='1', name='b.dcm'),
+        'c': FileReference(type='session', id='2', name='c.txt'),
+    })
+    job.insert()
+    assert sorted(db.jobs.docs[0]['input_containers']) == sorted([{'type': 'acquisition', 'id': '1'}, {'type': 'session', 'id': '2'}])
+
+    finds = []
+    db.jobs.find = lambda query: finds.append(query) or type('Cursor', (), {'sort': lambda self, s: []})()
+    queue.Queue.search(ContainerReference('acquisition', '1'), states=['failed'])
+    assert finds == [{'input_containers': {'$elemMatch': {'type': 'acquisition', 'id': '1'}}, 'state': {'$in': ['failed']}}]
+
+def test_start_jobs(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(queue.config, 'db', db)
+    monkeypatch.setattr(gears, 'get_gear_by_name', gear)
+
+    for name in ['a', 'b', 'c']:
+        Job('g', {'file': FileReference(type='acquisition', id='1', name=name)}).insert()
+
+    started = queue.Queue.start_jobs(tags=['g'], count=2)
+    assert [j['inputs']['file']['name'] for j in started] == ['a', 'b']
+    assert all(j['state'] == 'running' for j in started)
+
+    started = queue.Queue.start_jobs(count=5)
+    assert [j['inputs']['file']['name'] for j in started] == ['c']
+    assert queue.Queue.start_jobs(count=5) == []
+
+def test_heartbeat_and_reap(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(queue.config, 'db', db)
+    monkeypatch.setattr(gears, 'get_gear_by_name', gear)
+    monkeypatch.setattr(queue, 'orphan_timeout', lambda: 100)
+    monkeypatch.setattr(queue, 'max_attempts', lambda: 2)
+
+    for name in ['alive', 'dead', 'dead-last-attempt', 'pending']:
+        Job('g', {'file': FileReference(type='acquisition', id='1', name=name)}, attempt=2 if name == 'dead-last-attempt' else 1).insert()
+    queue.Queue.start_jobs(count=3)
+
+    old = datetime.datetime.utcnow() - datetime.timedelta(seconds=200)
+    for doc in db.jobs.docs:
+        if doc['state'] == 'running':
+            doc['modified'] = old
+
+    alive = db.jobs.docs[0]['_id']
+    assert queue.Queue.heartbeat([str(alive), str(db.jobs.docs[3]['_id'])]) == 1
+    assert db.jobs.docs[0]['modified'] > old
+
+    assert queue.Queue.scan_for_orphans() == 2
+    states = [(d['inputs']['file']['name'], d['state'], d['attempt']) for d in db.jobs.docs]
+    assert states == [
+        ('alive', 'running', 1),
+        ('dead', 'failed', 1),
+        ('dead-last-attempt', 'failed', 2),
+        ('pending', 'pending', 1),
+        ('dead', 'pending', 2),
+    ]
+    assert db.jobs.docs[4]['previous_job_id'] == str(db.jobs.docs[1]['_id'])
+    assert queue.Queue.scan_for_orphans() == 0
+
+    # Already retried jobs are not retried again
+    failed = Job.load(copy.deepcopy(db.jobs.docs[1]))
+    assert queue.Queue.retry_many([failed]) == []
+
+def test_statistics(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(queue.config, 'db', db)
+    monkeypatch.setattr(gears, 'get_gear_by_name', gear)
+    monkeypatch.setattr(queue, 'max_attempts', lambda: 2)
+    monkeypatch.setattr(queue, 'retry_on_explicit_fail', lambda: False)
+
+    def aggregate(pipeline):
+        counts = {}
+        for d in db.jobs.docs:
+            key = (d['state'], tuple(d['tags']), d['attempt'])
+            counts[key] = counts.get(key, 0) + 1
+        return [{'_id': {'state': k[0], 'tags': list(k[1]), 'attempt': k[2]}, 'count': c} for k, c in counts.items()]
+    db.jobs.aggregate = aggregate
+
+    Job.insert_many([Job('g', {'file': FileReference(type='acquisition', id='1', name=str(i))}, attempt=2) for i in range(3)])
+    Job('h', {'file': FileReference(type='acquisition', id='1', name='x')}, tags=['extra']).insert()
+    started = queue.Queue.start_job(tags=['g'])
+    queue.Queue.mutate(Job.load(copy.deepcopy(started)), {'state': 'failed'})
+
+    result = queue.Queue.get_statistics()
+    assert result['by-state'] == {'pending': 3, 'running': 0, 'failed': 1, 'complete': 0}
+    assert sorted((tuple(sorted(t['tags'])), t['count']) for t in result['by-tag']) == [(('extra', 'h'), 1), (('g',), 3)]
+    assert result['permafailed'] == 1
+    assert result['reconciliation'] is None
+
+    assert queue.stats.reconcile()['drift'] == 0
+
+    # A job changed behind the queue's back is picked up by the next reconcile
+    db.jobs.docs[1]['state'] = 'complete'
+    assert queue.stats.reconcile()['drift'] == 2
+    result = queue.Queue.get_statistics()
+    assert result['by-state'] == {'pending': 2, 'running': 0, 'failed': 1, 'complete': 1}
+    assert result['reconciliation']['drift'] == 2
+
+def test_job_events(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(queue.config, 'db', db)
+    monkeypatch.setattr(gears, 'get_gear_by_name', gear)
+    monkeypatch.setattr(queue, 'retry_on_explicit_fail', lambda: False)
+
+    Job('g', {'file': FileReference(type='acquisition', id='1', name='a')}).insert()
+    started = queue.Queue.start_job()
+    queue.Queue.mutate(Job.load(copy.deepcopy(started)), {'state': 'running'}) # same state, no event
+    queue.Queue.mutate(Job.load(copy.deepcopy(started)), {'state': 'complete'})
+
+    job_id = str(started['_id'])
+    assert [(e['job'], e['previous_state'], e['state']) for e in db.jobevents.docs] == [
+        (job_id, None, 'pending'),
+        (job_id, 'pending', 'running'),
+        (job_id, 'running', 'complete'),
+    ]
+
+def test_find_jobs_query(monkeypatch):
+    finds = []
+    class Cursor(object):
+        def sort(self, s):
+            finds.append(('sort', s))
+            return self
+        def limit(self, l):
+            finds.append(('limit', l))
+            return self
+    db = FakeDB()
+    db.jobs.find = lambda query, projection: finds.append((query, projection)) or Cursor()
+    monkeypatch.setattr(queue.config, 'db', db)
+
+    after = bson.ObjectId()
+    queue.Queue.find_jobs(states=['failed'], gears=['g'], after=after, limit=10)
+    assert finds == [
+        ({'state': {'$in': ['failed']}, 'name': {'$in': ['g']}, '_id': {'$gt': after}}, None),
+        ('sort', [('_id', pymongo.ASCENDING)]),
+        ('limit', 10),
+    ]
+
+    del finds[:]
+    modified = datetime.datetime(2016, 6, 1, 12, 0, 0, 123000)
+    queue.Queue.find_jobs(sort='modified', after=(modified, after), fields=['state'])
+    query, projection = finds[0]
+    assert query == {'$or': [{'modified': {'$gt': modified}}, {'modified': modified, '_id': {'$gt': after}}]}
+    assert sorted(projection) == ['_id', 'modified', 'state']
+
+def test_page_tokens():
+    doc = {'_id': bson.ObjectId(), 'modified': datetime.datetime(2016, 6, 1, 12, 0, 0, 123000)}
+    for sort in queue.PAGE_SORTS:
+        token = queue.Queue.page_token(doc, sort)
+        parsed = queue.Queue.parse_page_token(token, sort)
+        assert parsed == ((doc['modified'], doc['_id']) if sort == 'modified' else doc['_id'])
+
+    for token, sort in [('nope', '_id'), ('123', 'modified'), ('x:y', 'modified')]:
+        with pytest.raises(ValueError):
+            queue.Queue.parse_page_token(token, sort)
@@ -199,3 +199,88 @@ def test_eval_rule_any_all():
     file_ = {'name': 'hello.txt', 'type': 'a'}
     result = rules.eval_rule(rule, file_, container)
     assert result == False
+
+def test_compiled_rules_match_eval_rule():
+    container = {'measurement': 'anatomy', 'files': [{'measurements': ['diffusion']}]}
+    rule_list = [
+        {'alg': 'a', 'any': [['file.type', 'dicom'], ['file.name', '*.dcm'], ['file.type', 'nifti']]},
+        {'alg': 'b', 'all': [['file.name', '*.[bB]vec'], ['container.has-type', 'diffusion']]},
+        {'alg': 'c', 'any': [['file.measurements', 'functional'], ['file.measurements', 'localizer']], 'all': [['container.measurement', 'anatomy']]},
+        {'alg': 'd', 'any': [], 'all': []},
+        {'alg': 'e', 'any': [['file.name', 'x?.txt']], 'all': [['file.type', 'text']]},
+    ]
+    files = [
+        {'name': 'hello.dcm', 'type': 'a'},
+        {'name': 'hello.txt', 'type': 'nifti', 'measurements': ['localizer']},
+        {'name': 'hello.bvec', 'type': None, 'measurements': []},
+        {'name': 'hello.Bvec'},
+        {'name': 'xy.txt', 'type': 'text', 'measurements': ['functional']},
+        {'name': 'xyz.txt', 'type': 'text'},
+    ]
+
+    ruleset = rules.RuleSet(rule_list)
+    for file_ in files:
+        expected = [rule for rule in rule_list if rules.eval_rule(rule, file_, container)]
+        assert ruleset.matching_rules(file_, container) == expected
+
+def test_compiled_rules_unknown_match_type():
+    ruleset = rules.RuleSet([{'alg': 'a', 'all': [['file.nope', 'x']]}])
+    with pytest.raises(Exception):
+        ruleset.matching_rules({'name': 'a'}, {})
+
+def fake_gear(name):
+    return {'name': name, 'input': {}, 'manifest': {'inputs': {'file': {}}}}
+
+def test_create_jobs_for_files(monkeypatch, fake_db):
+    base_rules = [{'alg': 'base', 'any': [['file.type', 'dicom']]}]
+    db = fake_db.load(
+        projects=[{'_id': 'p', 'rules': [{'alg': 'proj', 'all': [['file.name', '*.nii']]}]}],
+        sessions=[{'_id': 's', 'project': 'p'}],
+        singletons=[{'_id': 'gears', 'gear_list': [fake_gear('proj'), fake_gear('base')]}],
+    )
+    monkeypatch.setattr(rules, 'get_base_rules', lambda: base_rules)
+    rules.invalidate_rules()
+    rules.gears.invalidate_gears()
+
+    acquisition = {'_id': 'a', 'session': 's'}
+    files = [{'name': 'a.nii', 'type': 'dicom'}, {'name': 'b.txt'}, {'name': 'c.dcm', 'type': 'dicom'}]
+    assert rules.create_jobs_for_files(db, acquisition, 'acquisition', files) == ['proj', 'base', 'base']
+    assert len(db.jobs.inserts) == 1
+    assert [(j['name'], j['inputs']['file']['name']) for j in db.jobs.inserts[0]] == [('proj', 'a.nii'), ('base', 'a.nii'), ('base', 'c.dcm')]
+    assert db.projects.queries == 1
+    assert db.singletons.queries == 1
+
+    # Compiled rules are cached per project until invalidated
+    db.projects.docs[0]['rules'] = []
+    assert rules.create_jobs(db, {'_id': 'ss', 'project': 'p'}, 'session', files[0]) == ['proj', 'base']
+    assert db.projects.queries == 1
+
+    rules.invalidate_rules('p')
+    assert rules.create_jobs(db, acquisition, 'acquisition', files[0]) == ['base']
+    assert db.projects.queries == 2
+    assert db.singletons.queries == 1
+
+    # No matches, no insert
+    assert rules.create_jobs(db, acquisition, 'acquisition', files[1]) == []
+    assert len(db.jobs.inserts) == 3
+    rules.invalidate_rules()
+    rules.gears.invalidate_gears()
+
+def test_gear_registry(fake_db):
+    db = fake_db.load(singletons=[{'_id': 'gears', 'gear_list': [fake_gear('a')]}])
+    rules.gears.invalidate_gears()
+
+    gear = rules.gears.get_gear_by_name('a')
+    gear['input']['changed'] = True
+    assert rules.gears.get_gear_by_name('a') == fake_gear('a')
+    assert db.singletons.queries == 1
+
+    # Unknown names reload the registry before failing
+    with pytest.raises(Exception):
+        rules.gears.get_gear_by_name('b')
+    assert db.singletons.queries == 2
+
+    db.singletons.docs[0]['gear_list'].append(fake_gear('b'))
+    assert rules.gears.get_gear_by_name('b')['name'] == 'b'
+    assert db.singletons.queries == 3
+    rules.gears.invalidate_gears()
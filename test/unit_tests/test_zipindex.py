@@ -0,0 +1,66 @@
+import os
+import datetime
+import zipfile
+
+import pytest
+
+from api import zipindex
+
+
+@pytest.fixture
+def archive(tmpdir):
+    path = str(tmpdir.join('archive.zip'))
+    stored = os.urandom(3 * zipindex.CHUNKSIZE + 123)
+    deflated = 'DICM' * (2 * zipindex.CHUNKSIZE) # compresses far below one chunk
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.comment = 'a comment'
+        zf.writestr(zipfile.ZipInfo('dir/stored.bin'), stored, zipfile.ZIP_STORED)
+        zf.writestr('dir/deflated.dcm', deflated, zipfile.ZIP_DEFLATED)
+        zf.writestr('dir/empty', '', zipfile.ZIP_DEFLATED)
+    zipindex.index_cache.clear()
+    return path, {'dir/stored.bin': stored, 'dir/deflated.dcm': deflated, 'dir/empty': ''}
+
+def test_index_is_cached(archive):
+    path, contents = archive
+    index = zipindex.get_index('hash', path)
+    assert zipindex.get_index('hash', path) is index
+    info = index.info()
+    assert info['comment'] == 'a comment'
+    assert [m['path'] for m in info['members']] == ['dir/stored.bin', 'dir/deflated.dcm', 'dir/empty']
+    assert [m['size'] for m in info['members']] == [len(contents[m['path']]) for m in info['members']]
+
+def test_member_stream(archive):
+    path, contents = archive
+    index = zipindex.get_index('hash', path)
+    for name, data in contents.iteritems():
+        chunks = list(zipindex.member_stream(path, index.members[name]))
+        assert ''.join(chunks) == data
+        assert all(len(chunk) <= zipindex.CHUNKSIZE for chunk in chunks)
+
+def test_member_range(archive):
+    path, contents = archive
+    index = zipindex.get_index('hash', path)
+    stored = index.members['dir/stored.bin']
+    assert zipindex.is_seekable(stored)
+    start, length = zipindex.CHUNKSIZE - 10, zipindex.CHUNKSIZE + 20
+    assert ''.join(zipindex.member_stream(path, stored, start, length)) == contents['dir/stored.bin'][start:start+length]
+
+    deflated = index.members['dir/deflated.dcm']
+    assert not zipindex.is_seekable(deflated)
+    with pytest.raises(ValueError):
+        list(zipindex.member_stream(path, deflated, 10, 10))
+
+def test_not_a_zip(tmpdir):
+    path = tmpdir.join('plain.txt')
+    path.write('not a zip')
+    with pytest.raises(zipfile.BadZipfile):
+        zipindex.get_index('other', str(path))
+
+def test_invalid_timestamp(tmpdir):
+    path = str(tmpdir.join('zeroed.zip'))
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr(zipfile.ZipInfo('valid', (2016, 6, 1, 12, 0, 0)), 'a')
+        zf.writestr(zipfile.ZipInfo('zeroed', (1980, 0, 0, 0, 0, 0)), 'b')
+    index = zipindex.get_index('zeroed', path)
+    assert [m['timestamp'] for m in index.info()['members']] == [datetime.datetime(2016, 6, 1, 12, 0, 0), None]
+    assert ''.join(zipindex.member_stream(path, index.members['zeroed'])) == 'b'